@@ -0,0 +1,123 @@
+"""
+N Perplexity fetches from one process against the local mock server with
+artificial latency: sequential pooled client vs. the asyncio client with a
+bounded number of requests in flight.
+
+The "pipeline" rows time services.fetch_trends_concurrently, which also
+parses, scores and saves every reply, on a throwaway test database with
+the embedding model stubbed out (see benchmarks.load).
+
+    python -m benchmarks.async_fetch --queries 50 --latency 0.5 --concurrency 1 8 32
+"""
+import argparse
+import asyncio
+import time
+
+from ._django import setup
+
+setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from trends.mock_perplexity import MockPerplexityServer  # noqa: E402
+from trends.models import TrendQuery  # noqa: E402
+from trends.perplexity import AsyncPerplexityClient, PerplexityClient  # noqa: E402
+from trends.ratelimit import RateLimiter  # noqa: E402
+from trends.services import fetch_trends_concurrently  # noqa: E402
+
+from .load import LOCMEM_CACHES, fake_embeddings, query_params  # noqa: E402
+
+PAYLOAD = {
+    "model": "sonar-pro",
+    "messages": [{"role": "user", "content": "benchmark"}],
+    "temperature": 1.5,
+}
+UNLIMITED = RateLimiter(limits={})  # measure the transport, not the API budget
+
+
+def run_sequential(url, queries):
+    client = PerplexityClient(api_key="bench", api_url=url, limiter=UNLIMITED)
+    started = time.perf_counter()
+    for _ in range(queries):
+        client.create_completion(PAYLOAD).json()
+    client.close()
+    return time.perf_counter() - started
+
+
+async def run_async(url, queries, concurrency):
+    client = AsyncPerplexityClient(api_key="bench", api_url=url, pool_maxsize=concurrency, limiter=UNLIMITED)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            resp = await client.create_completion(PAYLOAD)
+            return resp.json()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(queries)))
+    elapsed = time.perf_counter() - started
+    await client.aclose()
+    return elapsed
+
+
+def run_pipeline(url, queries, concurrency):
+    # Fresh rows and an empty response cache, so every query goes upstream.
+    cache.clear()
+    query_ids = [str(TrendQuery.objects.create(**query_params(i)).id) for i in range(queries)]
+
+    async def fetch():
+        client = AsyncPerplexityClient(api_key="bench", api_url=url, pool_maxsize=concurrency, limiter=UNLIMITED)
+        try:
+            return await fetch_trends_concurrently(query_ids, concurrency=concurrency, client=client)
+        finally:
+            await client.aclose()
+
+    started = time.perf_counter()
+    outcomes = asyncio.run(fetch())
+    elapsed = time.perf_counter() - started
+    failed = sum(isinstance(outcome, Exception) for outcome in outcomes.values())
+    if failed:
+        print(f"  {failed} of {queries} pipeline fetches failed")
+    return elapsed
+
+
+def run_pipelines(url, queries, levels):
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+    patches = fake_embeddings()
+    try:
+        with override_settings(CACHES=LOCMEM_CACHES):
+            for patcher in patches:
+                patcher.start()
+            for concurrency in levels:
+                elapsed = run_pipeline(url, queries, concurrency)
+                label = f"pipeline, {concurrency} in flight"
+                print(f"{label:<22}{elapsed:>10.2f}{queries / elapsed:>12.1f}")
+    finally:
+        for patcher in patches:
+            patcher.stop()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    with MockPerplexityServer(latency=args.latency) as server:
+        print(f"{'mode':<22}{'total s':>10}{'queries/s':>12}")
+        elapsed = run_sequential(server.url, args.queries)
+        print(f"{'sync sequential':<22}{elapsed:>10.2f}{args.queries / elapsed:>12.1f}")
+        for concurrency in args.concurrency:
+            elapsed = asyncio.run(run_async(server.url, args.queries, concurrency))
+            label = f"async, {concurrency} in flight"
+            print(f"{label:<22}{elapsed:>10.2f}{args.queries / elapsed:>12.1f}")
+        run_pipelines(server.url, args.queries, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Trend emails to N recipients: one connection per message (the old
+send_trend_email loop) vs. build_trend_email + send_email_batch over one
+connection per batch.
+
+Runs against Django's locmem backend (render and build cost only) and a
+local SMTP stand-in; --handshake-ms adds a delay to every new SMTP session
+to model the TCP+TLS+AUTH round trips to a remote server like Gmail.
+
+    python -m benchmarks.email_batch --recipients 1000 10000 --handshake-ms 0 50
+"""
+import argparse
+import socketserver
+import threading
+import time
+from types import SimpleNamespace
+
+from ._django import setup
+
+setup()
+
+from django.test.utils import override_settings  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from trends.email_utils import build_trend_email, send_email_batch, send_trend_email  # noqa: E402
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: greeting, EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT."""
+
+    disable_nagle_algorithm = True  # multi-line replies would otherwise stall on delayed ACKs
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self):
+        self.server.record_session()
+        if self.server.handshake:
+            time.sleep(self.server.handshake)
+        self.reply("220 localhost stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.record_message()
+                self.reply("250 OK queued")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:  # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply("250 OK")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, handshake=0.0):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.handshake = handshake
+        self.sessions = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def record_session(self):
+        with self._lock:
+            self.sessions += 1
+
+    def record_message(self):
+        with self._lock:
+            self.messages += 1
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def make_recipients(count, result_count=5):
+    query = SimpleNamespace(
+        id="00000000-0000-0000-0000-000000000001", industry="fashion", region="India",
+        persona="creator", date_range="last 7 days", updated_at=timezone.now())
+    results = [
+        SimpleNamespace(topic=f"Trend {i}", summary="A synthetic summary for the benchmark. " * 4,
+                        final_score=90 - i, engagement_score=50, freshness_score=80, relevance_score=60,
+                        suggested_angles=["Angle A", "Angle B"], sources={"urls": []})
+        for i in range(result_count)
+    ]
+    users = [SimpleNamespace(id=i, email=f"reader{i}@example.com", first_name="Reader", last_name=str(i))
+             for i in range(count)]
+    return query, results, users
+
+
+def per_message(query, results, users):
+    for user in users:
+        send_trend_email(user, query, 2, results=results, subject="Your trends have been refreshed (v2)")
+
+
+def batched(query, results, users, batch_size):
+    for start in range(0, len(users), batch_size):
+        messages = [build_trend_email(user, query, 2, results=results, subject="Your trends have been refreshed (v2)")
+                    for user in users[start:start + batch_size]]
+        failures = send_email_batch(messages)
+        assert not failures, failures
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--handshake-ms", type=float, nargs="+", default=[0, 50],
+                        help="Per-session delay of the SMTP stand-in.")
+    args = parser.parse_args()
+
+    print(f"{'backend':<24}{'recipients':>11}{'mode':>12}{'sessions':>10}{'total s':>10}{'msgs/s':>10}")
+
+    def row(backend, count, mode, sessions, elapsed):
+        print(f"{backend:<24}{count:>11}{mode:>12}{sessions:>10}{elapsed:>10.2f}{count / elapsed:>10.0f}")
+
+    locmem = "django.core.mail.backends.locmem.EmailBackend"
+    for count in args.recipients:
+        query, results, users = make_recipients(count)
+        with override_settings(EMAIL_BACKEND=locmem):
+            row("locmem", count, "per-message", count, timed(per_message, query, results, users))
+            row("locmem", count, "batched", -(-count // args.batch_size),
+                timed(batched, query, results, users, args.batch_size))
+
+    smtp = "django.core.mail.backends.smtp.EmailBackend"
+    for handshake_ms in args.handshake_ms:
+        for count in args.recipients:
+            query, results, users = make_recipients(count)
+            for mode in ("per-message", "batched"):
+                with SMTPStandIn(handshake=handshake_ms / 1000) as server, override_settings(
+                        EMAIL_BACKEND=smtp, EMAIL_HOST="127.0.0.1", EMAIL_PORT=server.server_address[1],
+                        EMAIL_USE_TLS=False, EMAIL_HOST_USER="", EMAIL_HOST_PASSWORD=""):
+                    if mode == "per-message":
+                        elapsed = timed(per_message, query, results, users)
+                    else:
+                        elapsed = timed(batched, query, results, users, args.batch_size)
+                    assert server.messages == count, (server.messages, count)
+                    row(f"smtp, {handshake_ms:g} ms handshake", count, mode, server.sessions, elapsed)
+
+
+if __name__ == "__main__":
+    main()
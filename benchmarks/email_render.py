@@ -0,0 +1,67 @@
+"""
+Render time per recipient of a trend email for one query version with
+hundreds of subscribers: the whole body rendered for every subscriber
+vs. the results block rendered once (cached_results_block) and only the
+per-recipient fragments rendered per user.
+
+    python -m benchmarks.email_render --subscribers 100 500 1000 --results 5 10
+"""
+import argparse
+import time
+
+from ._django import setup
+
+setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from trends.email_utils import build_trend_email, cached_results_block  # noqa: E402
+
+from .email_batch import make_recipients  # noqa: E402
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+SUBJECT = "Your trends have been refreshed (v2)"
+
+
+def full_render(query, results, users):
+    for user in users:
+        build_trend_email(user, query, 2, results=results, subject=SUBJECT)
+
+
+def render_once(query, results, users):
+    cache.clear()
+    blocks = cached_results_block(query, 2, results)
+    for user in users:
+        build_trend_email(user, query, 2, subject=SUBJECT, blocks=blocks)
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--results", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'results':>8}{'subscribers':>13}{'full us/rcpt':>14}{'once us/rcpt':>14}{'speedup':>9}")
+    with override_settings(CACHES=LOCMEM_CACHES):
+        for result_count in args.results:
+            for count in args.subscribers:
+                query, results, users = make_recipients(count, result_count)
+                full = best_of(args.repeat, full_render, query, results, users)
+                once = best_of(args.repeat, render_once, query, results, users)
+                print(f"{result_count:>8}{count:>13}{full / count * 1e6:>14.0f}{once / count * 1e6:>14.0f}"
+                      f"{full / once:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
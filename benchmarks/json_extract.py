@@ -0,0 +1,149 @@
+"""
+extract_json_from_text on real-shaped malformed completions, 10 KB to 1 MB:
+the old regex pipeline vs. the single-pass scanner in trends.json_extract.
+
+    python -m benchmarks.json_extract --sizes 10000 100000 1000000 --timeout 30
+
+The legacy implementation runs in a child process and is killed after
+--timeout seconds, since its backtracking can take far longer on large,
+unbalanced input.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import time
+
+from ._django import setup
+
+setup()
+
+from trends.json_extract import extract_json  # noqa: E402
+
+
+# --- the pre-scanner implementation, kept verbatim for comparison ---------
+
+def legacy_clean_json_numbers(text):
+    return re.sub(r'(\d+)_(\d+)', r'\1\2', text)
+
+
+def legacy_sanitize_json(text):
+    text = re.sub(r',(\s*[\]}])', r'\1', text)
+    text = re.sub(r'\"\"(\s*[,\]])', r'"\1', text)
+    text = text.replace("“", "\"").replace("”", "\"")
+    return text
+
+
+def legacy_extract(text):
+    cleaned = legacy_sanitize_json(legacy_clean_json_numbers(text))
+    try:
+        return json.loads(cleaned)
+    except Exception:
+        pass
+    m = re.search(r'(\{.*"results"\s*:\s*\[.*\]\s*\})', cleaned, re.S)
+    if m:
+        try:
+            return json.loads(m.group(1))
+        except Exception:
+            pass
+    m2 = re.search(r'(\[.*\])', cleaned, re.S)
+    if m2:
+        try:
+            return {"results": json.loads(m2.group(1))}
+        except Exception:
+            pass
+    return None
+
+
+# --- corpus ---------------------------------------------------------------
+
+def result_text(i, rng):
+    likes = f"{rng.randint(1, 99)}_{rng.randint(100, 999)}"
+    return (
+        '    {\n'
+        f'      "topic": “Trend {i}: creator commerce”,\n'
+        f'      "summary": "Brands [{i}] shift {{budget}} to short-form video"",\n'
+        '      "sources": {\n'
+        f'        "urls": ["https://example.com/{i}", "https://x.com/status/{i}",],\n'
+        '        "dates": ["2025-09-01", "2025-09-12"],\n'
+        f'        "engagement": [{{"likes": {likes}, "shares": 12, "comments": 4,}},],\n'
+        '      },\n'
+        '      "suggested_angles": ["Angle A", "Angle B",],\n'
+        '    },\n'
+    )
+
+
+def build(shape, size, seed=7):
+    rng = random.Random(seed)
+    head = "Sure! Here are the latest trends based on your query:\n\n```json\n{\n  \"results\": [\n"
+    body = []
+    length = len(head)
+    i = 0
+    while length < size:
+        piece = result_text(i, rng)
+        body.append(piece)
+        length += len(piece)
+        i += 1
+    text = head + "".join(body)
+
+    if shape == "wrapped":
+        return text + "  ]\n}\n```\nLet me know if you want more detail on any trend [1]."
+    if shape == "truncated":
+        # Generation stopped mid-object: nothing balanced at the top level.
+        return text
+    if shape == "bracket_noise":
+        # Markdown-ish prose with many unmatched brackets and no JSON at all.
+        return "".join(f"- point [{j} see (ref) {{note" + "\n" for j in range(size // 24))
+    raise ValueError(shape)
+
+
+SHAPES = ("wrapped", "truncated", "bracket_noise")
+
+
+def _legacy_child(text, queue):
+    started = time.perf_counter()
+    result = legacy_extract(text)
+    queue.put((time.perf_counter() - started, result is not None))
+
+
+def time_legacy(text, timeout):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_legacy_child, args=(text, queue))
+    proc.start()
+    proc.join(timeout)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+        return None, None
+    return queue.get()
+
+
+def time_scanner(text):
+    started = time.perf_counter()
+    result = extract_json(text)
+    return time.perf_counter() - started, result is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'shape':<15}{'size':>10}{'legacy s':>12}{'ok':>5}{'scanner s':>12}{'ok':>5}")
+    for shape in SHAPES:
+        for size in args.sizes:
+            text = build(shape, size)
+            legacy_s, legacy_ok = time_legacy(text, args.timeout)
+            scan_s, scan_ok = time_scanner(text)
+            legacy_col = f"{legacy_s:.3f}" if legacy_s is not None else f">{args.timeout:g}"
+            print(f"{shape:<15}{len(text):>10}{legacy_col:>12}{str(legacy_ok or False)[0]:>5}"
+                  f"{scan_s:>12.3f}{str(scan_ok)[0]:>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+End-to-end load test: N trend queries submitted through the API
+(TrendQueryCreateView) and processed by process_trend_query against a
+local Perplexity stand-in, on a throwaway test database.
+
+Reports requests and tasks per second, latency percentiles and database
+queries per request/task. Tasks run in-process (task.apply) on a thread
+pool instead of through a broker, so the numbers are the app's own cost.
+
+    python -m benchmarks.load --queries 200 --concurrency 8 --latency 1.5 \
+        --latency-sigma 0.5 --error-rate 0.05 --malformed-rate 0.05
+
+--api-url points at an already running stand-in (manage.py
+run_mock_perplexity) instead of starting one here. SQLite serialises
+writers, so use the Postgres settings for --concurrency above 1.
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from ._django import setup
+
+setup()
+
+import numpy as np  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import (  # noqa: E402
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment)
+from django.urls import reverse  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from trends import perplexity, services  # noqa: E402
+from trends.mock_perplexity import MockPerplexityServer  # noqa: E402
+from trends.models import IngestionRun, TrendQuery, UpstreamCall, User  # noqa: E402
+from trends.tasks import process_trend_query  # noqa: E402
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+INDUSTRIES = ("fashion", "fintech", "gaming", "food", "travel", "fitness", "beauty", "edtech")
+REGIONS = ("India", "US", "UK", "Brazil", "Germany")
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    ordered = sorted(values)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in (50, 95, 99)}
+
+
+def query_params(i):
+    # Distinct parameters, so the create view's one-day dedupe never short-circuits.
+    return {
+        "industry": INDUSTRIES[i % len(INDUSTRIES)],
+        "region": REGIONS[(i // len(INDUSTRIES)) % len(REGIONS)],
+        "persona": f"load-test persona {i}",
+        "date_range": "last 7 days",
+    }
+
+
+def fake_embeddings():
+    """Deterministic stand-ins for the sentence-transformer calls."""
+    def fake_embed(trends, model_name=None, batch_size=32):
+        rng = np.random.default_rng(len(trends))
+        vectors = rng.standard_normal((len(trends), 384)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def fake_relevance(query_obj, trends, trend_vectors=None):
+        return [50.0] * len(trends)
+
+    return [mock.patch.object(services, "embed_trends", side_effect=fake_embed),
+            mock.patch.object(services, "compute_relevance_batch", side_effect=fake_relevance)]
+
+
+def submit(count):
+    """POST `count` queries; returns (query ids, latencies ms, queries per request)."""
+    user = User.objects.create_user(
+        email="load@example.com", password="load", first_name="Load", last_name="Test")
+    client = APIClient()
+    client.force_authenticate(user)
+    url = reverse("trend-query-create")
+
+    ids, latencies, db_queries = [], [], []
+    with mock.patch.object(process_trend_query, "delay") as delay:
+        for i in range(count):
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                response = client.post(url, query_params(i), format="json")
+                latencies.append((time.perf_counter() - started) * 1000)
+            db_queries.append(len(ctx.captured_queries))
+            if response.status_code >= 400:
+                raise RuntimeError(f"Create view returned {response.status_code}: {response.content[:200]}")
+        ids = [call.args[0] for call in delay.call_args_list]
+    return ids, latencies, db_queries
+
+
+def process(query_id):
+    try:
+        with CaptureQueriesContext(connection) as ctx:
+            started = time.perf_counter()
+            result = process_trend_query.apply(args=[query_id])
+            elapsed = (time.perf_counter() - started) * 1000
+        return elapsed, len(ctx.captured_queries), result.failed()
+    finally:
+        connection.close()
+
+
+def report(label, latencies, db_queries, elapsed):
+    p = percentiles(latencies)
+    per_call = sum(db_queries) / len(db_queries) if db_queries else 0
+    print(f"{label:<10}{len(latencies):>7}{len(latencies) / elapsed:>10.1f}"
+          f"{p['p50']:>10.1f}{p['p95']:>10.1f}{p['p99']:>10.1f}{per_call:>12.1f}{max(db_queries, default=0):>8}")
+
+
+def run(args, api_url):
+    ids_started = time.perf_counter()
+    ids, create_ms, create_queries = submit(args.queries)
+    create_elapsed = time.perf_counter() - ids_started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        outcomes = list(pool.map(process, ids))
+    task_elapsed = time.perf_counter() - started
+
+    print(f"{args.queries} queries, {args.concurrency} workers, upstream {api_url}")
+    print(f"{'phase':<10}{'count':>7}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'db q/call':>12}{'max q':>8}")
+    report("create", create_ms, create_queries, create_elapsed)
+    report("process", [o[0] for o in outcomes], [o[1] for o in outcomes], task_elapsed)
+
+    statuses = {}
+    for status in TrendQuery.objects.filter(id__in=ids).values_list("status", flat=True):
+        statuses[status] = statuses.get(status, 0) + 1
+    runs = {}
+    for status in IngestionRun.objects.filter(query_id__in=ids).values_list("status", flat=True):
+        runs[status] = runs.get(status, 0) + 1
+    print(f"task failures {sum(o[2] for o in outcomes)}; query status {statuses}; ingestion runs {runs}; "
+          f"upstream calls {UpstreamCall.objects.filter(query_id__in=ids).count()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1, help="Tasks processed at once.")
+    parser.add_argument("--api-url", default=None, help="Use a running stand-in instead of starting one.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Median upstream latency, seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--results", type=int, default=5, help="Trends per upstream reply.")
+    parser.add_argument("--summary-chars", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backoff-base", type=float, default=0.1,
+                        help="PERPLEXITY_BACKOFF_BASE for the run, seconds.")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Skip the sentence-transformer (measures everything but the encoder).")
+    parser.add_argument("--keepdb", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's warning/error logs.")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)  # injected errors would drown the report
+
+    server = None
+    api_url = args.api_url
+    if not api_url:
+        server = MockPerplexityServer(
+            latency=args.latency, latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate, result_count=args.results,
+            summary_chars=args.summary_chars, seed=args.seed).start()
+        api_url = server.url
+
+    patches = fake_embeddings() if args.fake_embeddings else []
+    old_name = connection.settings_dict["NAME"]
+    setup_test_environment()  # testserver host, locmem email backend
+    connection.creation.create_test_db(verbosity=0, keepdb=args.keepdb)
+    try:
+        with override_settings(
+                CACHES=LOCMEM_CACHES,
+                PERPLEXITY_API_URL=api_url,
+                PERPLEXITY_BACKOFF_BASE=args.backoff_base,
+                PERPLEXITY_RATE_LIMITS={},  # measure the app, not the API budget
+                PERPLEXITY_STREAMING=False):
+            perplexity._client = None  # rebuilt with the overridden URL
+            for patcher in patches:
+                patcher.start()
+            try:
+                run(args, api_url)
+            finally:
+                for patcher in patches:
+                    patcher.stop()
+                perplexity._client = None
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=args.keepdb)
+        teardown_test_environment()
+        if server:
+            print(f"stand-in: {len(server.requests)} requests over {server.connections} connections, "
+                  f"replies {server.replies}")
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
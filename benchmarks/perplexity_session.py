@@ -0,0 +1,64 @@
+"""
+Sequential Perplexity calls against the local mock server: bare
+requests.post per call (one connection each) vs. the pooled client.
+
+    python -m benchmarks.perplexity_session --calls 200
+"""
+import argparse
+import statistics
+import time
+
+import requests
+
+from ._django import setup
+
+setup()
+
+from trends.mock_perplexity import MockPerplexityServer  # noqa: E402
+from trends.perplexity import PerplexityClient  # noqa: E402
+
+PAYLOAD = {
+    "model": "sonar-pro",
+    "messages": [{"role": "user", "content": "benchmark"}],
+    "temperature": 1.5,
+}
+
+
+def run(call, calls):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(calls):
+        t0 = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - t0)
+    return time.perf_counter() - started, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Artificial server latency per request, seconds.")
+    args = parser.parse_args()
+
+    print(f"{'mode':<18}{'total s':>10}{'p50 ms':>10}{'p99 ms':>10}{'connections':>13}")
+    for label in ("requests.post", "pooled session"):
+        with MockPerplexityServer(latency=args.latency) as server:
+            if label == "requests.post":
+                def call():
+                    requests.post(server.url, json=PAYLOAD, timeout=120).raise_for_status()
+            else:
+                client = PerplexityClient(api_key="bench", api_url=server.url)
+
+                def call():
+                    client.post_completion(PAYLOAD)
+
+            total, latencies = run(call, args.calls)
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000
+            p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+            print(f"{label:<18}{total:>10.3f}{p50:>10.2f}{p99:>10.2f}{server.connections:>13}")
+
+
+if __name__ == "__main__":
+    main()
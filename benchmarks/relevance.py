@@ -0,0 +1,73 @@
+"""
+Relevance scoring for synthetic Perplexity payloads: one encode call per
+trend (the old loop) vs. compute_relevance_batch.
+
+    python -m benchmarks.relevance --sizes 5 50 500 --repeat 3
+"""
+import argparse
+import statistics
+import time
+from types import SimpleNamespace
+
+from ._django import setup
+
+setup()
+
+from trends import embeddings  # noqa: E402
+from trends.services import build_relevance_query_text, compute_relevance_batch  # noqa: E402
+
+
+def synthetic_trends(n):
+    return [
+        (
+            f"Trend {i}: creator-led commerce wave {i % 17}",
+            f"Brands in segment {i % 11} are shifting budget towards short-form "
+            f"video and community programs, with engagement up {i % 40}% this quarter.",
+        )
+        for i in range(n)
+    ]
+
+
+def per_trend(query_obj, trends):
+    from sentence_transformers import util
+
+    model = embeddings.get_model()
+    query_text = build_relevance_query_text(query_obj)
+    scores = []
+    for topic, summary in trends:
+        vectors = model.encode([query_text, f"{topic} {summary}"], convert_to_tensor=True)
+        scores.append(max(0.0, round(util.cos_sim(vectors[0], vectors[1]).item() * 100, 2)))
+    return scores
+
+
+def timed(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 50, 500])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    query_obj = SimpleNamespace(
+        industry="Fintech", persona="Founders", region="India", date_range="last 30 days")
+    embeddings.warm_up()
+
+    print(f"{'trends':>8}{'per-trend s':>14}{'batched s':>12}{'speedup':>10}{'max |diff|':>12}")
+    for n in args.sizes:
+        trends = synthetic_trends(n)
+        slow, slow_scores = timed(lambda: per_trend(query_obj, trends), args.repeat)
+        fast, fast_scores = timed(lambda: compute_relevance_batch(query_obj, trends), args.repeat)
+        diff = max(abs(a - b) for a, b in zip(slow_scores, fast_scores))
+        print(f"{n:>8}{slow:>14.3f}{fast:>12.3f}{slow / fast:>9.1f}x{diff:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Engagement / freshness / final_score for N synthetic results: the scalar
+per-result functions vs. trends.scoring on NumPy columns.
+
+    python -m benchmarks.scoring --sizes 1000 10000 100000 1000000
+
+"columns" is the cost of flattening the result dicts into arrays and
+"vector" the array math alone (what a rescore of already-loaded columns
+pays); both are checked against the scalar output.
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+from ._django import setup
+
+setup()
+
+from django.utils import timezone  # noqa: E402
+
+from trends import scoring  # noqa: E402
+from trends.models import TrendResult  # noqa: E402
+from trends.services import score_result  # noqa: E402
+
+
+def synthetic_results(n, seed=7):
+    rng = random.Random(seed)
+    now = timezone.now()
+    results = []
+    for i in range(n):
+        results.append({
+            "topic": f"Trend {i}",
+            "sources": {
+                "urls": [f"https://example.com/{i}/{j}" for j in range(rng.randint(0, 6))],
+                "dates": [
+                    (now - timedelta(days=rng.randint(0, 45), hours=rng.randint(0, 23))).date().isoformat()
+                    for _ in range(rng.randint(0, 3))
+                ],
+                "engagement": [
+                    {"likes": rng.randint(0, 150), "shares": rng.randint(0, 40), "comments": rng.randint(0, 30)}
+                    for _ in range(rng.randint(0, 3))
+                ],
+            },
+        })
+    relevance = [round(rng.uniform(0, 100), 2) for _ in range(n)]
+    return results, relevance
+
+
+def scalar(query_obj, results, relevance):
+    out = []
+    for r, rel in zip(results, relevance):
+        engagement, freshness, rel = score_result(query_obj, r, relevance=rel)
+        row = SimpleNamespace(engagement_score=engagement, freshness_score=freshness, relevance_score=rel)
+        out.append((engagement, freshness, rel, TrendResult.calculate_final_score(row)))
+    return np.array(out).T
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    query_obj = SimpleNamespace(created_at=timezone.now() - timedelta(days=2))
+    print(f"{'rows':>10}{'scalar s':>12}{'columns s':>12}{'vector s':>12}{'speedup':>10}  match")
+    for n in args.sizes:
+        results, relevance = synthetic_results(n)
+
+        started = time.perf_counter()
+        expected = scalar(query_obj, results, relevance)
+        scalar_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        columns = scoring.build_columns(results, query_obj.created_at)
+        columns_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        actual = scoring.score_columns(columns, relevance)
+        vector_s = time.perf_counter() - started
+
+        match = all(np.array_equal(a, b) for a, b in zip(expected, actual))
+        print(f"{n:>10}{scalar_s:>12.3f}{columns_s:>12.3f}{vector_s:>12.4f}"
+              f"{scalar_s / (columns_s + vector_s):>9.1f}x  {match}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Startup cost of the web process: `import trends.views` with the lazy
+embedding registry vs. the old behaviour of loading the model at import.
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from ._django import BASE_DIR
+
+CHILD = r"""
+import json, resource, sys, time
+sys.path.insert(0, {base!r})
+from benchmarks._django import setup
+setup()
+
+started = time.perf_counter()
+import trends.views
+if {eager}:
+    from trends.embeddings import warm_up
+    warm_up()
+elapsed = time.perf_counter() - started
+
+from trends.embeddings import is_loaded
+print(json.dumps({{
+    "seconds": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "model_loaded": is_loaded(),
+}}))
+"""
+
+
+def run_once(eager):
+    code = CHILD.format(base=str(BASE_DIR), eager=eager)
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=BASE_DIR,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'mode':<20}{'import s (median)':>20}{'max RSS MB':>14}{'model loaded':>14}")
+    for label, eager in (("before (eager load)", True), ("after (lazy)", False)):
+        samples = [run_once(eager) for _ in range(args.runs)]
+        seconds = statistics.median(s["seconds"] for s in samples)
+        rss = statistics.median(s["max_rss_mb"] for s in samples)
+        print(f"{label:<20}{seconds:>20.3f}{rss:>14.1f}{str(samples[0]['model_loaded']):>14}")
+
+
+if __name__ == "__main__":
+    main()
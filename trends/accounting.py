@@ -0,0 +1,108 @@
+"""
+Token and cost accounting for Perplexity calls.
+
+Each upstream call (not cache hits) is stored as an UpstreamCall row with
+its usage, latency, status, attempts and cost. The roll-ups below group
+that spend per day, per user and per query fingerprint.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Avg, Count, Sum
+from django.db.models.functions import TruncDate
+
+from .query_builder import query_fingerprint
+
+
+def estimate_cost(model, usage):
+    """USD for one call: the response's own usage.cost when present, else PERPLEXITY_PRICING."""
+    cost = usage.get("cost")
+    if isinstance(cost, dict) and cost.get("total_cost") is not None:
+        return Decimal(str(cost["total_cost"]))
+
+    price = getattr(settings, "PERPLEXITY_PRICING", {}).get(model)
+    if not price:
+        return Decimal(0)
+    amount = (
+        usage.get("prompt_tokens", 0) * price.get("input", 0)
+        + usage.get("completion_tokens", 0) * price.get("output", 0)
+    ) / 1_000_000 + price.get("request", 0)
+    return Decimal(str(round(amount, 6)))
+
+
+def upstream_call_fields(payload, call_info, latency_ms, data=None, usage=None, streamed=False):
+    """
+    Field values for an UpstreamCall, from the request payload, the
+    client's call_info and the response body (or the usage of a stream).
+    Returns None when no HTTP attempt was made (e.g. circuit open).
+    """
+    if not call_info.get("attempts"):
+        return None
+    data = data or {}
+    usage = usage or data.get("usage") or {}
+    model = data.get("model") or payload.get("model", "")
+    status = call_info.get("status")
+    return {
+        "model": model,
+        "status_code": status,
+        "attempts": call_info["attempts"],
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+        "latency_ms": round(latency_ms, 2),
+        # Only answered calls are billed.
+        "cost": estimate_cost(model, usage) if status is not None and status < 400 else Decimal(0),
+        "streamed": streamed,
+    }
+
+
+def record_upstream_call(query_obj, fields, version=None):
+    from .models import UpstreamCall
+
+    return UpstreamCall.objects.create(
+        query=query_obj,
+        version=version,
+        fingerprint=query_fingerprint(
+            query_obj.industry, query_obj.region, query_obj.persona, query_obj.date_range),
+        **fields,
+    )
+
+
+def _rollup(qs, *group_by):
+    return (
+        qs.values(*group_by)
+        .annotate(
+            calls=Count("id"),
+            prompt_tokens=Sum("prompt_tokens"),
+            completion_tokens=Sum("completion_tokens"),
+            cost=Sum("cost"),
+            avg_latency_ms=Avg("latency_ms"),
+        )
+        .order_by(*group_by)
+    )
+
+
+def _calls(since=None):
+    from .models import UpstreamCall
+
+    qs = UpstreamCall.objects.all()
+    if since is not None:
+        qs = qs.filter(created_at__gte=since)
+    return qs
+
+
+def cost_by_day(since=None):
+    return _rollup(_calls(since).annotate(day=TruncDate("created_at")), "day")
+
+
+def cost_by_user(since=None):
+    # A query shared by several users counts towards each of them.
+    return _rollup(_calls(since).filter(query__user__isnull=False), "query__user", "query__user__email")
+
+
+def cost_by_fingerprint(since=None):
+    return _rollup(_calls(since), "fingerprint").order_by("-cost")
+
+
+def total_cost(since=None):
+    return _calls(since).aggregate(calls=Count("id"), tokens=Sum("total_tokens"), cost=Sum("cost"))
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import TrendQuery, TrendResult, User, QuerySubscription, SignUpOTP
+from .models import TrendQuery, TrendResult, User, QuerySubscription, SignUpOTP, IngestionRun, UpstreamCall, EmailOutbox
 
 # Register your models here.
 admin.site.register(TrendQuery)
@@ -9,6 +9,30 @@ admin.site.register(SignUpOTP)
 
 @admin.register(QuerySubscription)
 class QuerySubscriptionAdmin(admin.ModelAdmin):
-    list_display = ("user", "query", "wants_emails", "is_active", "created_at")
-    list_filter = ("wants_emails", "is_active")
+    list_display = ("user", "query", "wants_emails", "is_active", "delivery", "created_at")
+    list_filter = ("wants_emails", "is_active", "delivery")
     search_fields = ("user__email", "query__industry", "query__region")
+
+
+@admin.register(IngestionRun)
+class IngestionRunAdmin(admin.ModelAdmin):
+    list_display = ("query", "version", "status", "result_count", "fetch_ms", "parse_ms",
+                    "embed_ms", "score_ms", "persist_ms", "total_ms", "created_at")
+    list_filter = ("status", "streamed", "from_cache")
+    search_fields = ("query__id", "query__industry")
+
+
+@admin.register(UpstreamCall)
+class UpstreamCallAdmin(admin.ModelAdmin):
+    list_display = ("query", "version", "model", "status_code", "attempts", "prompt_tokens",
+                    "completion_tokens", "cost", "latency_ms", "created_at")
+    list_filter = ("model", "status_code", "streamed")
+    search_fields = ("fingerprint", "query__industry")
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ("kind", "to_email", "subject", "status", "attempts", "next_attempt_at", "created_at", "sent_at")
+    list_filter = ("status", "kind")
+    search_fields = ("to_email", "subject")
+    exclude = ("body_text", "body_html")  # a pending signup email holds its code
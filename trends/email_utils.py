@@ -1,9 +1,15 @@
+import logging
+
+from django.core.cache import cache
 from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.utils import timezone
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
 from urllib.parse import urljoin
 
+logger = logging.getLogger(__name__)
+
 BASE_URL = "http://127.0.0.1:8000"
 
 
@@ -18,28 +24,72 @@ def build_unsubscribe_url(user, query):
     return urljoin(BASE_URL, f"/trendsage/web/query/{query.id}/subscription/unsubscribe/{user.id}/")
 
 
-def send_trend_email(user, query, version, results=None, subject=None, message=None, include_results=True):
+def render_results_block(query, version, results=None, message=None):
+    """
+    The part of a trend email that is the same for every recipient of a
+    query version (results list, or `message` when there are none), as
+    {"html": ..., "txt": ...} safe strings for trend_notification.*.
+    """
+    context = {
+        "query": query,
+        "version": version,
+        "results": list(results) if results is not None else [],
+        "message": message or "",
+        "detail_url": build_detail_url(query.id, version),
+    }
+    return {ext: mark_safe(render_to_string(f"emails/trend_results.{ext}", context)) for ext in ("html", "txt")}
+
+
+def cached_results_block(query, version, results=None, message=None):
+    """
+    render_results_block, kept in the shared cache per (query, version) for
+    TREND_EMAIL_RENDER_CACHE_TTL seconds so every batch and worker sending
+    that version renders it once. Only result lists are cached; a version's
+    results do not change once stored. A cache outage only costs the
+    rendering it would have saved.
+    """
+    key = f"trends:email-results:{query.id}:{version}"
+    try:
+        blocks = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Email render cache unavailable: {e}")
+        blocks = None
+    if blocks is None:
+        # Evaluated only on a miss, so a lazy queryset costs nothing on a hit.
+        results = list(results) if results is not None else []
+        blocks = render_results_block(query, version, results, message)
+        if results:
+            try:
+                cache.set(key, blocks, getattr(settings, "TREND_EMAIL_RENDER_CACHE_TTL", 60 * 60))
+            except Exception as e:
+                logger.warning(f"Could not cache rendered results for query {query.id} v{version}: {e}")
+    return blocks
+
+
+def build_trend_email(user, query, version, results=None, subject=None, message=None, blocks=None):
+    """
+    One subscriber's trend email. Only the greeting, subject and links are
+    rendered here; pass `blocks` from cached_results_block() to reuse the
+    results part across recipients (otherwise it is rendered for this one).
+    """
     subject = subject or f"Trends Update for {query.industry} -- vesrion {version}"
     detail_url = build_detail_url(query.id, version)
     unsubscribe_url = build_unsubscribe_url(user, query)
     updated_at = timezone.localtime(query.updated_at)
-
-    results_list = list(results) if results is not None else []
+    blocks = blocks or render_results_block(query, version, results, message)
 
     context = {
         "user": user,
         "subject": subject,
         "query": query,
         "version": version,
-        "results": results_list,
-        "message": message or "",
         "detail_url": detail_url,
         "updated_at": updated_at,
         "unsubscribe_url": unsubscribe_url,
     }
 
-    text_body = render_to_string("emails/trend_notification.txt", context)
-    html_body = render_to_string("emails/trend_notification.html", context)
+    text_body = render_to_string("emails/trend_notification.txt", {**context, "results_block": blocks["txt"]})
+    html_body = render_to_string("emails/trend_notification.html", {**context, "results_block": blocks["html"]})
 
     email = EmailMultiAlternatives(
         subject=subject,
@@ -49,10 +99,104 @@ def send_trend_email(user, query, version, results=None, subject=None, message=N
     )
 
     email.attach_alternative(html_body, "text/html")
-    email.send(fail_silently=False)
+    return email
+
+
+def build_digest_email(user, sections, subject=None):
+    """
+    One email covering several refreshed queries. `sections` are
+    {"query", "version", "blocks"} dicts, blocks from cached_results_block().
+    """
+    subject = subject or f"Your TrendSage digest: {len(sections)} queries refreshed"
+    context = {"user": user, "subject": subject}
+    bodies = {}
+    for ext in ("txt", "html"):
+        bodies[ext] = render_to_string(f"emails/trend_digest.{ext}", {**context, "sections": [
+            {"query": section["query"], "version": section["version"], "block": section["blocks"][ext],
+             "unsubscribe_url": build_unsubscribe_url(user, section["query"])}
+            for section in sections
+        ]})
+
+    email = EmailMultiAlternatives(
+        subject=subject,
+        body=bodies["txt"],
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email],
+    )
+
+    email.attach_alternative(bodies["html"], "text/html")
+    return email
+
+
+def send_trend_email(user, query, version, results=None, subject=None, message=None, include_results=True):
+    build_trend_email(user, query, version, results, subject, message).send(fail_silently=False)
+
+
+def send_email_batch(messages, connection=None):
+    """
+    Send `messages` over one mail connection (one SMTP+TLS session) instead
+    of one per message. Each message is sent on its own so a rejected
+    recipient does not sink the rest, and an unreachable server fails them
+    all; returns [(index, error)] of the messages that failed. Never raises.
+    """
+    connection = connection or get_connection(fail_silently=False)
+    failures = []
+    try:
+        connection.open()
+    except Exception as e:
+        # Server unreachable: every message failed this attempt.
+        return [(i, e) for i in range(len(messages))]
+    try:
+        for i, email in enumerate(messages):
+            try:
+                connection.send_messages([email])
+            except Exception as e:
+                failures.append((i, e))
+                # The session may be dead (e.g. SMTPServerDisconnected); start a new one.
+                connection.close()
+                try:
+                    connection.open()
+                except Exception as e:
+                    failures.extend((j, e) for j in range(i + 1, len(messages)))
+                    break
+    finally:
+        connection.close()
+    return failures
+
+
+def outbox_row(email, kind):
+    """An unsaved EmailOutbox row holding `email` (an EmailMultiAlternatives) as rendered."""
+    from .models import EmailOutbox
+
+    html = next((content for content, mimetype in email.alternatives if mimetype == "text/html"), "")
+    return EmailOutbox(kind=kind, to_email=email.to[0], subject=email.subject, body_text=email.body, body_html=html)
+
+
+def enqueue_emails(messages, kind):
+    """
+    Store `messages` in the outbox in one insert. Call it inside the
+    transaction of the write that triggered them, if there is one, so the
+    emails exist exactly when that write commits; tasks.dispatch_email_outbox
+    sends them.
+    """
+    from .models import EmailOutbox
+
+    return EmailOutbox.objects.bulk_create([outbox_row(email, kind) for email in messages])
+
+
+def outbox_message(row):
+    email = EmailMultiAlternatives(
+        subject=row.subject,
+        body=row.body_text,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[row.to_email],
+    )
+    if row.body_html:
+        email.attach_alternative(row.body_html, "text/html")
+    return email
 
 
-def send_signup_otp_email(email: str, otp: str, name: str = "", expiry_minutes: int = 10):
+def build_signup_otp_email(email: str, otp: str, name: str = "", expiry_minutes: int = 10):
     subject = "Your TrendSage verification code"
     context = {
         "subject": subject,
@@ -70,5 +214,5 @@ def send_signup_otp_email(email: str, otp: str, name: str = "", expiry_minutes:
         from_email=settings.DEFAULT_FROM_EMAIL, 
         to=[email]
     )
-    msg .attach_alternative(html_body, "text/html")
-    msg.send(fail_silently=False)
+    msg.attach_alternative(html_body, "text/html")
+    return msg
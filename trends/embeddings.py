@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from .query_builder import query_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# One SentenceTransformer per model name, per process. Loaded on first use so
+# web workers, manage.py commands and celery beat never pay for it.
+_models = {}
+_lock = threading.Lock()
+
+
+def get_model_name():
+    return getattr(settings, "EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+
+
+def get_model(name=None):
+    name = name or get_model_name()
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _lock:
+        model = _models.get(name)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            started = time.perf_counter()
+            model = SentenceTransformer(name)
+            _models[name] = model
+            logger.info(
+                f"Loaded embedding model {name} in {time.perf_counter() - started:.2f}s")
+    return model
+
+
+def is_loaded(name=None):
+    return (name or get_model_name()) in _models
+
+
+def warm_up(name=None):
+    """Load the model ahead of the first request (used by celery workers)."""
+    return get_model(name)
+
+
+def cosine_similarities(vector, matrix):
+    vector = np.asarray(vector, dtype=np.float32)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    return (matrix @ vector) / np.maximum(norms, 1e-12)
+
+
+class QueryEmbeddingCache:
+    """
+    Embeddings of the relevance query text, keyed by the normalized query
+    parameters and the model name.
+
+    Lookups go to an in-process LRU first, then to the shared Django cache,
+    and only then to the encoder.
+    """
+
+    def __init__(self, max_entries=None, timeout=None, cache_alias=None):
+        self.max_entries = max_entries or getattr(
+            settings, "QUERY_EMBEDDING_CACHE_SIZE", 1024)
+        self.timeout = timeout or getattr(
+            settings, "QUERY_EMBEDDING_CACHE_TIMEOUT", 60 * 60 * 24 * 30)
+        self.cache_alias = cache_alias or getattr(
+            settings, "QUERY_EMBEDDING_CACHE_ALIAS", "default")
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def make_key(self, query_obj, model_name=None):
+        fingerprint = query_fingerprint(
+            query_obj.industry, query_obj.region, query_obj.persona, query_obj.date_range)
+        return f"trends:query-embedding:{model_name or get_model_name()}:{fingerprint}"
+
+    def get(self, query_obj, text, model_name=None):
+        key = self.make_key(query_obj, model_name)
+
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+        store = caches[self.cache_alias]
+        try:
+            raw = store.get(key)
+        except Exception as e:
+            logger.warning(f"Query embedding store unavailable: {e}")
+            raw = None
+
+        if raw is not None:
+            vector = np.frombuffer(raw, dtype=np.float32)
+            with self._lock:
+                self.store_hits += 1
+        else:
+            model = get_model(model_name)
+            vector = np.asarray(model.encode(text), dtype=np.float32)
+            try:
+                store.set(key, vector.tobytes(), self.timeout)
+            except Exception as e:
+                logger.warning(f"Could not persist query embedding: {e}")
+            with self._lock:
+                self.misses += 1
+
+        self._remember(key, vector)
+        return vector
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory_hits = self.store_hits = self.misses = 0
+
+
+query_embedding_cache = QueryEmbeddingCache()
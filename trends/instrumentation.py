@@ -0,0 +1,95 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.db import transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("fetch", "parse", "embed", "score", "persist")
+
+
+class StageTimer:
+    """
+    Wall-clock time spent in each stage of one ingestion run.
+
+    fetch covers building the prompt and getting the completion (the whole
+    stream when streaming), parse the JSON extraction/repair, embed the
+    encoder call, score relevance plus the other scores, and persist the
+    database writes. Time a stage by wrapping it in `with timer.stage(name)`;
+    re-entering a stage adds to it.
+    """
+
+    def __init__(self, streamed=False):
+        self.started = time.perf_counter()
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self.streamed = streamed
+        self.from_cache = False
+        self.upstream = None  # accounting.upstream_call_fields() of the Perplexity call, if one was made
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += (time.perf_counter() - started) * 1000
+
+    @property
+    def total_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+
+def record_ingestion_run(query_obj, timer, status, version=None, result_count=0, error=""):
+    """
+    Log the run's stage timings as one structured record and store them as
+    an IngestionRun, plus the UpstreamCall behind it when there was one.
+    """
+    from .accounting import record_upstream_call
+    from .models import IngestionRun
+
+    total_ms = timer.total_ms
+    fields = {
+        "query_id": str(query_obj.id),
+        "version": version,
+        "status": status,
+        "result_count": result_count,
+        "streamed": timer.streamed,
+        "from_cache": timer.from_cache,
+        **{f"{name}_ms": round(ms, 2) for name, ms in timer.timings.items()},
+        "total_ms": round(total_ms, 2),
+    }
+    metrics.observe_ingestion_run(status, timer.timings)
+    stages = " ".join(f"{name}={ms:.0f}ms" for name, ms in timer.timings.items())
+    logger.info(
+        f"Ingestion run for query {query_obj.id} v{version}: {status}, {result_count} results "
+        f"in {total_ms:.0f}ms ({stages})",
+        extra={"ingestion_run": fields},
+    )
+
+    try:
+        with transaction.atomic():
+            run = IngestionRun.objects.create(
+                query=query_obj,
+                version=version,
+                status=status,
+                result_count=result_count,
+                streamed=timer.streamed,
+                from_cache=timer.from_cache,
+                fetch_ms=fields["fetch_ms"],
+                parse_ms=fields["parse_ms"],
+                embed_ms=fields["embed_ms"],
+                score_ms=fields["score_ms"],
+                persist_ms=fields["persist_ms"],
+                total_ms=fields["total_ms"],
+                error=error[:2000],
+            )
+            if timer.upstream:
+                record_upstream_call(query_obj, timer.upstream, version=version)
+        return run
+    except Exception as e:
+        # Stats must never fail the ingestion they describe.
+        logger.warning(f"Could not store ingestion run for query {query_obj.id}: {e}")
+        return None
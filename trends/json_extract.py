@@ -0,0 +1,155 @@
+"""
+Single-pass repair and extraction of JSON embedded in LLM completions.
+
+The scanner walks the text once, left to right, never backtracking. While
+it copies characters it also fixes what the model typically gets wrong:
+
+- smart quotes used as string delimiters (“ ” → ")
+- trailing commas before } or ]
+- digit separators in numbers (1_000 → 1000)
+- a doubled closing quote before , ] or } ("text"" → "text")
+
+and it records the span of every balanced top-level object and array, so
+the caller can pick the outermost object containing "results" without any
+regex search over the whole completion.
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+OPEN_SMART_QUOTES = "“„"
+CLOSE_SMART_QUOTES = "”"
+WHITESPACE = " \t\r\n"
+CLOSERS = {"{": "}", "[": "]"}
+
+
+def scan_json(text):
+    """
+    Return (repaired_text, spans) where spans is a list of
+    (start, end, opener, has_results_key) for every balanced top-level
+    object or array, as offsets into repaired_text.
+    """
+    out = []
+    spans = []
+    stack = []
+    in_string = False
+    string_closers = '"'
+    escape = False
+    pending_comma = None
+    top_start = None
+    has_results = False
+    string_start = 0
+    n = len(text)
+    i = 0
+
+    while i < n:
+        ch = text[i]
+
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch in string_closers:
+                # "text"" followed by , ] or } -> drop the stray quote.
+                if ch == '"' and i + 1 < n and text[i + 1] == '"':
+                    j = i + 2
+                    while j < n and text[j] in WHITESPACE:
+                        j += 1
+                    if j < n and text[j] in ",]}":
+                        i += 1
+                in_string = False
+                out.append('"')
+                if (len(stack) == 1 and stack[0] == "{" and len(out) - string_start == 8
+                        and "".join(out[string_start:-1]) == "results"):
+                    has_results = True
+            elif ch in "\n\r\t":
+                # Raw control characters are invalid inside JSON strings.
+                out.extend({"\n": "\\n", "\r": "\\r", "\t": "\\t"}[ch])
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in WHITESPACE:
+            out.append(ch)
+            i += 1
+            continue
+
+        if stack and (ch == '"' or ch in OPEN_SMART_QUOTES or ch in CLOSE_SMART_QUOTES):
+            # Quotes in the prose around the JSON are copied as they are.
+            pending_comma = None
+            in_string = True
+            string_closers = '"' if ch == '"' else CLOSE_SMART_QUOTES + '"'
+            out.append('"')
+            string_start = len(out)
+        elif ch in "{[":
+            pending_comma = None
+            if not stack:
+                top_start = len(out)
+                has_results = False
+            stack.append(ch)
+            out.append(ch)
+        elif ch in "}]":
+            if pending_comma is not None:
+                # Only whitespace follows the comma, so this is a short delete.
+                del out[pending_comma]
+                pending_comma = None
+            if stack and CLOSERS[stack[-1]] == ch:
+                opener = stack.pop()
+                out.append(ch)
+                if not stack:
+                    spans.append((top_start, len(out), opener, has_results))
+            else:
+                # Stray closer: not part of any value we can use.
+                out.append(ch)
+                stack = []
+        elif ch == ",":
+            pending_comma = len(out) if stack else None
+            out.append(ch)
+        elif ch == "_" and out and out[-1].isdigit() and i + 1 < n and text[i + 1].isdigit():
+            pass
+        else:
+            pending_comma = None
+            out.append(ch)
+        i += 1
+
+    # `out` holds exactly one character per entry, so span offsets index
+    # straight into the joined text.
+    return "".join(out), spans
+
+
+def repair_json(text):
+    return scan_json(text)[0]
+
+
+def extract_json(text):
+    """
+    Parse the outermost object holding "results" out of `text`; failing
+    that, wrap the first top-level array as {"results": [...]}.
+    """
+    repaired, spans = scan_json(text)
+
+    for start, end, opener, has_results in spans:
+        if opener == "{" and has_results:
+            try:
+                return json.loads(repaired[start:end])
+            except ValueError as e:
+                logger.warning(f"JSON parse error in results object: {e}")
+
+    for start, end, opener, _ in spans:
+        if opener == "[":
+            try:
+                value = json.loads(repaired[start:end])
+            except ValueError as e:
+                logger.warning(f"JSON parse error in array: {e}")
+                continue
+            if isinstance(value, list):
+                return {"results": value}
+
+    logger.error(
+        f"❌ Could not parse content into JSON. First 500 chars: {text[:500]}")
+    return None
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from trends import embeddings
+from trends.models import TrendResult
+from trends.services import embed_trends
+
+
+class Command(BaseCommand):
+    help = "Embed TrendResult rows that have no stored embedding (or one from another model)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="Rows loaded and written per round trip.")
+        parser.add_argument("--batch-size", type=int, default=64,
+                            help="Texts per forward pass of the encoder.")
+        parser.add_argument("--model", default=None,
+                            help="Embedding model name (defaults to EMBEDDING_MODEL_NAME).")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        batch_size = options["batch_size"]
+        model_name = options["model"] or embeddings.get_model_name()
+
+        pending = (
+            TrendResult.objects
+            .filter(Q(embedding__isnull=True) | ~Q(embedding_model=model_name))
+            .order_by("pk")
+            .only("id", "topic", "summary")
+        )
+
+        total = 0
+        last_pk = None
+        while True:
+            chunk_qs = pending if last_pk is None else pending.filter(pk__gt=last_pk)
+            chunk = list(chunk_qs[:chunk_size])
+            if not chunk:
+                break
+
+            vectors = embed_trends(
+                [(r.topic, r.summary) for r in chunk],
+                model_name=model_name, batch_size=batch_size)
+
+            for row, vector in zip(chunk, vectors):
+                row.set_embedding(vector, model_name)
+            TrendResult.objects.bulk_update(chunk, ["embedding", "embedding_model"])
+
+            total += len(chunk)
+            last_pk = chunk[-1].pk
+            self.stdout.write(f"Embedded {total} results...")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled embeddings for {total} results with {model_name}."))
@@ -0,0 +1,250 @@
+import json
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import Manager
+from queue import Empty
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from trends import scoring
+from trends.models import TrendResult
+
+UUID_SPACE = 1 << 128
+BINS = 101  # final_score histogram, one bin per point, 100+ in the last
+
+
+def split_uuid_space(parts):
+    """[lower, upper) UUID ranges covering the whole key space; upper None = open."""
+    bounds = [uuid.UUID(int=UUID_SPACE * i // parts) for i in range(parts)]
+    return [
+        {"lower": str(lower), "upper": str(bounds[i + 1]) if i + 1 < parts else None,
+         "after": None, "done": False}
+        for i, lower in enumerate(bounds)
+    ]
+
+
+def empty_stats():
+    return {"rows": 0, "changed": 0, "max_delta": 0.0, "sum_old": 0.0, "sum_new": 0.0,
+            "hist_old": [0] * BINS, "hist_new": [0] * BINS}
+
+
+def merge_stats(total, part):
+    total["rows"] += part["rows"]
+    total["changed"] += part["changed"]
+    total["max_delta"] = max(total["max_delta"], part["max_delta"])
+    total["sum_old"] += part["sum_old"]
+    total["sum_new"] += part["sum_new"]
+    total["hist_old"] = [a + b for a, b in zip(total["hist_old"], part["hist_old"])]
+    total["hist_new"] = [a + b for a, b in zip(total["hist_new"], part["hist_new"])]
+    return total
+
+
+def chunk_stats(old, new):
+    def hist(values):
+        return np.bincount(np.clip(values, 0, BINS - 1).astype(np.int64), minlength=BINS).tolist()
+
+    delta = np.abs(new - old)
+    return {
+        "rows": len(old),
+        "changed": int(np.count_nonzero(delta)),
+        "max_delta": float(delta.max()) if len(delta) else 0.0,
+        "sum_old": float(old.sum()),
+        "sum_new": float(new.sum()),
+        "hist_old": hist(old),
+        "hist_new": hist(new),
+    }
+
+
+def percentile(hist, q):
+    counts = np.cumsum(hist)
+    if not counts[-1]:
+        return 0
+    return int(np.searchsorted(counts, q * counts[-1]))
+
+
+def rescore_chunk(rows, opts, now):
+    old = np.array([row.final_score for row in rows], dtype=np.float64)
+    relevance = np.array([row.relevance_score for row in rows], dtype=np.float64)
+
+    if opts["components"]:
+        columns = scoring.build_columns(
+            [{"sources": row.sources} for row in rows],
+            [row.query.created_at for row in rows])
+        engagement, freshness, relevance, new = scoring.score_columns(
+            columns, relevance, now=now, weights=opts["weights"], decay_days=opts["decay_days"])
+        for row, e, f, final, newest in zip(
+                rows, engagement.tolist(), freshness.tolist(), new.tolist(),
+                scoring.newest_source_dates(columns)):
+            row.engagement_score, row.freshness_score, row.final_score = e, f, final
+            row.newest_source_at = newest
+    else:
+        engagement = np.array([row.engagement_score for row in rows], dtype=np.float64)
+        freshness = np.array([row.freshness_score for row in rows], dtype=np.float64)
+        new = scoring.final_scores(engagement, freshness, relevance, weights=opts["weights"])
+        for row, final in zip(rows, new.tolist()):
+            row.final_score = final
+
+    if not opts["dry_run"]:
+        fields = ["final_score"]
+        if opts["components"]:
+            fields += ["engagement_score", "freshness_score", "newest_source_at"]
+        TrendResult.objects.bulk_update(rows, fields)
+    return chunk_stats(old, new)
+
+
+def rescore_range(index, key_range, opts, progress):
+    """
+    Rescore every committed row with lower <= pk < upper (after the
+    checkpointed pk, if any). Calls progress(index, last_pk, stats) after
+    each chunk.
+    """
+    now = datetime.fromisoformat(opts["now"])
+    fields = ["id", "engagement_score", "freshness_score", "relevance_score", "final_score"]
+    qs = TrendResult.objects.filter(is_provisional=False, pk__gte=uuid.UUID(key_range["lower"]))
+    if key_range["upper"]:
+        qs = qs.filter(pk__lt=uuid.UUID(key_range["upper"]))
+    if key_range["after"]:
+        qs = qs.filter(pk__gt=uuid.UUID(key_range["after"]))
+    if opts["components"]:
+        qs = qs.select_related("query")
+        fields += ["sources", "query__created_at"]
+    qs = qs.order_by("pk").only(*fields)
+
+    chunk_size = opts["chunk_size"]
+    chunk = []
+    for row in qs.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            progress(index, str(chunk[-1].pk), rescore_chunk(chunk, opts, now))
+            chunk = []
+    if chunk:
+        progress(index, str(chunk[-1].pk), rescore_chunk(chunk, opts, now))
+
+
+def _worker_init():
+    import django
+    django.setup()
+    # Never share the parent's database connections across a fork.
+    connections.close_all()
+
+
+def _worker_run(index, key_range, opts, queue):
+    rescore_range(index, key_range, opts, lambda *update: queue.put(update))
+    return index
+
+
+class Command(BaseCommand):
+    help = "Recompute scores of stored TrendResult rows in bulk (e.g. after changing TREND_SCORE_WEIGHTS)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="Rows streamed, rescored and written per bulk_update.")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Processes; the UUID key space is split into this many ranges.")
+        parser.add_argument("--weights", default=None,
+                            help="engagement,freshness,relevance (defaults to TREND_SCORE_WEIGHTS).")
+        parser.add_argument("--components", action="store_true",
+                            help="Also recompute engagement, freshness and newest_source_at from sources "
+                                 "(freshness as of now).")
+        parser.add_argument("--decay-days", type=float, default=None,
+                            help="Freshness decay with --components (defaults to TREND_FRESHNESS_DECAY_DAYS).")
+        parser.add_argument("--checkpoint", default=None,
+                            help="JSON file recording progress per key range; an existing one is resumed.")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Compute new scores and report the change in distribution without writing.")
+
+    def handle(self, *args, **options):
+        weights = options["weights"]
+        opts = {
+            "chunk_size": options["chunk_size"],
+            "weights": tuple(float(w) for w in weights.split(",")) if weights else scoring.get_weights(),
+            "decay_days": options["decay_days"] or scoring.get_decay_days(),
+            "components": options["components"],
+            "dry_run": options["dry_run"],
+            "now": timezone.now().isoformat(),
+        }
+        if len(opts["weights"]) != 3:
+            raise CommandError("--weights takes three comma-separated numbers.")
+
+        self.checkpoint_path = None if opts["dry_run"] else options["checkpoint"]
+        state = self.load_checkpoint(opts, options["workers"])
+        self.state = state
+        # Kept in the checkpoint, so a resumed run reports on every row, not just its own.
+        self.stats = state.setdefault("stats", empty_stats())
+
+        pending = [(i, r) for i, r in enumerate(state["ranges"]) if not r["done"]]
+        if len(state["ranges"]) == 1 or len(pending) <= 1:
+            for index, key_range in pending:
+                rescore_range(index, key_range, state["opts"], self.progress)
+                self.finish_range(index)
+        else:
+            self.run_pool(pending, state["opts"])
+
+        self.report(state["opts"])
+
+    def load_checkpoint(self, opts, workers):
+        path = self.checkpoint_path
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            saved = state["opts"]
+            if tuple(saved["weights"]) != opts["weights"] or saved["components"] != opts["components"]:
+                raise CommandError(
+                    f"{path} was written with weights={saved['weights']} components={saved['components']}; "
+                    "finish that run or delete the checkpoint.")
+            done = sum(r["done"] for r in state["ranges"])
+            self.stdout.write(f"Resuming from {path}: {done}/{len(state['ranges'])} ranges done.")
+            return state
+        return {"opts": opts, "ranges": split_uuid_space(max(1, workers)), "stats": empty_stats()}
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp = f"{self.checkpoint_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def progress(self, index, last_pk, stats):
+        # A chunk's rows and its stats are checkpointed together.
+        self.state["ranges"][index]["after"] = last_pk
+        merge_stats(self.stats, stats)
+        self.save_checkpoint()
+        self.stdout.write(f"Rescored {self.stats['rows']} results...")
+
+    def finish_range(self, index):
+        self.state["ranges"][index]["done"] = True
+        self.save_checkpoint()
+
+    def run_pool(self, pending, opts):
+        connections.close_all()
+        with Manager() as manager:
+            queue = manager.Queue()
+            with ProcessPoolExecutor(len(pending), initializer=_worker_init) as pool:
+                futures = [pool.submit(_worker_run, i, r, opts, queue) for i, r in pending]
+                while not all(f.done() for f in futures) or not queue.empty():
+                    try:
+                        self.progress(*queue.get(timeout=0.5))
+                    except Empty:
+                        pass
+                for future in futures:
+                    # Re-raises a worker's exception; the checkpoint keeps its progress.
+                    self.finish_range(future.result())
+
+    def report(self, opts):
+        s = self.stats
+        rows = s["rows"] or 1
+        self.stdout.write(
+            f"final_score over {s['rows']} results (weights={tuple(opts['weights'])}):\n"
+            f"  mean {s['sum_old'] / rows:.2f} -> {s['sum_new'] / rows:.2f}\n"
+            + "".join(
+                f"  p{int(q * 100)}  {percentile(s['hist_old'], q)} -> {percentile(s['hist_new'], q)}\n"
+                for q in (0.1, 0.5, 0.9))
+            + f"  changed {s['changed']} rows, max |delta| {s['max_delta']:.2f}")
+        verb = "Would rescore" if opts["dry_run"] else "Rescored"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {s['rows']} results."))
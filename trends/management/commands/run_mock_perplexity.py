@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from trends.mock_perplexity import RESPONSE_SHAPES, MockPerplexityServer
+
+
+class Command(BaseCommand):
+    help = ("Serve a local stand-in for the Perplexity /chat/completions endpoint "
+            "(set PERPLEXITY_API_URL to the printed URL to use it).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency", type=float, default=2.0,
+                            help="Median seconds before each reply.")
+        parser.add_argument("--latency-sigma", type=float, default=0.5,
+                            help="Lognormal shape of the latency; 0 for a fixed delay.")
+        parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="Share of requests answered with 429/500/502/503.")
+        parser.add_argument("--malformed-rate", type=float, default=0.0,
+                            help="Share of requests answered with truncated, unparseable JSON.")
+        parser.add_argument("--shapes", nargs="+", default=None, choices=sorted(RESPONSE_SHAPES),
+                            help="Content shapes for normal replies (default: json fenced sloppy).")
+        parser.add_argument("--results", type=int, default=5, help="Trends per reply.")
+        parser.add_argument("--summary-chars", type=int, default=None,
+                            help="Pad summaries to this length to grow the payload.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        for name in ("error_rate", "malformed_rate"):
+            if not 0 <= options[name] <= 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be between 0 and 1.")
+
+        server = MockPerplexityServer(
+            host=options["host"],
+            port=options["port"],
+            latency=options["latency"],
+            latency_sigma=options["latency_sigma"],
+            error_rate=options["error_rate"],
+            malformed_rate=options["malformed_rate"],
+            shapes=options["shapes"],
+            result_count=options["results"],
+            summary_chars=options["summary_chars"],
+            seed=options["seed"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Mock Perplexity listening on {server.url} (Ctrl-C to stop)"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(
+                f"{len(server.requests)} requests over {server.connections} connections: "
+                + ", ".join(f"{count} {kind}" for kind, count in server.replies.items()))
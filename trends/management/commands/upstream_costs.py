@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from trends import accounting
+
+
+class Command(BaseCommand):
+    help = "Roll up Perplexity token usage and cost per day, user or query fingerprint."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--by", choices=["day", "user", "fingerprint"], default="day")
+        parser.add_argument("--days", type=int, default=30, help="Look back this many days.")
+        parser.add_argument("--limit", type=int, default=50, help="Rows to print.")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options["days"])
+        rollup, label = {
+            "day": (accounting.cost_by_day, "day"),
+            "user": (accounting.cost_by_user, "query__user__email"),
+            "fingerprint": (accounting.cost_by_fingerprint, "fingerprint"),
+        }[options["by"]]
+
+        self.stdout.write(
+            f"{options['by']:<66}{'calls':>8}{'prompt tok':>12}{'compl. tok':>12}{'cost $':>12}{'avg ms':>10}")
+        for row in rollup(since)[:options["limit"]]:
+            self.stdout.write(
+                f"{str(row[label]):<66}{row['calls']:>8}{row['prompt_tokens'] or 0:>12}"
+                f"{row['completion_tokens'] or 0:>12}{row['cost'] or 0:>12.4f}{row['avg_latency_ms'] or 0:>10.0f}")
+
+        total = accounting.total_cost(since)
+        self.stdout.write(self.style.SUCCESS(
+            f"{total['calls']} calls, {total['tokens'] or 0} tokens, ${total['cost'] or 0:.4f} "
+            f"in the last {options['days']} days."))
@@ -0,0 +1,155 @@
+"""
+Prometheus metrics for the web and worker processes.
+
+Everything is registered on the default registry of the process that
+records it. When PROMETHEUS_MULTIPROC_DIR is set (gunicorn with several
+workers, celery prefork), prometheus_client writes the samples to files in
+that directory and metrics_view() aggregates every process on scrape.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+# Request handling is tens of ms; upstream calls and tasks run up to minutes.
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+PERPLEXITY_RETRIES = Counter(
+    "trendsage_perplexity_retries_total",
+    "Perplexity calls retried, by reason (HTTP status or error class).",
+    ["reason"],
+)
+PERPLEXITY_BREAKER_REJECTIONS = Counter(
+    "trendsage_perplexity_breaker_rejections_total",
+    "Perplexity calls rejected because the circuit breaker was open.",
+    ["breaker"],
+)
+PERPLEXITY_BREAKER_STATE = Gauge(
+    "trendsage_perplexity_breaker_state",
+    "Circuit breaker state as last seen by this process (0 closed, 1 half-open, 2 open).",
+    ["breaker"],
+    multiprocess_mode="mostrecent",
+)
+PERPLEXITY_REQUEST_DURATION = Histogram(
+    "trendsage_perplexity_request_duration_seconds",
+    "Duration of single Perplexity HTTP attempts, by outcome (ok, HTTP status or error class).",
+    ["outcome"],
+    buckets=SLOW_BUCKETS,
+)
+PERPLEXITY_RATE_LIMIT_WAIT = Histogram(
+    "trendsage_perplexity_rate_limit_wait_seconds",
+    "Time Perplexity attempts waited for a rate-limit token, by traffic class.",
+    ["traffic"],
+    buckets=SLOW_BUCKETS,
+)
+PERPLEXITY_RATE_LIMITED = Counter(
+    "trendsage_perplexity_rate_limited_total",
+    "Perplexity calls given up because no rate-limit token freed up in time, by traffic class.",
+    ["traffic"],
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "trendsage_http_request_duration_seconds",
+    "Django request latency by method, URL route and status code.",
+    ["method", "route", "status"],
+    buckets=FAST_BUCKETS,
+)
+CELERY_TASK_DURATION = Histogram(
+    "trendsage_celery_task_duration_seconds",
+    "Celery task run time by task name and final state.",
+    ["task", "state"],
+    buckets=SLOW_BUCKETS,
+)
+INGESTION_STAGE_DURATION = Histogram(
+    "trendsage_ingestion_stage_duration_seconds",
+    "Time per ingestion stage (fetch, parse, embed, score, persist).",
+    ["stage"],
+    buckets=SLOW_BUCKETS,
+)
+INGESTION_RUNS = Counter(
+    "trendsage_ingestion_runs_total",
+    "Ingestion runs by outcome (completed, empty, failed).",
+    ["status"],
+)
+
+
+def set_breaker_state(name, state):
+    PERPLEXITY_BREAKER_STATE.labels(name).set(BREAKER_STATES[state])
+
+
+@contextmanager
+def time_perplexity_call():
+    """Observe one upstream HTTP attempt; usable around sync and awaited calls."""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception as exc:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+        outcome = str(status) if status is not None else type(exc).__name__
+        raise
+    finally:
+        PERPLEXITY_REQUEST_DURATION.labels(outcome).observe(time.perf_counter() - started)
+
+
+def observe_ingestion_run(status, timings_ms):
+    INGESTION_RUNS.labels(status).inc()
+    for stage, ms in timings_ms.items():
+        if ms:
+            INGESTION_STAGE_DURATION.labels(stage).observe(ms / 1000)
+
+
+class MetricsMiddleware:
+    """Record the latency of every request, labelled by its URL route pattern."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            match = getattr(request, "resolver_match", None)
+            # The pattern, not the path, keeps the label set bounded.
+            route = match.route if match is not None else "unmatched"
+            HTTP_REQUEST_DURATION.labels(request.method, route, str(status)).observe(
+                time.perf_counter() - started)
+
+
+def collect():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def _has_scrape_token(request):
+    token = getattr(settings, "METRICS_TOKEN", "")
+    header = request.headers.get("Authorization", "")
+    return bool(token) and constant_time_compare(header, f"Bearer {token}")
+
+
+def metrics_view(request):
+    """Prometheus text exposition; staff session or `Authorization: Bearer <METRICS_TOKEN>`."""
+    if not _has_scrape_token(request):
+        from django.contrib.admin.views.decorators import staff_member_required
+        return staff_member_required(_metrics_response)(request)
+    return _metrics_response(request)
+
+
+def _metrics_response(request):
+    return HttpResponse(collect(), content_type=CONTENT_TYPE_LATEST)
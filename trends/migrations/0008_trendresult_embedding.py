@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trends', '0007_signupotp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trendresult',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='trendresult',
+            name='embedding_model',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
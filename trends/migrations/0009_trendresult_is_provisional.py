@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trends', '0008_trendresult_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trendresult',
+            name='is_provisional',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trends', '0009_trendresult_is_provisional'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trendresult',
+            name='newest_source_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:40
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trends', '0010_trendresult_newest_source_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionRun',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('version', models.PositiveIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('completed', 'Completed'), ('empty', 'Empty'), ('failed', 'Failed')], max_length=10)),
+                ('result_count', models.PositiveIntegerField(default=0)),
+                ('streamed', models.BooleanField(default=False)),
+                ('from_cache', models.BooleanField(default=False)),
+                ('fetch_ms', models.FloatField(default=0.0)),
+                ('parse_ms', models.FloatField(default=0.0)),
+                ('embed_ms', models.FloatField(default=0.0)),
+                ('score_ms', models.FloatField(default=0.0)),
+                ('persist_ms', models.FloatField(default=0.0)),
+                ('total_ms', models.FloatField(default=0.0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_runs', to='trends.trendquery')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['query', 'created_at'], name='trends_inge_query_i_1b4b80_idx')],
+            },
+        ),
+    ]
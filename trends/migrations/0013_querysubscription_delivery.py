@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trends', '0012_upstreamcall'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querysubscription',
+            name='delivery',
+            field=models.CharField(choices=[('immediate', 'Immediate'), ('digest', 'Daily digest')], default='immediate', max_length=10),
+        ),
+    ]
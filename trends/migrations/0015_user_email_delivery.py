@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trends', '0014_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_delivery',
+            field=models.CharField(choices=[('immediate', 'Immediate'), ('digest', 'Daily digest')], default='immediate', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='querysubscription',
+            name='delivery',
+            field=models.CharField(choices=[('immediate', 'Immediate'), ('digest', 'Daily digest')], default=None, max_length=10),
+        ),
+    ]
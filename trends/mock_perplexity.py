@@ -0,0 +1,302 @@
+"""
+Local stand-in for the Perplexity /chat/completions endpoint.
+
+Used by the tests and the benchmarks so neither needs an API key or spends
+money. Speaks HTTP/1.1 with keep-alive and counts the TCP connections it
+accepts, which is what the pooled client is supposed to save.
+
+For load tests it can also behave like the real API under traffic: a
+lognormal latency around a median, a share of 429/5xx errors, and replies
+in the shapes the model actually produces (plain JSON, JSON fenced in
+prose, JSON with smart quotes and trailing commas, a truncated answer).
+Everything random comes from one seeded generator.
+"""
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ERROR_STATUSES = (429, 500, 502, 503)
+TOPIC_WORDS = ("AI", "creator", "short-form", "B2B", "retail", "fintech", "climate", "wellness",
+               "gaming", "privacy", "automation", "community", "video", "newsletter", "pricing")
+
+
+def sample_results(count=5, rng=None, summary_chars=None):
+    """
+    `count` result dicts in the prompt's schema. Without `rng` they are
+    fixed (the tests rely on that); with one, topics, engagement and dates
+    vary. `summary_chars` pads each summary to set the payload size.
+    """
+    if rng is not None:
+        return [random_result(i, rng, summary_chars) for i in range(count)]
+    return [
+        {
+            "topic": f"Sample trend {i + 1}",
+            "summary": f"Synthetic summary for trend {i + 1} returned by the local mock server.",
+            "sources": {
+                "urls": [f"https://example.com/trend-{i + 1}", f"https://x.com/status/{1000 + i}"],
+                "snippets": ["Snippet one", "Snippet two"],
+                "dates": ["2025-09-01", "2025-09-10"],
+                "engagement": [
+                    {"likes": 0, "shares": 0, "comments": 0},
+                    {"likes": 120 + i, "shares": 30, "comments": 12},
+                ],
+            },
+            "suggested_angles": ["Angle A", "Angle B"],
+        }
+        for i in range(count)
+    ]
+
+
+def random_result(i, rng, summary_chars=None):
+    topic = " ".join(rng.sample(TOPIC_WORDS, 3)).capitalize()
+    summary = f"{topic} is picking up across social and news sources this week (trend {i + 1})."
+    if summary_chars and len(summary) < summary_chars:
+        summary += " " + " ".join(rng.choice(TOPIC_WORDS) for _ in range(summary_chars // 6))
+        summary = summary[:summary_chars]
+    today = date.today()
+    sources = rng.randint(1, 4)
+    return {
+        "topic": topic,
+        "summary": summary,
+        "sources": {
+            "urls": [f"https://example.com/{uuid.UUID(int=rng.getrandbits(128))}" for _ in range(sources)],
+            "snippets": [f"Snippet {n + 1}" for n in range(sources)],
+            "dates": [(today - timedelta(days=rng.randint(0, 30))).isoformat() for _ in range(sources)],
+            "engagement": [
+                {"likes": rng.randint(0, 5000), "shares": rng.randint(0, 800), "comments": rng.randint(0, 400)}
+                for _ in range(sources)
+            ],
+        },
+        "suggested_angles": [f"Angle {n + 1} on {topic.lower()}" for n in range(rng.randint(1, 3))],
+    }
+
+
+def sloppy_json(text):
+    """Mistakes models make in JSON: smart-quoted values, 1_000 numbers, trailing commas."""
+    text = re.sub(r'("topic": )"([^"\\]*)"', "\\1\u201c\\2\u201d", text)
+    text = re.sub(r'(": )(\d)(\d{3})\b', r"\1\2_\3", text)
+    return re.sub(r'([}\]"\d])(\n\s*[}\]])', r"\1,\2", text)
+
+
+RESPONSE_SHAPES = {
+    # Shapes of content seen from the real API, built from the same results.
+    "json": lambda results: json.dumps({"results": results}),
+    "fenced": lambda results: (
+        "Here are the most relevant trends for your audience right now.\n\n```json\n"
+        + json.dumps({"results": results}, indent=2)
+        + "\n```\n\nLet me know if you want more detail on any of them."),
+    "sloppy": lambda results: sloppy_json(json.dumps({"results": results}, indent=2)),
+    "truncated": lambda results: (lambda text: text[:len(text) * 2 // 3])(
+        json.dumps({"results": results})),
+}
+
+
+def completion_body(content, model="sonar-pro"):
+    return {
+        "id": str(uuid.uuid4()),
+        "model": model,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 600,
+            "completion_tokens": max(1, len(content) // 4),
+            "total_tokens": 600 + max(1, len(content) // 4),
+        },
+    }
+
+
+class MockPerplexityHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.record_connection()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            payload = json.loads(raw or b"{}")
+        except ValueError:
+            payload = {}
+        self.server.record_request(payload)
+        try:
+            self.reply(payload)
+        finally:
+            self.server.record_done()
+
+    def reply(self, payload):
+        fault = self.server.next_fault()
+        if fault == "reset":
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if fault is not None:
+            status, headers = fault if isinstance(fault, tuple) else (fault, {})
+            self.send_json(status, {"error": {"code": status, "message": "injected fault"}}, headers)
+            return
+
+        reply = self.server.draw_reply()
+        if reply["delay"]:
+            time.sleep(reply["delay"])
+        if reply["error"]:
+            status = reply["error"]
+            self.send_json(status, {"error": {"code": status, "message": "simulated upstream error"}})
+            return
+
+        content = reply["content"]
+        if payload.get("stream"):
+            self.send_stream(content, payload.get("model", "sonar-pro"))
+        else:
+            self.send_json(200, completion_body(content, payload.get("model", "sonar-pro")))
+
+    def send_stream(self, content, model):
+        """Server-sent events over chunked transfer encoding, like the real API."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        body = completion_body(content, model)
+        step = self.server.stream_chunk_size
+        for start in range(0, len(content), step):
+            event = {"id": body["id"], "model": model, "choices": [
+                {"index": 0, "delta": {"role": "assistant", "content": content[start:start + step]}}]}
+            self.write_chunk(f"data: {json.dumps(event)}\n\n")
+            if self.server.stream_delay:
+                time.sleep(self.server.stream_delay)
+
+        final = {"id": body["id"], "model": model, "usage": body["usage"], "choices": [
+            {"index": 0, "finish_reason": "stop", "delta": {}}]}
+        self.write_chunk(f"data: {json.dumps(final)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockPerplexityServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, result_count=5, faults=None,
+                 stream_chunk_size=64, stream_delay=0.0, latency_sigma=0.0, error_rate=0.0,
+                 malformed_rate=0.0, shapes=None, summary_chars=None, seed=None):
+        """
+        `faults` is consumed one entry per request before any normal reply:
+        an HTTP status (503), a (status, headers) tuple such as
+        (429, {"Retry-After": "1"}), or "reset" to drop the connection.
+
+        Without `seed` every reply is the same fixed sample_results() JSON
+        after `latency` seconds. With a seed, latency is lognormal with
+        median `latency` and shape `latency_sigma`, `error_rate` of the
+        requests get a 429/500/502/503, `malformed_rate` get a truncated
+        answer, and the rest are drawn from `shapes` (RESPONSE_SHAPES keys,
+        default all but "truncated") with randomised results.
+        """
+        super().__init__((host, port), MockPerplexityHandler)
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.shapes = list(shapes or [k for k in RESPONSE_SHAPES if k != "truncated"])
+        self.summary_chars = summary_chars
+        self.result_count = result_count
+        self.rng = random.Random(seed) if seed is not None else None
+        self.faults = list(faults or [])
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_delay = stream_delay
+        self.connections = 0
+        self.requests = []
+        self.in_flight = 0
+        self.peak_in_flight = 0  # most requests handled at once
+        self.replies = dict.fromkeys(("ok", "error", "malformed"), 0)
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/chat/completions"
+
+    def record_connection(self):
+        with self._stats_lock:
+            self.connections += 1
+
+    def record_request(self, payload):
+        with self._stats_lock:
+            self.requests.append(payload)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def record_done(self):
+        with self._stats_lock:
+            self.in_flight -= 1
+
+    def next_fault(self):
+        with self._stats_lock:
+            return self.faults.pop(0) if self.faults else None
+
+    def draw_reply(self):
+        """Latency, error status and content of the next normal reply."""
+        with self._stats_lock:
+            rng = self.rng
+            if rng is None:
+                self.replies["ok"] += 1
+                return {"delay": self.latency, "error": None,
+                        "content": json.dumps({"results": sample_results(self.result_count)})}
+
+            delay = self.latency * math.exp(rng.gauss(0, self.latency_sigma)) if self.latency else 0.0
+            roll = rng.random()
+            if roll < self.error_rate:
+                self.replies["error"] += 1
+                return {"delay": delay, "error": rng.choice(ERROR_STATUSES), "content": None}
+            shape = "truncated" if roll < self.error_rate + self.malformed_rate else rng.choice(self.shapes)
+            self.replies["malformed" if shape == "truncated" else "ok"] += 1
+            results = sample_results(self.result_count, rng, self.summary_chars)
+        return {"delay": delay, "error": None, "content": RESPONSE_SHAPES[shape](results)}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
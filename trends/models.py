@@ -5,6 +5,7 @@ import uuid
 import random
 from django.utils import timezone
 from django.contrib.auth.hashers import make_password, check_password
+import numpy as np
 
 
 class CustomUserManager(BaseUserManager):
@@ -23,6 +24,12 @@ class CustomUserManager(BaseUserManager):
         return self.create_user(email, password, **extra_fields)
 
 
+EMAIL_DELIVERY_CHOICES = [
+    ('immediate', 'Immediate'),
+    ('digest', 'Daily digest'),
+]
+
+
 class User(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     username = None
@@ -30,6 +37,8 @@ class User(AbstractUser):
 
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
+    # Delivery of subscriptions created from now on; see QuerySubscription.delivery
+    email_delivery = models.CharField(max_length=10, choices=EMAIL_DELIVERY_CHOICES, default='immediate')
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["first_name", "last_name"]
@@ -83,11 +92,26 @@ class TrendResult(models.Model):
     relevance_score = models.FloatField(default=0.0)
     final_score = models.FloatField(default=0.0)
     suggested_angles = models.JSONField(default=list, blank=True)
+    embedding = models.BinaryField(null=True, blank=True, editable=False)  # float16
+    embedding_model = models.CharField(max_length=100, blank=True, default="")
+    is_provisional = models.BooleanField(default=False)  # streamed, version not committed yet
+    newest_source_at = models.DateTimeField(null=True, blank=True)  # freshness anchor for live ranking
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def calculate_final_score(self, weights=(0.3, 0.4, 0.3)):
-        engagement, freshness, relevance = weights
+    def set_embedding(self, vector, model_name):
+        self.embedding = np.asarray(vector, dtype=np.float16).tobytes()
+        self.embedding_model = model_name
+
+    def get_embedding(self):
+        # Read-only float16 view over the stored bytes, no copy.
+        if not self.embedding:
+            return None
+        return np.frombuffer(self.embedding, dtype=np.float16)
+
+    def calculate_final_score(self, weights=None):
+        from .scoring import get_weights
+        engagement, freshness, relevance = weights or get_weights()
 
         self.final_score = round(
             (self.engagement_score * engagement) +
@@ -100,6 +124,8 @@ class TrendResult(models.Model):
 
 
 class QuerySubscription(models.Model):
+    DELIVERY_CHOICES = EMAIL_DELIVERY_CHOICES
+
     id = models.UUIDField(
         primary_key=True,
         default=uuid.uuid4,
@@ -117,6 +143,9 @@ class QuerySubscription(models.Model):
     )
     wants_emails = models.BooleanField(default=True)  # email
     is_active = models.BooleanField(default=True)  # refresh updates
+    # immediate: one email per refreshed version; digest: folded into one email per refresh run.
+    # Left unset, a new subscription takes the user's email_delivery.
+    delivery = models.CharField(max_length=10, choices=DELIVERY_CHOICES, default=None)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -124,10 +153,75 @@ class QuerySubscription(models.Model):
         unique_together = ("user", "query")
         ordering = ["-created_at"]
 
+    def save(self, *args, **kwargs):
+        if self.delivery is None:
+            self.delivery = self.user.email_delivery
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.user.email} - {self.query.industry}/{self.query.region} (emails={self.wants_emails} active={self.is_active})"
 
 
+class IngestionRun(models.Model):
+    STATUS_CHOICES = [
+        ('completed', 'Completed'),
+        ('empty', 'Empty'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    query = models.ForeignKey(
+        TrendQuery, related_name="ingestion_runs", on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(null=True, blank=True)  # None when nothing was saved
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    result_count = models.PositiveIntegerField(default=0)
+    streamed = models.BooleanField(default=False)
+    from_cache = models.BooleanField(default=False)  # completion served by the response cache
+    # Wall-clock milliseconds per stage
+    fetch_ms = models.FloatField(default=0.0)
+    parse_ms = models.FloatField(default=0.0)
+    embed_ms = models.FloatField(default=0.0)
+    score_ms = models.FloatField(default=0.0)
+    persist_ms = models.FloatField(default=0.0)
+    total_ms = models.FloatField(default=0.0)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["query", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.query_id} v{self.version} {self.status} ({self.total_ms:.0f} ms)"
+
+
+class UpstreamCall(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # Spend history outlives the query it was made for.
+    query = models.ForeignKey(
+        TrendQuery, related_name="upstream_calls", on_delete=models.SET_NULL, null=True, blank=True)
+    version = models.PositiveIntegerField(null=True, blank=True)
+    fingerprint = models.CharField(max_length=64, db_index=True)  # query_builder.query_fingerprint
+    model = models.CharField(max_length=100)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)  # None: no HTTP response
+    attempts = models.PositiveSmallIntegerField(default=1)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    total_tokens = models.PositiveIntegerField(default=0)
+    latency_ms = models.FloatField(default=0.0)
+    cost = models.DecimalField(max_digits=12, decimal_places=6, default=0)  # USD
+    streamed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.model} {self.status_code} {self.total_tokens} tokens ${self.cost}"
+
+
 def generate_numeric_otp(n=6):
     return "".join(random.choices("0123456789", k=n))
 
@@ -162,3 +256,40 @@ class SignUpOTP(models.Model):
 
     def __str__(self):
         return f"OTP for {self.email} (used={self.is_used})"
+
+
+class EmailOutbox(models.Model):
+    """
+    A rendered email waiting to be sent. Rows are written in the same
+    transaction as whatever triggered the email and sent by
+    tasks.dispatch_email_outbox.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),  # gave up after EMAIL_OUTBOX_MAX_ATTEMPTS
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=20)  # signup_otp, trend, digest
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body_text = models.TextField()
+    body_html = models.TextField(blank=True, default="")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            # Only the backlog the dispatcher scans; sent rows stay out of it.
+            models.Index(fields=["next_attempt_at"], condition=models.Q(status="pending"),
+                         name="emailoutbox_pending_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} to {self.to_email} ({self.status}, {self.attempts} attempts)"
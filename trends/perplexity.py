@@ -0,0 +1,209 @@
+import asyncio
+import os
+import threading
+import time
+
+import requests
+from decouple import config
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .ratelimit import RateLimiter
+from .resilience import CircuitBreaker, RetryPolicy, retry_delay_for
+from .streaming import iter_sse_chunks
+
+PERPLEXITY_API_KEY = config("PERPLEXITY_API_KEY", default='')
+API_URL = "https://api.perplexity.ai/chat/completions"
+
+
+def response_status(exc):
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+
+def default_headers(api_key=None):
+    return {
+        "Authorization": f"Bearer {api_key if api_key is not None else PERPLEXITY_API_KEY}",
+        "Content-Type": "application/json",
+        "Connection": "keep-alive",
+    }
+
+
+class PerplexityClient:
+    """
+    Thin wrapper around a pooled, keep-alive requests.Session.
+
+    One instance per process (see get_client) so sequential calls reuse the
+    same TCP+TLS connection to the API instead of handshaking every time.
+    """
+
+    def __init__(self, api_key=None, api_url=None, connect_timeout=None,
+                 read_timeout=None, pool_maxsize=None, retry_policy=None, breaker=None, limiter=None):
+        self.api_url = api_url or getattr(settings, "PERPLEXITY_API_URL", API_URL)
+        self.connect_timeout = connect_timeout or getattr(
+            settings, "PERPLEXITY_CONNECT_TIMEOUT", 5)
+        self.read_timeout = read_timeout or getattr(
+            settings, "PERPLEXITY_READ_TIMEOUT", 120)
+        pool_maxsize = pool_maxsize or getattr(settings, "PERPLEXITY_POOL_MAXSIZE", 10)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or RateLimiter()
+
+        self.session = requests.Session()
+        # Retries are handled by the caller, not urllib3.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(default_headers(api_key))
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def post_completion(self, payload, timeout=None):
+        with metrics.time_perplexity_call():
+            resp = self.session.post(self.api_url, json=payload, timeout=timeout or self.timeout)
+            resp.raise_for_status()
+        return resp
+
+    def create_completion(self, payload, timeout=None, max_attempts=None, call_info=None):
+        """
+        post_completion behind the circuit breaker and the rate limiter,
+        retried with backoff (every attempt takes a rate-limit token).
+        `call_info`, if given, is filled with the attempt count and the
+        last HTTP status seen.
+        """
+        call_info = {} if call_info is None else call_info
+        max_attempts = max_attempts or self.retry_policy.max_attempts
+        for attempt in range(max_attempts):
+            self.breaker.before_call()
+            self.limiter.acquire()
+            call_info["attempts"] = attempt + 1
+            try:
+                resp = self.post_completion(payload, timeout=timeout)
+            except Exception as exc:
+                call_info["status"] = response_status(exc)
+                time.sleep(retry_delay_for(
+                    exc, attempt, max_attempts, self.retry_policy, self.breaker))
+                continue
+            call_info["status"] = resp.status_code
+            self.breaker.record_success()
+            return resp
+
+    def stream_completion(self, payload, timeout=None, max_attempts=None, call_info=None):
+        """
+        Yield the decoded SSE chunks of a `stream: true` completion.
+
+        Opening the stream is retried like create_completion; once chunks
+        have been yielded a failure is raised to the caller instead.
+        """
+        call_info = {} if call_info is None else call_info
+        payload = {**payload, "stream": True}
+        max_attempts = max_attempts or self.retry_policy.max_attempts
+        for attempt in range(max_attempts):
+            self.breaker.before_call()
+            self.limiter.acquire()
+            call_info["attempts"] = attempt + 1
+            try:
+                resp = self.session.post(
+                    self.api_url, json=payload, timeout=timeout or self.timeout, stream=True)
+                resp.raise_for_status()
+            except Exception as exc:
+                call_info["status"] = response_status(exc)
+                time.sleep(retry_delay_for(
+                    exc, attempt, max_attempts, self.retry_policy, self.breaker))
+                continue
+            call_info["status"] = resp.status_code
+            break
+
+        resp.encoding = "utf-8"
+        try:
+            yield from iter_sse_chunks(resp.iter_lines(decode_unicode=True))
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            resp.close()
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncPerplexityClient:
+    """
+    asyncio counterpart of PerplexityClient, built on httpx.AsyncClient.
+
+    Meant to be created inside the event loop that uses it and closed with
+    aclose() when that loop is done.
+    """
+
+    def __init__(self, api_key=None, api_url=None, connect_timeout=None,
+                 read_timeout=None, pool_maxsize=None, retry_policy=None, breaker=None, limiter=None):
+        import httpx
+
+        self.api_url = api_url or getattr(settings, "PERPLEXITY_API_URL", API_URL)
+        self.connect_timeout = connect_timeout or getattr(
+            settings, "PERPLEXITY_CONNECT_TIMEOUT", 5)
+        self.read_timeout = read_timeout or getattr(
+            settings, "PERPLEXITY_READ_TIMEOUT", 120)
+        pool_maxsize = pool_maxsize or getattr(settings, "PERPLEXITY_POOL_MAXSIZE", 10)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or RateLimiter()
+
+        self.client = httpx.AsyncClient(
+            headers=default_headers(api_key),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+        )
+
+    async def post_completion(self, payload, timeout=None):
+        kwargs = {"timeout": timeout} if timeout else {}
+        with metrics.time_perplexity_call():
+            resp = await self.client.post(self.api_url, json=payload, **kwargs)
+            resp.raise_for_status()
+        return resp
+
+    async def create_completion(self, payload, timeout=None, max_attempts=None, call_info=None):
+        from asgiref.sync import sync_to_async
+
+        call_info = {} if call_info is None else call_info
+        max_attempts = max_attempts or self.retry_policy.max_attempts
+        # The breaker state is in the cache; keep its blocking calls off the event loop.
+        for attempt in range(max_attempts):
+            await sync_to_async(self.breaker.before_call, thread_sensitive=False)()
+            await self.limiter.acquire_async()
+            call_info["attempts"] = attempt + 1
+            try:
+                resp = await self.post_completion(payload, timeout=timeout)
+            except Exception as exc:
+                call_info["status"] = response_status(exc)
+                await asyncio.sleep(await sync_to_async(retry_delay_for, thread_sensitive=False)(
+                    exc, attempt, max_attempts, self.retry_policy, self.breaker))
+                continue
+            call_info["status"] = resp.status_code
+            await sync_to_async(self.breaker.record_success, thread_sensitive=False)()
+            return resp
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Per-process client; a forked child never reuses its parent's sockets."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = PerplexityClient()
+                _client_pid = pid
+    return _client
@@ -1,3 +1,6 @@
+import hashlib
+
+
 def build_perplexity_query(industry: str, region: str, persona: str, date_range: str) -> str:
     return f'''
 You are a search engine.
@@ -65,3 +68,15 @@ Important:
 - No duplicate URLs should appear across any of the 5 trends.
 - The number of URLs per trend can vary from 1 to 5 according to availability.
 '''
+
+
+def normalize_query_params(industry: str, region: str, persona: str, date_range: str) -> tuple:
+    return tuple(
+        " ".join(str(value or "").split()).lower()
+        for value in (industry, region, persona, date_range)
+    )
+
+
+def query_fingerprint(industry: str, region: str, persona: str, date_range: str) -> str:
+    normalized = normalize_query_params(industry, region, persona, date_range)
+    return hashlib.sha256("\x1f".join(normalized).encode("utf-8")).hexdigest()
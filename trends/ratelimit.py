@@ -0,0 +1,184 @@
+"""
+Cluster-wide token buckets in front of the Perplexity API.
+
+Every HTTP attempt takes one token from the bucket of its traffic class
+before it is sent. Interactive traffic (queries users just submitted) and
+batch traffic (the nightly refresh) have separate budgets, so a refresh
+that fans out over many workers cannot use up the tokens user queries
+need. Pick the class with `with traffic_class("batch"):`; the default is
+"interactive".
+
+Buckets live next to the breaker state in the default cache. With Redis
+the refill-and-take is one Lua script, atomic across all workers and timed
+by the Redis clock. With any other cache backend (LocMem in tests and
+local development) the same arithmetic runs in Python under a
+process-local lock.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, BATCH = "interactive", "batch"
+
+_traffic_class = ContextVar("perplexity_traffic_class", default=INTERACTIVE)
+
+# KEYS[1] bucket hash; ARGV rate (tokens/s), capacity, tokens wanted, max wait (s).
+# Returns the wait in seconds as a string (Lua numbers come back truncated to
+# integers otherwise). The tokens are reserved only when the wait is within
+# max wait, so a caller that gives up leaves the bucket untouched. The key
+# lives until the bucket has refilled from its deficit, so it never expires
+# (and comes back full) while reservations are still waiting on it.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < wanted then
+  wait = (wanted - tokens) / rate
+end
+if wait <= max_wait then
+  local remaining = tokens - wanted
+  redis.call('HSET', KEYS[1], 'tokens', tostring(remaining), 'ts', tostring(now))
+  redis.call('EXPIRE', KEYS[1], math.ceil((capacity - remaining) / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class RateLimitExceeded(Exception):
+    """Raised instead of calling upstream when no token frees up within the allowed wait."""
+
+
+def current_traffic_class():
+    return _traffic_class.get()
+
+
+@contextmanager
+def traffic_class(name):
+    token = _traffic_class.set(name)
+    try:
+        yield
+    finally:
+        _traffic_class.reset(token)
+
+
+def bucket_ttl(tokens, rate, capacity):
+    """Seconds until a bucket holding `tokens` is full again, plus one."""
+    return math.ceil((capacity - tokens) / rate) + 1
+
+
+def take_tokens(state, now, rate, capacity, wanted, max_wait):
+    """Python twin of TOKEN_BUCKET_LUA: (wait seconds, new state or None)."""
+    tokens, ts = state or (capacity, now)
+    tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+    wait = (wanted - tokens) / rate if tokens < wanted else 0.0
+    if wait <= max_wait:
+        return wait, (tokens - wanted, now)
+    return wait, None
+
+
+class TokenBucket:
+    """
+    `per_minute` tokens a minute, up to `burst` saved up. Tokens go negative
+    while callers wait for them, so waiters are served in arrival order.
+    """
+
+    _local_lock = threading.Lock()
+
+    def __init__(self, name, per_minute, burst, cache_alias="default"):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.cache_alias = cache_alias
+        self.key = f"trends:ratelimit:{name}"
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def reserve(self, max_wait, tokens=1):
+        """Seconds to wait before the reserved tokens may be used; nothing is reserved past max_wait."""
+        cache = self.cache
+        if hasattr(cache, "_cache") and hasattr(cache._cache, "get_client"):
+            # django.core.cache.backends.redis.RedisCache
+            client = cache._cache.get_client(self.key, write=True)
+            script = client.register_script(TOKEN_BUCKET_LUA)
+            return float(script(keys=[cache.make_key(self.key)],
+                                args=[self.rate, self.capacity, tokens, max_wait]))
+
+        with self._local_lock:
+            wait, state = take_tokens(
+                cache.get(self.key), time.time(), self.rate, self.capacity, tokens, max_wait)
+            if state is not None:
+                cache.set(self.key, state, bucket_ttl(state[0], self.rate, self.capacity))
+        return wait
+
+
+class RateLimiter:
+    """
+    Per-traffic-class buckets configured by PERPLEXITY_RATE_LIMITS; a class
+    with no entry (or per_minute 0) is not limited.
+    """
+
+    def __init__(self, limits=None, max_wait=None, cache_alias="default"):
+        self.limits = getattr(settings, "PERPLEXITY_RATE_LIMITS", {}) if limits is None else limits
+        self.max_wait = max_wait if max_wait is not None else getattr(
+            settings, "PERPLEXITY_RATE_LIMIT_MAX_WAIT", 60)
+        self.cache_alias = cache_alias
+
+    def bucket(self, traffic):
+        limit = self.limits.get(traffic) or {}
+        if not limit.get("per_minute"):
+            return None
+        return TokenBucket(traffic, limit["per_minute"], limit.get("burst", 1), self.cache_alias)
+
+    def reserve(self, traffic=None):
+        """Take a token for `traffic` (default: the current class) and return the wait in seconds."""
+        traffic = traffic or current_traffic_class()
+        bucket = self.bucket(traffic)
+        if bucket is None:
+            return 0.0
+        try:
+            wait = bucket.reserve(self.max_wait)
+        except Exception as e:
+            # A limiter outage must not take Perplexity calls down with it.
+            logger.warning(f"Rate limiter unavailable, calling Perplexity unthrottled: {e}")
+            return 0.0
+        if wait > self.max_wait:
+            metrics.PERPLEXITY_RATE_LIMITED.labels(traffic).inc()
+            raise RateLimitExceeded(
+                f"No {traffic} Perplexity token within {self.max_wait}s (next in {wait:.1f}s)")
+        metrics.PERPLEXITY_RATE_LIMIT_WAIT.labels(traffic).observe(wait)
+        return wait
+
+    def acquire(self, traffic=None):
+        wait = self.reserve(traffic)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, traffic=None):
+        from asgiref.sync import sync_to_async
+
+        # The class is read here: it is a context variable of the calling task.
+        traffic = traffic or current_traffic_class()
+        wait = await sync_to_async(self.reserve, thread_sensitive=False)(traffic)
+        if wait:
+            await asyncio.sleep(wait)
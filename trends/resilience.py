@@ -0,0 +1,220 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit breaker is open."""
+
+
+def parse_retry_after(value):
+    """Retry-After as seconds; accepts both delta-seconds and an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc):
+    """
+    Return (retryable, status_code, retry_after) for an exception raised by
+    the requests or httpx transport.
+    """
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        return status in RETRYABLE_STATUS_CODES, status, retry_after
+
+    if isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True, None, None
+
+    try:
+        import httpx
+    except ImportError:
+        return False, None, None
+    if isinstance(exc, httpx.TransportError):
+        return True, None, None
+    return False, None, None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After."""
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None,
+                 max_retry_after=None):
+        self.max_attempts = max_attempts or getattr(settings, "PERPLEXITY_MAX_ATTEMPTS", 3)
+        self.base_delay = base_delay if base_delay is not None else getattr(
+            settings, "PERPLEXITY_BACKOFF_BASE", 1.0)
+        self.max_delay = max_delay if max_delay is not None else getattr(
+            settings, "PERPLEXITY_BACKOFF_MAX", 30.0)
+        self.max_retry_after = max_retry_after if max_retry_after is not None else getattr(
+            settings, "PERPLEXITY_RETRY_AFTER_MAX", 120.0)
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait after failed attempt number `attempt` (0-based)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker whose state lives in the Django cache,
+    so every worker process sees the same state.
+
+    closed    -> calls go through; failures are counted.
+    open      -> calls fail fast with CircuitOpenError until reset_timeout passes.
+    half_open -> one probe call is let through; success closes, failure re-opens.
+
+    When the cache is unreachable the breaker fails open: calls go through
+    and failures are not counted until the cache is back.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, name="perplexity", failure_threshold=None, reset_timeout=None,
+                 cache_alias="default"):
+        self.name = name
+        self.failure_threshold = failure_threshold or getattr(
+            settings, "PERPLEXITY_BREAKER_THRESHOLD", 5)
+        self.reset_timeout = reset_timeout or getattr(
+            settings, "PERPLEXITY_BREAKER_RESET_TIMEOUT", 60)
+        self.cache_alias = cache_alias
+        self.failures_key = f"trends:breaker:{name}:failures"
+        self.opened_until_key = f"trends:breaker:{name}:opened_until"
+        self.probe_key = f"trends:breaker:{name}:probe"
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def state(self):
+        try:
+            opened_until = self.cache.get(self.opened_until_key)
+        except Exception as e:
+            logger.warning(f"Circuit '{self.name}' state unavailable, treating it as closed: {e}")
+            return self.CLOSED
+        if opened_until is None:
+            return self.CLOSED
+        if opened_until > time.time():
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self):
+        state = self.state()
+        metrics.set_breaker_state(self.name, state)
+        if state == self.OPEN:
+            metrics.PERPLEXITY_BREAKER_REJECTIONS.labels(self.name).inc()
+            raise CircuitOpenError(f"Circuit '{self.name}' is open")
+        if state == self.HALF_OPEN and not self._claim_probe():
+            metrics.PERPLEXITY_BREAKER_REJECTIONS.labels(self.name).inc()
+            raise CircuitOpenError(f"Circuit '{self.name}' is half-open, probe in flight")
+
+    def _claim_probe(self):
+        try:
+            return self.cache.add(self.probe_key, 1, self.reset_timeout)
+        except Exception as e:
+            logger.warning(f"Circuit '{self.name}' probe lock unavailable, letting the call through: {e}")
+            return True
+
+    def record_success(self):
+        try:
+            if self.cache.get(self.failures_key) or self.cache.get(self.opened_until_key):
+                self.cache.delete_many([self.failures_key, self.opened_until_key, self.probe_key])
+                logger.info(f"Circuit '{self.name}' closed")
+        except Exception as e:
+            logger.warning(f"Could not record success on circuit '{self.name}': {e}")
+        metrics.set_breaker_state(self.name, self.CLOSED)
+
+    def record_failure(self):
+        try:
+            self.cache.add(self.failures_key, 0, None)
+            failures = self.cache.incr(self.failures_key)
+            if failures >= self.failure_threshold:
+                self.cache.set(self.opened_until_key, time.time() + self.reset_timeout, None)
+                self.cache.delete(self.probe_key)
+        except Exception as e:
+            logger.warning(f"Could not record failure on circuit '{self.name}': {e}")
+            return
+        if failures >= self.failure_threshold:
+            metrics.set_breaker_state(self.name, self.OPEN)
+            logger.warning(
+                f"Circuit '{self.name}' open for {self.reset_timeout}s after {failures} consecutive failures")
+
+
+def retry_delay_for(exc, attempt, max_attempts, policy, breaker):
+    """
+    Book-keeping for a failed attempt: update the breaker and the retry
+    metrics, then return how long to wait before the next attempt. Re-raises
+    `exc` when it is not retryable or the attempts are used up.
+    """
+    retryable, status, retry_after = classify_error(exc)
+    if not retryable:
+        if status is not None:
+            # Upstream answered (e.g. 400/401); that says nothing about its health.
+            breaker.record_success()
+        raise exc
+
+    breaker.record_failure()
+    if attempt >= max_attempts - 1:
+        raise exc
+
+    reason = str(status) if status is not None else type(exc).__name__
+    delay = policy.delay(attempt, retry_after)
+    metrics.PERPLEXITY_RETRIES.labels(reason).inc()
+    logger.warning(
+        f"Perplexity call failed ({reason}), retry {attempt + 1}/{max_attempts - 1} in {delay:.2f}s")
+    return delay
+
+
+class CacheSemaphore:
+    """
+    At most `limit` holders across every worker process, with the slots
+    kept in the Django cache like the breaker state.
+
+    A slot is a cache key added with the holder's token; it expires after
+    `timeout` seconds so a worker killed mid-task cannot hold it forever.
+    """
+
+    def __init__(self, name, limit, timeout, cache_alias="default"):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def slot_key(self, slot):
+        return f"trends:semaphore:{self.name}:{slot}"
+
+    def acquire(self, token):
+        """The slot number taken, or None when all `limit` slots are held."""
+        for slot in random.sample(range(self.limit), self.limit):
+            if self.cache.add(self.slot_key(slot), token, self.timeout):
+                return slot
+        return None
+
+    def release(self, slot, token):
+        key = self.slot_key(slot)
+        if self.cache.get(key) == token:
+            self.cache.delete(key)
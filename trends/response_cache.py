@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of raw Perplexity completions.
+
+    Keys are a hash of (model, prompt, temperature); values are the
+    zlib-compressed JSON body, stored in the Django cache with a TTL.
+    Concurrent requests for the same key are coalesced: threads (or
+    coroutines) of one process wait on the in-process leader, other
+    processes wait on a short-lived lock key in the shared cache and poll
+    for the result. When the cache is down every request simply calls
+    upstream.
+    """
+
+    def __init__(self, timeout=None, cache_alias="default", lock_timeout=None,
+                 poll_interval=0.5):
+        self.timeout = timeout or getattr(settings, "PERPLEXITY_RESPONSE_CACHE_TTL", 60 * 60 * 6)
+        self.cache_alias = cache_alias
+        # Long enough to cover a full upstream call with retries.
+        self.lock_timeout = lock_timeout or getattr(settings, "PERPLEXITY_READ_TIMEOUT", 120) * 3
+        self.poll_interval = poll_interval
+        self._inflight = {}  # key -> threading.Event of the leading thread
+        self._async_inflight = {}  # key -> asyncio.Future of the leading coroutine
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def enabled(self):
+        return getattr(settings, "PERPLEXITY_RESPONSE_CACHE_ENABLED", True)
+
+    def make_key(self, payload):
+        prompt = "\n".join(m.get("content", "") for m in payload.get("messages", []))
+        digest = hashlib.sha256(json.dumps(
+            [payload.get("model"), prompt, payload.get("temperature")],
+            ensure_ascii=False,
+        ).encode("utf-8")).hexdigest()
+        return f"trends:perplexity-response:{digest}"
+
+    def get(self, key):
+        try:
+            raw = self.cache.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache unavailable: {e}")
+            return None
+        if raw is None:
+            return None
+        return json.loads(zlib.decompress(raw))
+
+    def set(self, key, data):
+        try:
+            self.cache.set(key, zlib.compress(json.dumps(data).encode("utf-8")), self.timeout)
+        except Exception as e:
+            logger.warning(f"Could not store Perplexity response: {e}")
+
+    def invalidate(self, payload):
+        try:
+            self.cache.delete(self.make_key(payload))
+        except Exception as e:
+            logger.warning(f"Could not invalidate Perplexity response: {e}")
+
+    def _acquire_lock(self, lock_key):
+        """True when this process should call upstream: it holds the lock, or the cache is down."""
+        try:
+            return self.cache.add(lock_key, 1, self.lock_timeout)
+        except Exception as e:
+            logger.warning(f"Response cache unavailable, fetching without coalescing: {e}")
+            return True
+
+    def _release_lock(self, lock_key):
+        try:
+            self.cache.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"Could not release response cache lock: {e}")
+
+    def _lock_held(self, lock_key):
+        try:
+            return self.cache.get(lock_key) is not None
+        except Exception:
+            return False
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _fetch_and_store(self, key, fetch):
+        data = fetch()
+        self.set(key, data)
+        self._count("misses")
+        return data
+
+    def get_or_fetch(self, payload, fetch):
+        """Return the cached completion for `payload`, or call fetch() once for it."""
+        if not self.enabled:
+            return fetch()
+
+        key = self.make_key(payload)
+        data = self.get(key)
+        if data is not None:
+            self._count("hits")
+            return data
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = threading.Event()
+
+        if not leader:
+            flight.wait(self.lock_timeout)
+            data = self.get(key)
+            if data is not None:
+                self._count("coalesced")
+                return data
+            # The leader failed; try on our own.
+            return self._fetch_and_store(key, fetch)
+
+        try:
+            return self._fetch_across_processes(key, fetch)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.set()
+
+    def _fetch_across_processes(self, key, fetch):
+        lock_key = f"{key}:lock"
+        if self._acquire_lock(lock_key):
+            try:
+                return self._fetch_and_store(key, fetch)
+            finally:
+                self._release_lock(lock_key)
+
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            data = self.get(key)
+            if data is not None:
+                self._count("coalesced")
+                return data
+            if not self._lock_held(lock_key):
+                break
+        return self._fetch_and_store(key, fetch)
+
+    async def aget_or_fetch(self, payload, fetch):
+        """asyncio variant of get_or_fetch; `fetch` is a coroutine function."""
+        from asgiref.sync import sync_to_async
+
+        if not self.enabled:
+            return await fetch()
+
+        key = self.make_key(payload)
+        data = await sync_to_async(self.get, thread_sensitive=False)(key)
+        if data is not None:
+            self._count("hits")
+            return data
+
+        flight = self._async_inflight.get(key)
+        if flight is not None and flight.get_loop() is asyncio.get_running_loop():
+            try:
+                data = await asyncio.shield(flight)
+                self._count("coalesced")
+                return data
+            except Exception:
+                pass  # the leader failed; try on our own
+
+        flight = asyncio.get_running_loop().create_future()
+        self._async_inflight[key] = flight
+        try:
+            data = await self._afetch_across_processes(key, fetch)
+            flight.set_result(data)
+            return data
+        except Exception as e:
+            flight.set_exception(e)
+            flight.exception()  # mark retrieved when nobody is waiting
+            raise
+        finally:
+            if self._async_inflight.get(key) is flight:
+                del self._async_inflight[key]
+
+    async def _afetch_and_store(self, key, fetch):
+        from asgiref.sync import sync_to_async
+
+        data = await fetch()
+        await sync_to_async(self.set, thread_sensitive=False)(key, data)
+        self._count("misses")
+        return data
+
+    async def _afetch_across_processes(self, key, fetch):
+        from asgiref.sync import sync_to_async
+
+        lock_key = f"{key}:lock"
+        if await sync_to_async(self._acquire_lock, thread_sensitive=False)(lock_key):
+            try:
+                return await self._afetch_and_store(key, fetch)
+            finally:
+                await sync_to_async(self._release_lock, thread_sensitive=False)(lock_key)
+
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            data = await sync_to_async(self.get, thread_sensitive=False)(key)
+            if data is not None:
+                self._count("coalesced")
+                return data
+            if not await sync_to_async(self._lock_held, thread_sensitive=False)(lock_key):
+                break
+        return await self._afetch_and_store(key, fetch)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+
+response_cache = ResponseCache()
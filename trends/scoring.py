@@ -0,0 +1,242 @@
+"""
+Columnar scoring of trend results.
+
+The per-result functions in services.py walk one `sources` dict at a time.
+Here a whole batch is first flattened into NumPy columns (one entry per
+engagement dict, one per result for URL counts and newest source date),
+and engagement, freshness and final_score are then computed for every row
+with array operations. The numbers match the scalar functions:
+
+    engagement = min(sum(likes * 0.5 + shares + comments * 0.8), 100),
+                 or min(len(urls) * 20, 100) when that sum is 0
+    freshness  = round(100 * exp(-age_days / decay), 2)
+    final      = round(engagement * w0 + freshness * w1 + relevance * w2, 2)
+"""
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+US_PER_DAY = 86_400 * 1_000_000
+NO_DATE = np.iinfo(np.int64).min
+
+
+def get_weights():
+    return tuple(getattr(settings, "TREND_SCORE_WEIGHTS", (0.3, 0.4, 0.3)))
+
+
+def get_decay_days():
+    return getattr(settings, "TREND_FRESHNESS_DECAY_DAYS", 7)
+
+
+def live_ranking_enabled():
+    return getattr(settings, "TREND_LIVE_RANKING", False)
+
+
+def to_epoch_us(dt):
+    """Exact microseconds since the epoch, so day boundaries match timedelta.days."""
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def from_epoch_us(us):
+    return EPOCH + timedelta(microseconds=int(us))
+
+
+def parse_source_date(value, cache=None):
+    """Same parsing as compute_freshness_from_sources; None when unparseable."""
+    if cache is not None and value in cache:
+        return cache[value]
+    try:
+        dt = datetime.fromisoformat(value)
+        if timezone.is_naive(dt):
+            dt = timezone.make_aware(dt, timezone.get_current_timezone())
+        us = to_epoch_us(dt)
+    except Exception:
+        us = None
+    if cache is not None:
+        try:
+            cache[value] = us
+        except TypeError:
+            pass
+    return us
+
+
+def round2(values):
+    """
+    Python's round(x, 2) for an array.
+
+    np.round(x, 2) rounds the already-rounded product x * 100, which gives
+    a different answer from round() for a few percent of real scores. Here
+    the rounding error of that product is recovered exactly (Dekker's
+    two-product) and used to settle the cases that land on .5.
+    """
+    x = np.asarray(values, dtype=np.float64)
+    p = x * 100
+    c = 134217729.0 * x  # 2**27 + 1
+    hi = c - (c - x)
+    lo = x - hi
+    err = (hi * 100 - p) + lo * 100
+    n = np.rint(p)
+    frac = p - n
+    n += ((frac == 0.5) & (err > 0)).astype(np.float64)
+    n -= ((frac == -0.5) & (err < 0)).astype(np.float64)
+    return n / 100
+
+
+def _override(r, key):
+    value = r.get(key)
+    return np.nan if value is None else float(value)
+
+
+def build_columns(results, created_at):
+    """
+    Flatten result dicts into the arrays score_columns() works on.
+
+    `created_at` is the freshness fallback when a result has no parseable
+    source date: one datetime for the whole batch, or one per result.
+    """
+    n = len(results)
+    per_row_created = isinstance(created_at, (list, tuple))
+    date_cache = {}
+
+    rows, likes, shares, comments = [], [], [], []
+    url_count = np.zeros(n, dtype=np.int64)
+    newest_us = np.empty(n, dtype=np.int64)
+    given = np.full((n, 3), np.nan)
+
+    for i, r in enumerate(results):
+        sources = r.get("sources", {})
+        if isinstance(sources, dict):
+            url_count[i] = len(sources.get("urls", []))
+            for e in sources.get("engagement", []):
+                rows.append(i)
+                likes.append(e.get("likes", 0))
+                shares.append(e.get("shares", 0))
+                comments.append(e.get("comments", 0))
+            dates = sources.get("dates", [])
+        else:
+            dates = []
+
+        newest = NO_DATE
+        for d in dates:
+            us = parse_source_date(d, date_cache)
+            if us is not None and us > newest:
+                newest = us
+        if newest == NO_DATE:
+            newest = to_epoch_us(created_at[i] if per_row_created else created_at)
+        newest_us[i] = newest
+
+        given[i] = (_override(r, "engagement"), _override(r, "freshness"), _override(r, "relevance"))
+
+    return {
+        "n": n,
+        "row": np.asarray(rows, dtype=np.int64),
+        "likes": np.asarray(likes, dtype=np.float64),
+        "shares": np.asarray(shares, dtype=np.float64),
+        "comments": np.asarray(comments, dtype=np.float64),
+        "url_count": url_count,
+        "newest_us": newest_us,
+        "given_engagement": given[:, 0],
+        "given_freshness": given[:, 1],
+        "given_relevance": given[:, 2],
+    }
+
+
+def engagement_scores(columns):
+    per_entry = (columns["likes"] * 0.5) + (columns["shares"] * 1.0) + (columns["comments"] * 0.8)
+    # Accumulate per row in entry order, like the scalar loop does.
+    score = np.zeros(columns["n"])
+    np.add.at(score, columns["row"], per_entry)
+    fallback = np.minimum(100, columns["url_count"] * 20).astype(np.float64)
+    score = np.where(score == 0, fallback, score)
+    return np.minimum(score, 100.0)
+
+
+def freshness_scores(newest_us, now=None, decay_days=None):
+    decay_days = decay_days or get_decay_days()
+    now_us = to_epoch_us(now or timezone.now())
+    age_days = (now_us - newest_us) // US_PER_DAY
+    # Ages are whole days, so there are only a handful of distinct values;
+    # score each once with the exact scalar formula and scatter back.
+    ages, inverse = np.unique(age_days, return_inverse=True)
+    scores = np.array(
+        [round(100 * math.exp(-int(age) / decay_days), 2) for age in ages], dtype=np.float64)
+    return scores[inverse.reshape(-1)]
+
+
+def final_scores(engagement, freshness, relevance, weights=None):
+    w_engagement, w_freshness, w_relevance = weights or get_weights()
+    return round2(
+        (engagement * w_engagement) +
+        (freshness * w_freshness) +
+        (relevance * w_relevance))
+
+
+def score_columns(columns, relevance, now=None, weights=None, decay_days=None):
+    """
+    Return (engagement, freshness, relevance, final) float64 arrays.
+
+    Scores a result already carries ("engagement", "freshness",
+    "relevance" keys) win over computed ones, as in services.score_result.
+    """
+    engagement = engagement_scores(columns)
+    freshness = freshness_scores(columns["newest_us"], now=now, decay_days=decay_days)
+    relevance = np.asarray(relevance, dtype=np.float64)
+
+    engagement = np.where(np.isnan(columns["given_engagement"]), engagement, columns["given_engagement"])
+    freshness = np.where(np.isnan(columns["given_freshness"]), freshness, columns["given_freshness"])
+    relevance = np.where(np.isnan(columns["given_relevance"]), relevance, columns["given_relevance"])
+
+    return engagement, freshness, relevance, final_scores(engagement, freshness, relevance, weights)
+
+
+def score_results(results, created_at, relevance, now=None, weights=None, decay_days=None):
+    return score_columns(
+        build_columns(results, created_at), relevance,
+        now=now, weights=weights, decay_days=decay_days)
+
+
+def newest_source_dates(columns):
+    """Per-row freshness anchor (newest source date, else the fallback) as datetimes."""
+    return [from_epoch_us(us) for us in columns["newest_us"].tolist()]
+
+
+def rank_live(rows, now=None, weights=None, decay_days=None):
+    """
+    Recompute freshness_score and final_score of TrendResult rows as of
+    `now` from their stored newest_source_at, and return them best first.
+
+    The new values are set on the instances only; nothing is written.
+    Rows stored before newest_source_at existed keep their frozen freshness.
+    """
+    rows = list(rows)
+    if not rows:
+        return rows
+
+    freshness = np.array([row.freshness_score for row in rows], dtype=np.float64)
+    anchored = [i for i, row in enumerate(rows) if row.newest_source_at is not None]
+    if anchored:
+        newest_us = np.array([to_epoch_us(rows[i].newest_source_at) for i in anchored], dtype=np.int64)
+        freshness[anchored] = freshness_scores(newest_us, now=now, decay_days=decay_days)
+
+    engagement = np.array([row.engagement_score for row in rows], dtype=np.float64)
+    relevance = np.array([row.relevance_score for row in rows], dtype=np.float64)
+    final = final_scores(engagement, freshness, relevance, weights)
+
+    for row, fresh, score in zip(rows, freshness.tolist(), final.tolist()):
+        row.freshness_score, row.final_score = fresh, score
+    rows.sort(key=lambda row: row.final_score, reverse=True)
+    return rows
+
+
+def rank_results(queryset, now=None):
+    """
+    TrendResult rows best first: by stored final_score, or with
+    TREND_LIVE_RANKING by freshness decayed up to now.
+    """
+    if live_ranking_enabled():
+        return rank_live(queryset, now=now)
+    return queryset.order_by("-final_score")
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import TrendQuery, TrendResult, QuerySubscription
+from . import scoring
 from django.contrib.auth import get_user_model
 from django.db.models import Max
 
@@ -55,7 +56,7 @@ class TrendQuerySerializer(serializers.ModelSerializer):
         ]
 
     def get_results(self, obj):
-        results = obj.results.order_by("-final_score")
+        results = scoring.rank_results(obj.results.all())
         return TrendResultSerializer(results, many=True).data
 
 
@@ -82,6 +83,7 @@ class UserSerializer(serializers.ModelSerializer):
             "last_name",
             "full_name",
             "email",
+            "email_delivery",
             "date_joined",
             "last_login",
         ]
@@ -131,6 +133,7 @@ class QuerySubscriptionSerializer(serializers.ModelSerializer):
             "query_id",
             "wants_emails",
             "is_active",
+            "delivery",
             "created_at",
         ]
 
@@ -1,20 +1,23 @@
-import requests
 import logging
-from decouple import config
 from .models import TrendQuery, TrendResult
 from .query_builder import build_perplexity_query
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
 from django.utils import timezone
 from datetime import datetime
-from sentence_transformers import SentenceTransformer, util
+from . import accounting, embeddings, scoring
+from .perplexity import get_client
+from .response_cache import response_cache
+from .streaming import ResultStreamParser, chunk_delta
+from .json_extract import extract_json
+from .instrumentation import StageTimer, record_ingestion_run
+import asyncio
 import json
 import time
-import re
 import math
 
 logger = logging.getLogger(__name__)
-PERPLEXITY_API_KEY = config("PERPLEXITY_API_KEY", default='')
-API_URL = "https://api.perplexity.ai/chat/completions"
-model = SentenceTransformer("all-MiniLM-L6-v2")
 
 
 def compute_engagement_from_sources(sources):
@@ -34,7 +37,8 @@ def compute_engagement_from_sources(sources):
     return float(min(score, 100.0))
 
 
-def compute_freshness_from_sources(sources, query_created_at, decay_factor=7):
+def compute_freshness_from_sources(sources, query_created_at, decay_factor=None):
+    decay_factor = decay_factor or scoring.get_decay_days()
     dates = sources.get("dates", []) if isinstance(sources, dict) else []
 
     parsed_dates = []
@@ -58,61 +62,47 @@ def compute_freshness_from_sources(sources, query_created_at, decay_factor=7):
     return float(round(score, 2))
 
 
-def compute_relevance(query_obj, topic, summary):
-    query_text = f"{query_obj.industry} {query_obj.persona} {query_obj.region} {query_obj.date_range}"
-    trend_text = f"{topic} {summary}"
-
-    embeddings = model.encode([query_text, trend_text], convert_to_tensor=True)
-    similarity = util.cos_sim(embeddings[0], embeddings[1]).item()
-    relevance = max(0.0, round(similarity * 100, 2))
-    return relevance
+def build_relevance_query_text(query_obj):
+    return f"{query_obj.industry} {query_obj.persona} {query_obj.region} {query_obj.date_range}"
 
 
-def clean_json_numbers(text: str) -> str:
-    return re.sub(r'(\d+)_(\d+)', r'\1\2', text)
+def embed_trends(trends, model_name=None, batch_size=32):
+    """Encode (topic, summary) pairs in a single batched call."""
+    trend_texts = [f"{topic} {summary}" for topic, summary in trends]
+    if not trend_texts:
+        return []
+    return embeddings.get_model(model_name).encode(trend_texts, batch_size=batch_size)
 
 
-def sanitize_json(text: str) -> str:
-    text = re.sub(r',(\s*[\]}])', r'\1', text)
-    text = re.sub(r'\"\"(\s*[,\]])', r'"\1', text)
-    text = text.replace("“", "\"").replace("”", "\"")
-    return text
+def compute_relevance_batch(query_obj, trends, trend_vectors=None):
+    """
+    Score many (topic, summary) pairs against one query.
 
+    The query embedding comes from the query embedding cache, every trend
+    text goes through a single batched encode call (unless the vectors are
+    passed in), and the similarities come out of one matrix product.
+    """
+    if trend_vectors is None:
+        trend_vectors = embed_trends(trends)
+    if len(trend_vectors) == 0:
+        return []
 
-def extract_json_from_text(text):
-    cleaned = clean_json_numbers(text)
-    cleaned = sanitize_json(cleaned)
+    query_vector = embeddings.query_embedding_cache.get(
+        query_obj, build_relevance_query_text(query_obj))
+    similarities = embeddings.cosine_similarities(query_vector, trend_vectors)
+    return [max(0.0, round(float(similarity) * 100, 2)) for similarity in similarities]
 
-    try:
-        return json.loads(cleaned)
-    except Exception as e:
-        logger.warning(f"Direct JSON parse failed: {e}")
-
-    m = re.search(r'(\{.*"results"\s*:\s*\[.*\]\s*\})', cleaned, re.S)
-    if m:
-        try:
-            return json.loads(m.group(1))
-        except Exception as e:
-            logger.error(f"JSON parse error from regex 1: {e}")
 
-    m2 = re.search(r'(\[.*\])', cleaned, re.S)
-    if m2:
-        try:
-            return {"results": json.loads(m2.group(1))}
-        except Exception as e:
-            logger.error(f"JSON parse error from regex 2: {e}")
+def compute_relevance(query_obj, topic, summary):
+    return compute_relevance_batch(query_obj, [(topic, summary)])[0]
 
-    logger.error(
-        f"❌ Could not parse content into JSON. First 500 chars: {cleaned[:500]}")
-    return None
 
+def extract_json_from_text(text):
+    """Single-pass repair + extraction; see trends.json_extract."""
+    return extract_json(text)
 
-def fetch_trends_from_perplexity(query_obj: TrendQuery, max_retries=3, timeout=120):
-    headers = {
-        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "Content-Type": "application/json",
-    }
 
+def build_perplexity_payload(query_obj: TrendQuery):
     query_text = build_perplexity_query(
         query_obj.industry,
         query_obj.region,
@@ -120,7 +110,7 @@ def fetch_trends_from_perplexity(query_obj: TrendQuery, max_retries=3, timeout=1
         query_obj.date_range,
     )
 
-    payload = {
+    return {
         "model": "sonar-pro",
         "messages": [
             {
@@ -131,92 +121,356 @@ def fetch_trends_from_perplexity(query_obj: TrendQuery, max_retries=3, timeout=1
         "temperature": 1.5,
     }
 
-    resp = None
-    for attempt in range(max_retries):
+
+def fetch_trends_from_perplexity(query_obj: TrendQuery, max_retries=None, timeout=None, client=None, stream=None):
+    if stream is None:
+        stream = getattr(settings, "PERPLEXITY_STREAMING", False)
+    if stream:
+        return stream_trends_from_perplexity(
+            query_obj, max_retries=max_retries, timeout=timeout, client=client)
+
+    client = client or get_client()
+    timer = StageTimer()
+    timer.from_cache = True
+    call_info = {}
+
+    def fetch():
+        timer.from_cache = False
+        started = time.perf_counter()
+        data = None
         try:
-            resp = requests.post(
-                API_URL, headers=headers, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            break
-        except requests.exceptions.ReadTimeout:
-            logger.warning(f"Timeout on attempt {attempt+1} / {max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(2)
-                continue
-            else:
-                raise
+            data = client.create_completion(
+                payload, timeout=timeout, max_attempts=max_retries, call_info=call_info).json()
+            return data
+        finally:
+            timer.upstream = accounting.upstream_call_fields(
+                payload, call_info, (time.perf_counter() - started) * 1000, data=data)
 
     try:
-        data = resp.json()
-        content = (
-            data.get("choices", [{}])[0]
-            .get("message", {})
-            .get("content", "")
-        ).strip()
+        with timer.stage("fetch"):
+            payload = build_perplexity_payload(query_obj)
+            data = response_cache.get_or_fetch(payload, fetch)
+    except Exception as e:
+        timer.from_cache = False
+        record_ingestion_run(query_obj, timer, "failed", error=repr(e))
+        raise
 
-        print("Raw content:", content)
+    results = ingest_perplexity_response(query_obj, data, timer=timer)
+    if not results:
+        # Don't keep serving a completion we could not use.
+        response_cache.invalidate(payload)
+    return results
+
+
+def stream_trends_from_perplexity(query_obj: TrendQuery, max_retries=None, timeout=None, client=None):
+    """
+    Streaming variant of fetch_trends_from_perplexity.
+
+    Each element of "results" is scored and saved as a provisional row as
+    soon as it is complete, so the detail page can show it while the rest
+    is still generating. When the stream ends the whole completion goes
+    through the normal ingestion, which replaces the provisional rows with
+    the final version in one transaction.
+    """
+    client = client or get_client()
+    timer = StageTimer(streamed=True)
+    with timer.stage("fetch"):
+        payload = build_perplexity_payload(query_obj)
+        cached = response_cache.get(response_cache.make_key(payload))
+    if cached is not None:
+        timer.streamed, timer.from_cache = False, True
+        return ingest_perplexity_response(query_obj, cached, timer=timer)
+
+    version = None
+    parser = ResultStreamParser()
+    call_info = {}
+    usage = None
+    started = time.perf_counter()
+    try:
+        # Provisional rows are scored and saved while streaming; that time
+        # is part of the fetch stage.
+        with timer.stage("fetch"):
+            for chunk in client.stream_completion(
+                    payload, timeout=timeout, max_attempts=max_retries, call_info=call_info):
+                usage = chunk.get("usage") or usage  # sent with the last chunk
+                for r in parser.feed(chunk_delta(chunk)):
+                    trend = provisional_result(query_obj, r)
+                    with transaction.atomic():
+                        if version is None:
+                            # Reserved in the transaction that writes its first
+                            # row, so the row exists before the lock is released.
+                            version = next_result_version(query_obj)
+                        trend.version = version
+                        trend.save()
+    except Exception as e:
+        timer.upstream = accounting.upstream_call_fields(
+            payload, call_info, (time.perf_counter() - started) * 1000, usage=usage, streamed=True)
+        logger.exception("Error streaming from Perplexity API")
+        if version is not None:
+            query_obj.results.filter(version=version, is_provisional=True).delete()
+        mark_query_failed(query_obj)
+        record_ingestion_run(query_obj, timer, "failed", error=repr(e))
+        raise
 
-        # Try direct JSON
-        try:
-            parsed = json.loads(content)
-        except Exception:
-            parsed = extract_json_from_text(content)
+    timer.upstream = accounting.upstream_call_fields(
+        payload, call_info, (time.perf_counter() - started) * 1000, usage=usage, streamed=True)
+    data = {"choices": [{"message": {"role": "assistant", "content": parser.text}}]}
+    results = ingest_perplexity_response(query_obj, data, version=version, timer=timer)
+    if results:
+        response_cache.set(response_cache.make_key(payload), data)
+    return results
 
-        if not parsed or "results" not in parsed:
-            logger.warning("No valid results in API response")
-            query_obj.status = "completed"
-            query_obj.save()
-            return []
 
-        from django.db.models import Max
+def mark_query_failed(query_obj: TrendQuery):
+    """
+    Record a failed fetch on query_obj.
+
+    Only a first fetch fails the query. A completed query keeps serving its
+    previous versions and must stay in the nightly refresh, so a failed
+    refresh leaves its status alone.
+    """
+    if query_obj.status != "completed":
+        query_obj.status = "failed"
+        query_obj.save()
+
+
+def next_result_version(query_obj: TrendQuery):
+    """
+    Allocate the next version number for query_obj's results.
+
+    The TrendQuery row is locked first, so two workers refreshing the same
+    query take turns. The lock is only held until the outermost transaction
+    ends: call it inside the transaction that writes the rows.
+    """
+    with transaction.atomic():
+        TrendQuery.objects.select_for_update().filter(pk=query_obj.pk).exists()
         latest_version = query_obj.results.aggregate(Max("version"))[
             "version__max"] or 0
-        new_version = latest_version + 1
+    return latest_version + 1
+
+
+RESULT_COPY_FIELDS = (
+    "topic", "summary", "sources", "engagement_score", "freshness_score", "relevance_score",
+    "final_score", "suggested_angles", "embedding", "embedding_model", "newest_source_at",
+)
+
+
+def copy_result_version(source_query: TrendQuery, version, targets):
+    """
+    Store source_query's results of `version` as the next version of each
+    target query, one bulk INSERT per target. Returns {target.id: version}.
+    """
+    rows = list(source_query.results.filter(version=version, is_provisional=False))
+    versions = {}
+    for target in targets:
+        with transaction.atomic():
+            new_version = next_result_version(target)
+            TrendResult.objects.bulk_create([
+                TrendResult(query=target, version=new_version,
+                            **{field: getattr(row, field) for field in RESULT_COPY_FIELDS})
+                for row in rows
+            ])
+            target.save(update_fields=["updated_at"])
+        versions[target.id] = new_version
+    return versions
+
+
+def score_result(query_obj: TrendQuery, r, relevance=None):
+    sources = r.get("sources", {})
+    engagement_score = r.get("engagement")
+    freshness_score = r.get("freshness")
+    relevance_score = r.get("relevance")
+
+    if engagement_score is None:
+        engagement_score = compute_engagement_from_sources(sources)
+
+    if freshness_score is None:
+        freshness_score = compute_freshness_from_sources(
+            sources, query_obj.created_at)
+
+    if relevance_score is None:
+        relevance_score = relevance
+
+    return float(engagement_score), float(freshness_score), float(relevance_score)
+
+
+def provisional_result(query_obj: TrendQuery, r):
+    """An unsaved, scored provisional TrendResult for one streamed result; the caller sets its version."""
+    engagement_score, freshness_score, relevance_score = score_result(
+        query_obj, r, relevance=compute_relevance(
+            query_obj, r.get("topic", ""), r.get("summary", "")))
+
+    trend = TrendResult(
+        query=query_obj,
+        topic=r.get("topic", "Untitled"),
+        summary=r.get("summary", ""),
+        sources=r.get("sources", {}),
+        engagement_score=engagement_score,
+        freshness_score=freshness_score,
+        relevance_score=relevance_score,
+        suggested_angles=r.get("suggested_angles") or r.get("angles") or [],
+        is_provisional=True,
+        newest_source_at=scoring.newest_source_dates(
+            scoring.build_columns([r], query_obj.created_at))[0],
+    )
+    trend.calculate_final_score()
+    return trend
+
+
+def ingest_perplexity_response(query_obj: TrendQuery, data, version=None, timer=None):
+    """
+    Parse, score and persist one completion body as a new version of
+    query_obj. `version` is passed when provisional rows were already
+    streamed for it; they are replaced by the final rows. Stage timings go
+    to `timer` (a fresh StageTimer if none) and are recorded as an
+    IngestionRun.
+    """
+    timer = timer or StageTimer()
+    new_version = None
+    try:
+        with timer.stage("parse"):
+            content = (
+                data.get("choices", [{}])[0]
+                .get("message", {})
+                .get("content", "")
+            ).strip()
 
-        for r in parsed["results"]:
-            sources = r.get("sources", {})
-            engagement_score = r.get("engagement")
-            freshness_score = r.get("freshness")
-            relevance_score = r.get("relevance")
+            logger.debug(f"Raw content for query {query_obj.id}: {content}")
 
-            if engagement_score is None:
-                engagement_score = compute_engagement_from_sources(sources)
+            # Try direct JSON
+            try:
+                parsed = json.loads(content)
+            except Exception:
+                parsed = extract_json_from_text(content)
 
-            if freshness_score is None:
-                freshness_score = compute_freshness_from_sources(
-                    sources, query_obj.created_at)
+        if not parsed or "results" not in parsed:
+            logger.warning("No valid results in API response")
+            with timer.stage("persist"):
+                if version is not None:
+                    query_obj.results.filter(version=version, is_provisional=True).delete()
+                query_obj.status = "completed"
+                query_obj.save()
+            record_ingestion_run(query_obj, timer, "empty")
+            return []
 
-            if relevance_score is None:
-                relevance_score = compute_relevance(
-                    query_obj, r.get("topic", ""), r.get("summary", ""))
+        results = parsed["results"]
+        trend_texts = [(r.get("topic", ""), r.get("summary", "")) for r in results]
+        with timer.stage("embed"):
+            trend_vectors = embed_trends(trend_texts)
+            model_name = embeddings.get_model_name()
+
+        with timer.stage("score"):
+            computed_relevance = compute_relevance_batch(
+                query_obj, trend_texts, trend_vectors=trend_vectors)
+            columns = scoring.build_columns(results, query_obj.created_at)
+            engagement, freshness, relevance, final = scoring.score_columns(columns, computed_relevance)
+            newest_source_at = scoring.newest_source_dates(columns)
+
+            trends = []
+            for i, r in enumerate(results):
+                trend = TrendResult(
+                    query=query_obj,
+                    topic=r.get("topic", "Untitled"),
+                    summary=r.get("summary", ""),
+                    sources=r.get("sources", {}),
+                    engagement_score=float(engagement[i]),
+                    freshness_score=float(freshness[i]),
+                    relevance_score=float(relevance[i]),
+                    final_score=float(final[i]),
+                    newest_source_at=newest_source_at[i],
+                    suggested_angles=r.get(
+                        "suggested_angles") or r.get("angles") or [],
+                )
+                trend.set_embedding(trend_vectors[i], model_name)
+                trends.append(trend)
+
+        with timer.stage("persist"):
+            # The whole version lands at once or not at all.
+            with transaction.atomic():
+                new_version = version or next_result_version(query_obj)
+                query_obj.results.filter(version=new_version, is_provisional=True).delete()
+                for trend in trends:
+                    trend.version = new_version
+                TrendResult.objects.bulk_create(trends)
 
             logger.info(
-                f"Preparing trend result for query {query_obj.id}, version {new_version}: {r.get('topic')}")
-
-            trend = TrendResult.objects.create(
-                query=query_obj,
-                topic=r.get("topic", "Untitled"),
-                summary=r.get("summary", ""),
-                sources=sources,
-                engagement_score=float(engagement_score),
-                freshness_score=float(freshness_score),
-                relevance_score=float(relevance_score),
-                suggested_angles=r.get(
-                    "suggested_angles") or r.get("angles") or [],
-                version=new_version,
-            )
-            trend.calculate_final_score()
-            trend.save()
-
-        logger.info(
-            f"✅ Saved {query_obj.results.filter(version=new_version).count()} results for query {query_obj.id} (v{new_version})")
-
-        query_obj.status = "completed"
-        query_obj.save()
+                f"✅ Saved {len(trends)} results for query {query_obj.id} (v{new_version})")
+
+            query_obj.status = "completed"
+            query_obj.save()
+
+        record_ingestion_run(
+            query_obj, timer, "completed", version=new_version, result_count=len(trends))
         return parsed["results"]
 
     except Exception as e:
         logger.exception("Error calling Perplexity API")
-        query_obj.status = "failed"
-        query_obj.save()
+        mark_query_failed(query_obj)
+        record_ingestion_run(query_obj, timer, "failed", error=repr(e))
         raise
+
+
+async def fetch_trends_concurrently(query_ids, concurrency=None, client=None):
+    """
+    Fetch many TrendQuery rows from one process with up to `concurrency`
+    Perplexity requests in flight.
+
+    Only the HTTP calls run on the event loop. Loading the query, parsing,
+    scoring and persistence go through sync_to_async (thread sensitive), so
+    the ORM and the embedding model are only ever used from one thread.
+    Returns {query_id: results list or the exception raised for it}.
+    """
+    from asgiref.sync import sync_to_async
+    from .perplexity import AsyncPerplexityClient
+
+    concurrency = concurrency or getattr(settings, "PERPLEXITY_MAX_CONCURRENCY", 8)
+    semaphore = asyncio.Semaphore(concurrency)
+    own_client = client is None
+    client = client or AsyncPerplexityClient(pool_maxsize=concurrency)
+
+    def mark_failed(query_obj, timer, error):
+        mark_query_failed(query_obj)
+        record_ingestion_run(query_obj, timer, "failed", error=repr(error))
+
+    async def fetch_one(query_id):
+        query_obj = await sync_to_async(TrendQuery.objects.get)(id=query_id)
+        timer = StageTimer()
+        timer.from_cache = True
+
+        async def fetch():
+            timer.from_cache = False
+            call_info = {}
+            data = None
+            started = time.perf_counter()
+            try:
+                async with semaphore:
+                    started = time.perf_counter()
+                    resp = await client.create_completion(payload, call_info=call_info)
+                data = resp.json()
+                return data
+            finally:
+                timer.upstream = accounting.upstream_call_fields(
+                    payload, call_info, (time.perf_counter() - started) * 1000, data=data)
+
+        try:
+            # Includes time spent waiting for a free slot under the semaphore.
+            with timer.stage("fetch"):
+                payload = build_perplexity_payload(query_obj)
+                data = await response_cache.aget_or_fetch(payload, fetch)
+        except Exception as e:
+            logger.exception(f"Error calling Perplexity API for query {query_id}")
+            timer.from_cache = False
+            await sync_to_async(mark_failed)(query_obj, timer, e)
+            raise
+        results = await sync_to_async(ingest_perplexity_response)(query_obj, data, timer=timer)
+        if not results:
+            await sync_to_async(response_cache.invalidate, thread_sensitive=False)(payload)
+        return results
+
+    try:
+        outcomes = await asyncio.gather(
+            *(fetch_one(query_id) for query_id in query_ids), return_exceptions=True)
+    finally:
+        if own_client:
+            await client.aclose()
+    return dict(zip(query_ids, outcomes))
@@ -0,0 +1,113 @@
+import json
+import logging
+import re
+
+from .json_extract import repair_json
+
+logger = logging.getLogger(__name__)
+
+RESULTS_KEY_RE = re.compile(r'"results"\s*:\s*\[')
+
+
+def iter_sse_chunks(lines):
+    """Decode the `data:` events of a server-sent event stream into dicts."""
+    for line in lines:
+        if not line or line.startswith(":"):
+            continue
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        try:
+            yield json.loads(data)
+        except ValueError:
+            logger.warning(f"Skipping malformed stream event: {data[:200]}")
+
+
+def chunk_delta(chunk):
+    choice = (chunk.get("choices") or [{}])[0]
+    return (choice.get("delta") or {}).get("content") or ""
+
+
+class ResultStreamParser:
+    """
+    Pull finished elements of the top-level "results" array out of JSON text
+    that arrives in pieces.
+
+    feed() returns the result dicts completed by the new text. Every
+    character is looked at once: strings, escapes and nesting depth are
+    tracked so braces inside summaries or nested "sources" objects do not
+    end an element early.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.in_array = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.element_start = None
+        self.count = 0
+
+    def feed(self, delta):
+        self.text += delta
+        finished = []
+        if self.done:
+            return finished
+
+        if not self.in_array:
+            # Re-scan a little of the old text in case the key was split.
+            match = RESULTS_KEY_RE.search(self.text, max(0, self.pos - 16))
+            if not match:
+                self.pos = len(self.text)
+                return finished
+            self.in_array = True
+            self.pos = match.end()
+
+        text = self.text
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                if self.depth == 0 and ch == "{":
+                    self.element_start = i
+                self.depth += 1
+            elif ch in "}]":
+                if self.depth == 0 and ch == "]":
+                    self.done = True
+                    self.pos = i + 1
+                    return finished
+                self.depth -= 1
+                if self.depth == 0 and self.element_start is not None:
+                    result = self._load(text[self.element_start:i + 1])
+                    self.element_start = None
+                    if result is not None:
+                        finished.append(result)
+
+        self.pos = len(text)
+        return finished
+
+    def _load(self, element):
+        for candidate in (element, repair_json(element)):
+            try:
+                result = json.loads(candidate)
+            except ValueError:
+                continue
+            if isinstance(result, dict):
+                self.count += 1
+                return result
+        logger.warning(f"Could not parse streamed result: {element[:200]}")
+        return None
@@ -1,9 +1,24 @@
-from .services import fetch_trends_from_perplexity
-from celery import shared_task
-from .models import TrendQuery, TrendResult, QuerySubscription
+import asyncio
+import math
+import random
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from .services import copy_result_version, fetch_trends_from_perplexity, fetch_trends_concurrently
+from .query_builder import query_fingerprint
+from .embeddings import query_embedding_cache
+from .scoring import rank_results
+from .accounting import total_cost
+from .ratelimit import BATCH, traffic_class
+from .resilience import CacheSemaphore
+from celery import chord, shared_task
+from django.conf import settings
+from .models import EmailOutbox, TrendQuery, TrendResult, QuerySubscription, User
 import logging
 from django.utils.timezone import now
-from .email_utils import send_trend_email
+from .email_utils import (
+    build_digest_email, build_trend_email, cached_results_block, enqueue_emails, outbox_message, send_email_batch)
+from django.db import transaction
 from django.db.models import Max
 
 logger = logging.getLogger(__name__)
@@ -43,38 +58,388 @@ def process_trend_query(self, query_id):
         raise e
 
 
+@shared_task
+def fetch_trend_queries_concurrently(query_ids, concurrency=None):
+    """Fetch several queries from one worker process over asyncio."""
+    TrendQuery.objects.filter(id__in=query_ids, status="pending").update(status="running")
+
+    outcomes = asyncio.run(fetch_trends_concurrently(query_ids, concurrency=concurrency))
+
+    failed = [str(qid) for qid, outcome in outcomes.items() if isinstance(outcome, Exception)]
+    for qid in failed:
+        logger.error(f"Error processing query {qid}: {outcomes[qid]}")
+    logger.info(f"Fetched {len(outcomes) - len(failed)}/{len(outcomes)} queries concurrently")
+    return {"fetched": len(outcomes) - len(failed), "failed": failed}
+
+
+REFRESH_INGEST_ALLOWANCE = 5 * 60  # seconds for parsing, embedding, copies and queueing emails
+
+
+def refresh_slot_timeout():
+    """
+    TREND_REFRESH_SLOT_TIMEOUT, or else the longest a refresh can
+    legitimately hold its slot: every Perplexity attempt waiting out the
+    rate limiter, the connect and read timeouts and a capped Retry-After,
+    plus time to ingest the result.
+    """
+    timeout = getattr(settings, "TREND_REFRESH_SLOT_TIMEOUT", None)
+    if timeout:
+        return timeout
+    per_attempt = (
+        getattr(settings, "PERPLEXITY_RATE_LIMIT_MAX_WAIT", 60)
+        + getattr(settings, "PERPLEXITY_CONNECT_TIMEOUT", 5)
+        + getattr(settings, "PERPLEXITY_READ_TIMEOUT", 120)
+        + getattr(settings, "PERPLEXITY_RETRY_AFTER_MAX", 120)
+    )
+    return math.ceil(getattr(settings, "PERPLEXITY_MAX_ATTEMPTS", 3) * per_attempt) + REFRESH_INGEST_ALLOWANCE
+
+
+def refresh_slots():
+    return CacheSemaphore(
+        "refresh",
+        limit=getattr(settings, "TREND_REFRESH_CONCURRENCY", 4),
+        timeout=refresh_slot_timeout(),
+    )
+
+
 @shared_task
 def refresh_trend_queries():
+    """
+    Beat entry point. Active completed queries are grouped by their
+    normalized parameters (query_fingerprint); one refresh_trend_query per
+    group is enqueued, with a summarize_refresh callback once they have
+    all finished.
+    """
     logger.info("Running refresh_trend_queries task...")
-    active_query_ids = QuerySubscription.objects.filter(is_active=True).values_list("query_id", flat=True).distinct()
-    queries = TrendQuery.objects.filter(id__in=active_query_ids, status="completed").distinct()
+    started_at = now()
+    rows = (
+        TrendQuery.objects.filter(status="completed", subscriptions__is_active=True)
+        .order_by("-created_at")
+        .values_list("id", "industry", "region", "persona", "date_range")
+        .distinct()
+        .iterator(chunk_size=500)
+    )
+    groups = {}
+    for query_id, *params in rows:
+        groups.setdefault(query_fingerprint(*params), []).append(str(query_id))
+    if not groups:
+        logger.info("No active queries to refresh")
+        return 0
 
-    for query in queries:
-        try:
-            logger.info(f"Refreshing query {query.id} ({query.industry})")
-            fetch_trends_from_perplexity(query)
+    # The newest query of each group leads: it is fetched, the rest get copies.
+    header = [refresh_trend_query.s(ids[0], ids[1:]) for ids in groups.values()]
+    # Digests go out even if a refresh crashes and the chord never reaches its callback.
+    callback = summarize_refresh.s(started_at.isoformat()).on_error(send_trend_digests.si(started_at.isoformat()))
+    chord(header)(callback)
+    logger.info(f"Dispatched refresh of {sum(map(len, groups.values()))} queries in {len(groups)} groups")
+    return len(groups)
+
+
+def subscriber_emails(query, version):
+    """send_trend_email_batch items for everyone subscribed to immediate emails about `query`."""
+    user_ids = QuerySubscription.objects.filter(
+        query=query, wants_emails=True, is_active=True, delivery="immediate").values_list("user_id", flat=True)
+    return [
+        {"user_id": str(user_id), "query_id": str(query.id), "version": version,
+         "subject": f"Your trends have been refreshed (v{version})"}
+        for user_id in user_ids
+    ]
+
+
+def queue_trend_emails(items):
+    """Split email items into TREND_EMAIL_BATCH_SIZE batches and enqueue them; returns len(items)."""
+    size = getattr(settings, "TREND_EMAIL_BATCH_SIZE", 100)
+    for start in range(0, len(items), size):
+        send_trend_email_batch.delay(items[start:start + size])
+    return len(items)
+
+
+@shared_task(acks_late=True)
+def send_trend_email_batch(items):
+    """
+    Render a batch of trend emails ({"user_id", "query_id", "version",
+    "subject"} items) into the email outbox. The results part of the body
+    is rendered once per (query, version) and cached.
+    """
+    users = {str(u.id): u for u in User.objects.filter(id__in={item["user_id"] for item in items})}
+    queries = {str(q.id): q for q in TrendQuery.objects.filter(id__in={item["query_id"] for item in items})}
+
+    blocks = {}
+    messages = []
+    for item in items:
+        user, query = users.get(item["user_id"]), queries.get(item["query_id"])
+        if user is None or query is None:
+            logger.warning(f"Dropping email for user {item['user_id']} query {item['query_id']}: not found")
+            continue
+        key = (item["query_id"], item["version"])
+        if key not in blocks:
+            blocks[key] = cached_results_block(query, item["version"], rank_results(TrendResult.objects.filter(
+                query=query, version=item["version"])))
+        messages.append(build_trend_email(
+            user, query, item["version"], subject=item.get("subject"), blocks=blocks[key]))
+
+    return enqueue_and_dispatch(messages, "trend")
+
+
+def enqueue_and_dispatch(messages, kind):
+    """Write `messages` to the outbox and wake the dispatcher once they are committed."""
+    if not messages:
+        return {"queued": 0}
+    with transaction.atomic():
+        rows = enqueue_emails(messages, kind)
+        transaction.on_commit(dispatch_email_outbox.delay, robust=True)
+    logger.info(f"Queued {len(rows)} {kind} emails in the outbox")
+    return {"queued": len(rows)}
+
+
+def send_outbox_rows(rows):
+    """
+    Send claimed outbox rows over one connection and record each outcome:
+    sent, due again after backoff, or failed for good after
+    EMAIL_OUTBOX_MAX_ATTEMPTS attempts. Finished rows drop their bodies,
+    which may hold a signup code.
+    """
+    failures = dict(send_email_batch([outbox_message(row) for row in rows]))
+    max_attempts = getattr(settings, "EMAIL_OUTBOX_MAX_ATTEMPTS", 5)
+    backoff = getattr(settings, "EMAIL_OUTBOX_BACKOFF", 60)
+    sent_at = now()
+    counts = {"sent": 0, "retrying": 0, "failed": 0}
+    for i, row in enumerate(rows):
+        row.attempts += 1
+        if i not in failures:
+            row.status, row.sent_at, row.last_error = "sent", sent_at, ""
+            row.body_text = row.body_html = ""
+            counts["sent"] += 1
+            continue
+        row.last_error = str(failures[i])[:2000]
+        if row.attempts >= max_attempts:
+            row.status = "failed"
+            row.body_text = row.body_html = ""
+            counts["failed"] += 1
+            logger.error(f"Giving up on {row.kind} email {row.id} to {row.to_email}: {row.last_error}")
+        else:
+            row.next_attempt_at = sent_at + timedelta(seconds=backoff * 2 ** (row.attempts - 1))
+            counts["retrying"] += 1
+            logger.warning(f"{row.kind} email {row.id} to {row.to_email} failed, retry {row.attempts}: "
+                           f"{row.last_error}")
+    EmailOutbox.objects.bulk_update(
+        rows, ["status", "attempts", "next_attempt_at", "last_error", "sent_at", "body_text", "body_html"])
+    return counts
+
+
+@shared_task
+def dispatch_email_outbox():
+    """
+    Drain the email outbox. Each batch claims up to EMAIL_OUTBOX_BATCH_SIZE
+    due rows with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent
+    dispatchers never send the same row, and sends them over one
+    connection before committing the outcome.
+    """
+    size = getattr(settings, "EMAIL_OUTBOX_BATCH_SIZE", 100)
+    totals = {"sent": 0, "retrying": 0, "failed": 0}
+    while True:
+        with transaction.atomic():
+            rows = list(
+                EmailOutbox.objects.select_for_update(skip_locked=True)
+                .filter(status="pending", next_attempt_at__lte=now())
+                .order_by("next_attempt_at")[:size]
+            )
+            if rows:
+                for key, count in send_outbox_rows(rows).items():
+                    totals[key] += count
+        if len(rows) < size:
+            break
+    if any(totals.values()):
+        logger.info(f"Email outbox dispatch: {totals}")
+    return totals
 
-            latest_version = query.results.aggregate(Max("version"))["version__max"]
-            if not latest_version:
-                logger.warning(f"No results for query {query.id} after refresh")
+
+@shared_task
+def purge_email_outbox():
+    """Delete outbox rows sent more than EMAIL_OUTBOX_RETENTION_DAYS ago; returns how many."""
+    days = getattr(settings, "EMAIL_OUTBOX_RETENTION_DAYS", 7)
+    deleted, _ = EmailOutbox.objects.filter(status="sent", sent_at__lt=now() - timedelta(days=days)).delete()
+    if deleted:
+        logger.info(f"Purged {deleted} sent emails from the outbox")
+    return deleted
+
+
+def digest_versions(since):
+    """
+    (user_id, query_id, version) rows: the newest version written since
+    `since` of every query with an active digest subscription, per
+    subscriber, ordered by user. One grouped query for all users.
+    """
+    return (
+        TrendResult.objects.filter(
+            created_at__gte=since,
+            is_provisional=False,
+            query__subscriptions__delivery="digest",
+            query__subscriptions__wants_emails=True,
+            query__subscriptions__is_active=True,
+        )
+        .values_list("query__subscriptions__user_id", "query_id")
+        .annotate(version=Max("version"))
+        .order_by("query__subscriptions__user_id", "query_id")
+    )
+
+
+@shared_task
+def send_trend_digests(since):
+    """
+    Close a refresh window: queue one digest email per digest subscriber
+    covering every query that got a new version since `since`, in
+    TREND_EMAIL_BATCH_SIZE batches of users.
+    """
+    size = getattr(settings, "TREND_EMAIL_BATCH_SIZE", 100)
+    rows = digest_versions(datetime.fromisoformat(since)).iterator(chunk_size=2000)
+
+    batch, users, sections = [], 0, 0
+    for user_id, user_rows in groupby(rows, key=itemgetter(0)):
+        digest = {"user_id": str(user_id),
+                  "sections": [[str(query_id), version] for _, query_id, version in user_rows]}
+        batch.append(digest)
+        users += 1
+        sections += len(digest["sections"])
+        if len(batch) == size:
+            send_digest_batch.delay(batch)
+            batch = []
+    if batch:
+        send_digest_batch.delay(batch)
+
+    logger.info(f"Queued digests for {users} users covering {sections} refreshed query versions")
+    return {"users": users, "sections": sections}
+
+
+@shared_task(acks_late=True)
+def send_digest_batch(digests):
+    """
+    Render digest emails ({"user_id", "sections": [[query_id, version], ...]})
+    into the email outbox, reusing the cached results block of each query
+    version.
+    """
+    users = {str(u.id): u for u in User.objects.filter(id__in={d["user_id"] for d in digests})}
+    queries = {str(q.id): q for q in TrendQuery.objects.filter(
+        id__in={query_id for d in digests for query_id, _ in d["sections"]})}
+
+    blocks = {}
+    messages = []
+    for digest in digests:
+        user = users.get(digest["user_id"])
+        sections = []
+        for query_id, version in digest["sections"]:
+            query = queries.get(query_id)
+            if query is None:
                 continue
+            if (query_id, version) not in blocks:
+                blocks[(query_id, version)] = cached_results_block(query, version, rank_results(
+                    TrendResult.objects.filter(query=query, version=version)))
+            sections.append({"query": query, "version": version, "blocks": blocks[(query_id, version)]})
+        if user is None or not sections:
+            logger.warning(f"Dropping digest for user {digest['user_id']}: user or queries not found")
+            continue
+        messages.append(build_digest_email(user, sections))
+
+    return enqueue_and_dispatch(messages, "digest")
+
 
-            results = TrendResult.objects.filter(
-                query=query, version=latest_version).order_by("-final_score")
-            
-            subscriptions_to_email = QuerySubscription.objects.filter(query=query, wants_emails=True, is_active=True).select_related("user")
-
-            for sub in subscriptions_to_email:
-                user = sub.user
-                send_trend_email(
-                    user=user,
-                    query=query,
-                    version=latest_version,
-                    results=results,
-                    subject=f"Your trends have been refreshed (v{latest_version})",
-                )
-                logger.info(
-                    f"Email sent to {user.email} for query {query.id} (v{latest_version})"
-                )
+@shared_task(bind=True, acks_late=True)
+def refresh_trend_query(self, query_id, member_ids=None, failures=0, waits=0):
+    """
+    Refresh one group of queries with identical parameters: fetch and
+    score once for `query_id`, copy the new version to every query in
+    `member_ids`, then queue emails to each query's subscribers.
+
+    Holds one of the TREND_REFRESH_CONCURRENCY slots while running; without
+    a free slot the task is re-queued, backing off up to
+    TREND_REFRESH_SLOT_WAIT_MAX seconds, without counting as a failure. A
+    failed fetch is retried with backoff up to TREND_REFRESH_MAX_RETRIES
+    times.
+    """
+    member_ids = list(member_ids or [])
+    slots = refresh_slots()
+    slot = None
+    if slots.limit:
+        slot = slots.acquire(self.request.id)
+        if slot is None:
+            wait_max = getattr(settings, "TREND_REFRESH_SLOT_WAIT_MAX", 300)
+            raise self.retry(
+                countdown=random.uniform(0.5, 1.0) * min(wait_max, 10 * 2 ** waits), max_retries=None,
+                args=(query_id, member_ids), kwargs={"failures": failures, "waits": waits + 1})
+
+    try:
+        order = [query_id, *member_ids]
+        group = TrendQuery.objects.filter(id__in=order)
+        if not failures:
+            # A retry reloads the group as dispatched, whatever a failed fetch set the leader's status to.
+            group = group.filter(status="completed")
+        found = {str(q.id): q for q in group}
+        queries = [found[qid] for qid in order if qid in found]
+        if not queries:
+            return {"query_id": query_id, "status": "skipped", "emails": 0, "calls_saved": 0}
+        query, members = queries[0], queries[1:]
+        outcome = {"query_id": query_id, "emails": 0, "calls_saved": 0}
+
+        previous_version = query.results.aggregate(Max("version"))["version__max"]
+        try:
+            logger.info(f"Refreshing query {query.id} ({query.industry}) for {len(queries)} queries")
+            with traffic_class(BATCH):
+                fetch_trends_from_perplexity(query)
         except Exception as e:
-            print(f"Failed to refresh query {query.id}: {e}")
+            # Ingestion marks a query failed; a refreshed query still has its
+            # previous versions and must stay in the nightly refresh.
+            TrendQuery.objects.filter(pk=query.pk, status="failed").update(status="completed")
+            max_retries = getattr(settings, "TREND_REFRESH_MAX_RETRIES", 3)
+            if failures < max_retries:
+                countdown = 60 * 2 ** failures
+                logger.warning(
+                    f"Refresh of query {query_id} failed ({e}), retry {failures + 1}/{max_retries} in {countdown}s")
+                raise self.retry(
+                    exc=e, countdown=countdown, max_retries=None,
+                    args=(query_id, member_ids), kwargs={"failures": failures + 1, "waits": waits})
+            logger.error(f"Failed to refresh query {query_id} after {failures + 1} attempts: {e}")
+            return {**outcome, "status": "failed", "error": str(e)}
+
+        latest_version = query.results.aggregate(Max("version"))["version__max"]
+        if not latest_version or latest_version == previous_version:
+            logger.warning(f"No results for query {query.id} after refresh")
+            return {**outcome, "status": "empty"}
+
+        try:
+            versions = {query.id: latest_version}
+            versions.update(copy_result_version(query, latest_version, members))
+            outcome["emails"] = queue_trend_emails(
+                [item for member in queries for item in subscriber_emails(member, versions[member.id])])
+        except Exception as e:
+            # Reported to summarize_refresh rather than raised, which would fail the whole chord.
+            logger.exception(f"Refreshed query {query_id} but could not copy or email v{latest_version}")
+            return {**outcome, "status": "failed", "version": latest_version, "error": str(e)}
+        # Members only saved a call if the leader's fetch actually reached them.
+        return {**outcome, "status": "refreshed", "version": latest_version, "calls_saved": len(members)}
+    finally:
+        if slot is not None:
+            slots.release(slot, self.request.id)
+
+
+@shared_task
+def summarize_refresh(outcomes, started_at):
+    counts = {}
+    for outcome in outcomes:
+        counts[outcome["status"]] = counts.get(outcome["status"], 0) + 1
+    emails = sum(outcome["emails"] for outcome in outcomes)
+    calls_saved = sum(outcome["calls_saved"] for outcome in outcomes)
+    failed = [outcome["query_id"] for outcome in outcomes if outcome["status"] == "failed"]
+
+    logger.info(
+        f"Refreshed {len(outcomes)} query groups: {counts}, {emails} emails queued, "
+        f"{calls_saved} upstream calls saved by sharing results within groups")
+    if failed:
+        logger.error(f"Refresh failed for queries: {', '.join(failed)}")
+    logger.info(f"Query embedding cache after refresh: {query_embedding_cache.stats()}")
+    spend = total_cost(since=datetime.fromisoformat(started_at))
+    logger.info(
+        f"Refresh made {spend['calls']} Perplexity calls, {spend['tokens'] or 0} tokens, ${spend['cost'] or 0}")
+    # Last, so a failure above leaves the digests to the chord's error callback alone.
+    send_trend_digests.delay(started_at)
+    return {"groups": len(outcomes), "statuses": counts, "emails": emails, "calls_saved": calls_saved,
+            "failed": failed}
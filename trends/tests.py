@@ -1,3 +1,1248 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import os
+import random
+import smtplib
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from asgiref.sync import sync_to_async
+from celery.exceptions import Retry
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.mail.backends import locmem
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from . import accounting, email_utils, embeddings, scoring, services, tasks
+from .json_extract import extract_json
+from .management.commands import backfill_embeddings, rescore_results
+from .mock_perplexity import MockPerplexityServer, completion_body, sample_results
+from .models import EmailOutbox, IngestionRun, QuerySubscription, SignUpOTP, TrendQuery, TrendResult, UpstreamCall
+from .perplexity import AsyncPerplexityClient, PerplexityClient
+from .ratelimit import RateLimiter, RateLimitExceeded, traffic_class
+from .resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from .response_cache import ResponseCache
+from .streaming import ResultStreamParser
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+PAYLOAD = {
+    "model": "sonar-pro",
+    "messages": [{"role": "user", "content": "test"}],
+    "temperature": 1.5,
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PerplexityClientTests(SimpleTestCase):
+    def setUp(self):
+        self.server = MockPerplexityServer().start()
+        self.addCleanup(self.server.stop)
+        self.client = PerplexityClient(api_key="test-key", api_url=self.server.url)
+        self.addCleanup(self.client.close)
+
+    def test_sequential_calls_reuse_one_connection(self):
+        for _ in range(5):
+            resp = self.client.post_completion(PAYLOAD)
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_timeouts_are_split_into_connect_and_read(self):
+        client = PerplexityClient(
+            api_key="test-key", api_url=self.server.url, connect_timeout=2, read_timeout=30)
+        self.addCleanup(client.close)
+        self.assertEqual(client.timeout, (2, 30))
+
+    def test_sends_bearer_token(self):
+        self.assertEqual(self.client.session.headers["Authorization"], "Bearer test-key")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PerplexityRetryTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker(name="test", failure_threshold=3, reset_timeout=60)
+
+    def make_client(self, server):
+        client = PerplexityClient(
+            api_key="test-key",
+            api_url=server.url,
+            retry_policy=RetryPolicy(max_attempts=3, base_delay=0, max_delay=0),
+            breaker=self.breaker,
+        )
+        self.addCleanup(client.close)
+        return client
+
+    def retries(self, reason):
+        return REGISTRY.get_sample_value(
+            "trendsage_perplexity_retries_total", {"reason": reason}) or 0
+
+    def test_retries_retryable_status_then_succeeds(self):
+        before = self.retries("503")
+        with MockPerplexityServer(faults=[503, 503]) as server:
+            resp = self.make_client(server).create_completion(PAYLOAD)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(self.retries("503") - before, 2)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+
+    def test_honours_retry_after(self):
+        policy = RetryPolicy(base_delay=0, max_delay=0)
+        with MockPerplexityServer(faults=[(429, {"Retry-After": "0"})]) as server:
+            client = self.make_client(server)
+            client.retry_policy = policy
+            resp = client.create_completion(PAYLOAD)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(policy.delay(0, retry_after=7), 7)
+
+    def test_retries_dropped_connections(self):
+        with MockPerplexityServer(faults=["reset"]) as server:
+            resp = self.make_client(server).create_completion(PAYLOAD)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_does_not_retry_client_errors(self):
+        with MockPerplexityServer(faults=[400]) as server:
+            with self.assertRaises(requests.HTTPError):
+                self.make_client(server).create_completion(PAYLOAD)
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+
+    def test_breaker_opens_after_consecutive_failures_and_fails_fast(self):
+        with MockPerplexityServer(faults=[503] * 3) as server:
+            client = self.make_client(server)
+            with self.assertRaises(requests.HTTPError):
+                client.create_completion(PAYLOAD)
+            self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+
+            with self.assertRaises(CircuitOpenError):
+                client.create_completion(PAYLOAD)
+
+        self.assertEqual(len(server.requests), 3)
+
+    def test_half_open_breaker_closes_after_successful_probe(self):
+        breaker = CircuitBreaker(name="probe", failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        cache.set(breaker.opened_until_key, 0, None)
+        self.assertEqual(breaker.state(), CircuitBreaker.HALF_OPEN)
+
+        self.breaker = breaker
+        with MockPerplexityServer() as server:
+            self.make_client(server).create_completion(PAYLOAD)
+
+        self.assertEqual(breaker.state(), CircuitBreaker.CLOSED)
+
+    def test_breaker_fails_open_when_the_cache_is_down(self):
+        class DownCache:
+            def __getattr__(self, name):
+                def fail(*args, **kwargs):
+                    raise ConnectionError("redis down")
+                return fail
+
+        with mock.patch.object(CircuitBreaker, "cache", new_callable=mock.PropertyMock, return_value=DownCache()), \
+                MockPerplexityServer(faults=[503, 503, 503, 503]) as server:
+            client = self.make_client(server)
+            with self.assertRaises(requests.HTTPError):
+                client.create_completion(PAYLOAD)
+            resp = client.create_completion(PAYLOAD)
+            self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(server.requests), 5)
+
+    def test_backoff_is_capped_and_jittered(self):
+        policy = RetryPolicy(base_delay=1, max_delay=4)
+        delays = [policy.delay(5) for _ in range(50)]
+        self.assertTrue(all(0 <= d <= 4 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+
+class FakeEmbeddingsMixin:
+    """Stand in for the sentence-transformer so ingestion runs without the model."""
+
+    def setUp(self):
+        super().setUp()
+        self.query = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days")
+
+        def fake_embed(trends, model_name=None, batch_size=32):
+            return np.ones((len(trends), 8), dtype=np.float32)
+
+        def fake_relevance(query_obj, trends, trend_vectors=None):
+            return [50.0] * len(trends)
+
+        for name, fake in (("embed_trends", fake_embed), ("compute_relevance_batch", fake_relevance)):
+            patcher = mock.patch.object(services, name, side_effect=fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IngestionPersistenceTests(FakeEmbeddingsMixin, TestCase):
+    def ingest(self, count):
+        body = completion_body(json.dumps({"results": sample_results(count)}), "sonar-pro")
+        with CaptureQueriesContext(connection) as ctx:
+            results = services.ingest_perplexity_response(self.query, body)
+        self.assertEqual(len(results), count)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_results(self):
+        self.assertEqual(self.ingest(1), self.ingest(25))
+        self.assertEqual(
+            list(self.query.results.order_by("version").values_list("version", flat=True).distinct()),
+            [1, 2])
+        self.assertEqual(self.query.results.filter(version=2).count(), 25)
+
+    def test_records_stage_timings_per_run(self):
+        with self.assertLogs("trends.instrumentation", "INFO") as logs:
+            self.ingest(3)
+
+        run = self.query.ingestion_runs.get()
+        self.assertEqual((run.status, run.version, run.result_count), ("completed", 1, 3))
+        self.assertGreater(run.total_ms, 0)
+        self.assertGreaterEqual(run.total_ms, run.parse_ms + run.embed_ms + run.score_ms + run.persist_ms)
+        self.assertEqual(logs.records[0].ingestion_run["result_count"], 3)
+
+    def test_failed_write_leaves_no_partial_version(self):
+        with mock.patch.object(services.TrendResult.objects, "bulk_create", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.ingest(3)
+        self.assertFalse(self.query.results.exists())
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, "failed")
+        self.assertEqual(self.query.ingestion_runs.get().status, "failed")
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PERPLEXITY_RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.responses = ResponseCache(timeout=60, lock_timeout=5, poll_interval=0.01)
+        self.fetch = mock.Mock(return_value={"choices": []})
+
+    def afetch(self, delay=0.0):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(delay)
+            return {"choices": []}
+        fetch.calls = calls
+        return fetch
+
+    def test_second_request_is_a_hit(self):
+        self.assertEqual(self.responses.get_or_fetch(PAYLOAD, self.fetch), {"choices": []})
+        self.assertEqual(self.responses.get_or_fetch(PAYLOAD, self.fetch), {"choices": []})
+        self.fetch.assert_called_once()
+        self.assertEqual(self.responses.stats(), {"hits": 1, "misses": 1, "coalesced": 0})
+
+    def test_entries_expire_after_the_ttl(self):
+        with mock.patch("time.time", return_value=1000.0):
+            self.responses.get_or_fetch(PAYLOAD, self.fetch)
+        with mock.patch("time.time", return_value=1059.0):
+            self.responses.get_or_fetch(PAYLOAD, self.fetch)
+        self.assertEqual(self.fetch.call_count, 1)
+        with mock.patch("time.time", return_value=1061.0):
+            self.responses.get_or_fetch(PAYLOAD, self.fetch)
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_concurrent_identical_requests_fetch_once(self):
+        release = threading.Event()
+
+        def slow_fetch():
+            release.wait(5)
+            return {"choices": ["once"]}
+
+        fetch = mock.Mock(side_effect=slow_fetch)
+        with ThreadPoolExecutor(6) as pool:
+            futures = [pool.submit(self.responses.get_or_fetch, PAYLOAD, fetch) for _ in range(6)]
+            time.sleep(0.1)
+            release.set()
+            results = [f.result() for f in futures]
+
+        fetch.assert_called_once()
+        self.assertEqual(results, [{"choices": ["once"]}] * 6)
+        self.assertEqual(self.responses.stats()["coalesced"], 5)
+
+    def test_waits_for_another_process_holding_the_lock(self):
+        key = self.responses.make_key(PAYLOAD)
+        cache.add(f"{key}:lock", 1, 5)
+
+        def other_process():
+            time.sleep(0.05)
+            self.responses.set(key, {"choices": ["theirs"]})
+            cache.delete(f"{key}:lock")
+
+        threading.Thread(target=other_process).start()
+        self.assertEqual(self.responses.get_or_fetch(PAYLOAD, self.fetch), {"choices": ["theirs"]})
+        self.fetch.assert_not_called()
+
+    def test_cache_outage_falls_back_to_upstream(self):
+        broken = mock.Mock(**{f"{name}.side_effect": ConnectionError("redis down")
+                              for name in ("get", "set", "add", "delete")})
+        with mock.patch.object(ResponseCache, "cache", new_callable=mock.PropertyMock, return_value=broken):
+            self.assertEqual(self.responses.get_or_fetch(PAYLOAD, self.fetch), {"choices": []})
+            self.responses.invalidate(PAYLOAD)
+            self.assertEqual(asyncio.run(self.responses.aget_or_fetch(PAYLOAD, self.afetch())), {"choices": []})
+
+    def test_concurrent_async_requests_fetch_once(self):
+        fetch = self.afetch(delay=0.05)
+
+        async def run():
+            return await asyncio.gather(*(self.responses.aget_or_fetch(PAYLOAD, fetch) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(run()), [{"choices": []}] * 5)
+        self.assertEqual(len(fetch.calls), 1)
+        self.assertEqual(self.responses.stats(), {"hits": 0, "misses": 1, "coalesced": 4})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, EMBEDDING_MODEL_NAME="model-a")
+class QueryEmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.encoded = []
+
+        def fake_model(name=None):
+            name = name or embeddings.get_model_name()
+
+            def encode(text):
+                self.encoded.append((name, text))
+                return np.full(4, len(self.encoded), dtype=np.float32)
+            return SimpleNamespace(encode=encode)
+
+        patcher = mock.patch.object(embeddings, "get_model", side_effect=fake_model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def query(self, industry):
+        return SimpleNamespace(industry=industry, region="India", persona="creator", date_range="last 7 days")
+
+    def test_memory_hits_store_hits_misses_and_eviction(self):
+        vectors = embeddings.QueryEmbeddingCache(max_entries=2)
+        first = vectors.get(self.query("fashion"), "fashion text")
+        vectors.get(self.query("gaming"), "gaming text")
+        vectors.get(self.query("food"), "food text")  # evicts fashion from the LRU
+
+        np.testing.assert_array_equal(vectors.get(self.query(" Fashion"), "fashion text"), first)  # shared cache
+        vectors.get(self.query("fashion"), "fashion text")  # back in the LRU
+
+        self.assertEqual(len(self.encoded), 3)
+        self.assertEqual(vectors.stats(), {
+            "memory_hits": 1, "store_hits": 1, "misses": 3, "hit_rate": 0.4, "entries": 2})
+
+    def test_changing_the_model_invalidates_cached_vectors(self):
+        vectors = embeddings.QueryEmbeddingCache()
+        before = vectors.get(self.query("fashion"), "fashion text")
+        with override_settings(EMBEDDING_MODEL_NAME="model-b"):
+            after = vectors.get(self.query("fashion"), "fashion text")
+
+        self.assertEqual([name for name, _ in self.encoded], ["model-a", "model-b"])
+        self.assertFalse(np.array_equal(before, after))
+        self.assertEqual(vectors.stats()["misses"], 2)
+
+
+class JsonExtractTests(SimpleTestCase):
+    def test_repairs_smart_quotes(self):
+        self.assertEqual(extract_json('{“results”: [{“topic”: “A”}]}'), {"results": [{"topic": "A"}]})
+
+    def test_drops_trailing_commas(self):
+        self.assertEqual(extract_json('{"results": [{"topic": "A",}, ],}'), {"results": [{"topic": "A"}]})
+
+    def test_strips_digit_separators(self):
+        self.assertEqual(extract_json('{"results": [{"views": 1_000_000}]}'), {"results": [{"views": 1000000}]})
+
+    def test_drops_a_doubled_closing_quote(self):
+        self.assertEqual(extract_json('{"results": [{"topic": "A"", "summary": "B""}]}'),
+                         {"results": [{"topic": "A", "summary": "B"}]})
+
+    def test_finds_the_object_inside_prose_and_a_code_fence(self):
+        text = 'Here are the trends:\n```json\n{"results": [{"topic": "A"}]}\n```\nHope this helps!'
+        self.assertEqual(extract_json(text), {"results": [{"topic": "A"}]})
+
+    def test_quotes_in_the_surrounding_prose_are_left_alone(self):
+        text = 'Note: the "best" option is 5" wide. {"results":[{"topic":"A"}]}'
+        self.assertEqual(extract_json(text), {"results": [{"topic": "A"}]})
+        self.assertEqual(extract_json('The “top” pick: {"results": []}'), {"results": []})
+
+    def test_citation_brackets_do_not_hide_the_results(self):
+        text = 'Sources [1] and [2] agree. {"results": [{"topic": "A [3]"}]} See also [4].'
+        self.assertEqual(extract_json(text), {"results": [{"topic": "A [3]"}]})
+
+    def test_bare_array_is_wrapped(self):
+        self.assertEqual(extract_json('Trends: [{"topic": "A"}]'), {"results": [{"topic": "A"}]})
+
+    def test_truncated_completion_returns_none(self):
+        self.assertIsNone(extract_json('{"results": [{"topic": "A"}, {"topic": "B'))
+
+
+class ResultStreamParserTests(SimpleTestCase):
+    def feed(self, text, size):
+        parser = ResultStreamParser()
+        results = []
+        for start in range(0, len(text), size):
+            results.extend(parser.feed(text[start:start + size]))
+        return results
+
+    def test_results_key_split_across_chunks(self):
+        parser = ResultStreamParser()
+        self.assertEqual(parser.feed('{"summary": "x", "res'), [])
+        self.assertEqual(parser.feed('ults"'), [])
+        self.assertEqual(parser.feed(' : [{"topic": "A"}, {"top'), [{"topic": "A"}])
+        self.assertEqual(parser.feed('ic": "B"}]}'), [{"topic": "B"}])
+        self.assertTrue(parser.done)
+
+    def test_braces_and_brackets_inside_strings(self):
+        text = json.dumps({"results": [
+            {"topic": "x}{", "summary": "a ] b [", "sources": {"urls": ["{]"]}},
+            {"topic": "second"},
+        ]})
+        for size in (1, 3, len(text)):
+            self.assertEqual([r["topic"] for r in self.feed(text, size)], ["x}{", "second"])
+
+    def test_escaped_quotes_and_backslashes(self):
+        text = json.dumps({"results": [
+            {"topic": 'say "hi" {', "summary": "ends with a backslash \\"},
+            {"topic": "next"},
+        ]})
+        for size in (1, 2, 5):
+            results = self.feed(text, size)
+            self.assertEqual([r["topic"] for r in results], ['say "hi" {', "next"])
+            self.assertEqual(results[0]["summary"], "ends with a backslash \\")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StreamedIngestionTests(FakeEmbeddingsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        patcher = mock.patch.object(services, "compute_relevance", return_value=50.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        text = json.dumps({"results": sample_results(3)})
+        self.chunks = [text[i:i + 40] for i in range(0, len(text), 40)]
+
+    def stream_client(self, chunks, error=None, on_chunk=None):
+        def stream_completion(payload, **kwargs):
+            for i, text in enumerate(chunks):
+                if on_chunk:
+                    on_chunk(i)
+                yield {"choices": [{"delta": {"content": text}}]}
+            if error:
+                raise error
+        return SimpleNamespace(stream_completion=stream_completion)
+
+    def test_provisional_rows_are_replaced_by_the_final_version(self):
+        seen = []
+        client = self.stream_client(self.chunks, on_chunk=lambda i: seen.append(
+            self.query.results.filter(is_provisional=True).count()))
+
+        results = services.stream_trends_from_perplexity(self.query, client=client)
+
+        self.assertEqual(len(results), 3)
+        self.assertGreater(max(seen), 0)  # rows were visible while streaming
+        self.assertEqual(self.query.results.filter(is_provisional=True).count(), 0)
+        self.assertEqual(list(self.query.results.values_list("version", flat=True)), [1, 1, 1])
+
+    def test_failed_stream_removes_its_provisional_rows(self):
+        client = self.stream_client(self.chunks[:-2], error=requests.ConnectionError("stream dropped"))
+        with self.assertRaises(requests.ConnectionError):
+            services.stream_trends_from_perplexity(self.query, client=client)
+
+        self.assertFalse(self.query.results.exists())
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, "failed")
+
+    def test_failed_refresh_stream_keeps_the_query_completed(self):
+        self.query.status = "completed"
+        self.query.save()
+        TrendResult.objects.create(query=self.query, version=1, topic="Done", summary="")
+        client = self.stream_client(self.chunks[:-2], error=requests.ConnectionError("stream dropped"))
+        with self.assertRaises(requests.ConnectionError):
+            services.stream_trends_from_perplexity(self.query, client=client)
+
+        self.assertEqual(list(self.query.results.values_list("topic", flat=True)), ["Done"])
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, "completed")
+
+    def test_version_is_not_shared_with_a_concurrent_writer(self):
+        def other_writer(i):
+            if i == 0:  # before the stream has produced a row
+                with transaction.atomic():
+                    TrendResult.objects.create(
+                        query=self.query, version=services.next_result_version(self.query), topic="Copied")
+
+        services.stream_trends_from_perplexity(self.query, client=self.stream_client(self.chunks, on_chunk=other_writer))
+
+        self.assertEqual(self.query.results.get(version=1).topic, "Copied")
+        self.assertEqual(self.query.results.filter(version=2).count(), 3)
+
+    def test_detail_page_flags_a_half_streamed_refresh(self):
+        from django.contrib.auth import get_user_model
+
+        user = get_user_model().objects.create_user(
+            email="viewer@example.com", password="x", first_name="V", last_name="U")
+        QuerySubscription.objects.create(user=user, query=self.query)
+        self.query.status = "completed"  # refreshes never mark the query running
+        self.query.save()
+        TrendResult.objects.create(query=self.query, version=1, topic="Done", summary="")
+        TrendResult.objects.create(query=self.query, version=2, topic="Half", summary="", is_provisional=True)
+
+        self.client.force_login(user)
+        response = self.client.get(reverse("query-detail-frontend", args=[self.query.id]))
+        self.assertEqual(response.context["version"], 2)
+        self.assertTrue(response.context["generating"])
+
+
+class VectorizedScoringTests(SimpleTestCase):
+    def random_results(self, n):
+        rng = random.Random(3)
+        now = timezone.now()
+        results = []
+        for i in range(n):
+            results.append({
+                "sources": {
+                    "urls": ["https://example.com"] * rng.randint(0, 7),
+                    "dates": [
+                        (now - timedelta(days=rng.randint(0, 40), hours=rng.randint(0, 23))).isoformat()
+                        for _ in range(rng.randint(0, 3))
+                    ] + (["not a date"] if i % 9 == 0 else []),
+                    "engagement": [
+                        {"likes": rng.randint(0, 150), "shares": rng.randint(0, 40), "comments": rng.randint(0, 30)}
+                        for _ in range(rng.randint(0, 3))
+                    ],
+                },
+            })
+            if i % 25 == 0:
+                results[-1]["freshness"] = 42.0
+        return results, [round(rng.uniform(0, 100), 2) for _ in range(n)]
+
+    def test_matches_scalar_functions(self):
+        query_obj = SimpleNamespace(created_at=timezone.now() - timedelta(days=3))
+        results, relevance = self.random_results(2000)
+
+        engagement, freshness, rel, final = scoring.score_results(results, query_obj.created_at, relevance)
+
+        for i, r in enumerate(results):
+            e, f, rv = services.score_result(query_obj, r, relevance=relevance[i])
+            row = TrendResult(engagement_score=e, freshness_score=f, relevance_score=rv)
+            self.assertEqual(
+                (e, f, rv, row.calculate_final_score()),
+                (engagement[i], freshness[i], rel[i], final[i]))
+
+    @override_settings(TREND_SCORE_WEIGHTS=(1.0, 0.0, 0.0), TREND_FRESHNESS_DECAY_DAYS=14)
+    def test_weights_and_decay_come_from_settings(self):
+        created_at = timezone.now() - timedelta(days=14, hours=1)
+        results = [{"sources": {"engagement": [{"likes": 20}]}}]
+
+        engagement, freshness, _, final = scoring.score_results(results, created_at, [90.0])
+
+        self.assertEqual(final[0], engagement[0])
+        self.assertEqual(freshness[0], round(100 * math.exp(-1), 2))
+
+    def test_round2_matches_builtin_round(self):
+        values = [0.125, 2.675, 33.915, 48.595, 41.395, 1.005, 99.995, 0.0]
+        self.assertEqual(scoring.round2(values).tolist(), [round(v, 2) for v in values])
+
+
+class LiveRankingTests(TestCase):
+    def setUp(self):
+        self.query = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days")
+        now = timezone.now()
+        self.stale = self.make_result("stale", engagement=60.0, newest_source_at=now - timedelta(days=30))
+        self.fresh = self.make_result("fresh", engagement=50.0, newest_source_at=now)
+
+    def make_result(self, topic, engagement, newest_source_at):
+        result = TrendResult(
+            query=self.query, topic=topic, summary="", engagement_score=engagement,
+            freshness_score=100.0, relevance_score=50.0, newest_source_at=newest_source_at)
+        result.calculate_final_score()
+        result.save()
+        return result
+
+    def topics(self, results):
+        return [r.topic for r in results]
+
+    def test_stored_ranking_by_default(self):
+        self.assertEqual(self.topics(scoring.rank_results(self.query.results.all())), ["stale", "fresh"])
+
+    @override_settings(TREND_LIVE_RANKING=True)
+    def test_live_ranking_decays_freshness_without_writes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            ranked = scoring.rank_results(self.query.results.all())
+
+        self.assertEqual(self.topics(ranked), ["fresh", "stale"])
+        self.assertEqual(ranked[1].freshness_score, round(100 * math.exp(-30 / 7), 2))
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.stale.refresh_from_db()
+        self.assertEqual(self.stale.freshness_score, 100.0)
+
+
+class MetricsEndpointTests(TestCase):
+    def test_requires_staff_or_token(self):
+        self.assertEqual(self.client.get("/metrics/").status_code, 302)
+
+        with override_settings(METRICS_TOKEN="scrape-secret"):
+            resp = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer scrape-secret")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 302)
+
+    def test_exports_request_histogram_to_staff(self):
+        from django.contrib.auth import get_user_model
+
+        staff = get_user_model().objects.create_user(
+            email="ops@example.com", password="x", first_name="Ops", last_name="Team", is_staff=True)
+        self.client.force_login(staff)
+        self.client.get("/metrics/")
+
+        body = self.client.get("/metrics/").content.decode()
+        self.assertIn('trendsage_http_request_duration_seconds_bucket{le="0.005",method="GET",route="metrics/"', body)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PERPLEXITY_STREAMING=False)
+class UpstreamAccountingTests(FakeEmbeddingsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def fetch(self, server):
+        client = PerplexityClient(
+            api_key="test-key", api_url=server.url,
+            retry_policy=RetryPolicy(max_attempts=2, base_delay=0, max_delay=0),
+            breaker=CircuitBreaker(name="accounting", failure_threshold=10))
+        self.addCleanup(client.close)
+        return services.fetch_trends_from_perplexity(self.query, client=client)
+
+    def test_records_usage_and_cost_per_upstream_call(self):
+        with MockPerplexityServer(result_count=3) as server:
+            self.fetch(server)
+            self.fetch(server)  # served by the response cache, not billed again
+
+        call = UpstreamCall.objects.get()
+        self.assertEqual((call.query, call.version, call.status_code, call.attempts), (self.query, 1, 200, 1))
+        self.assertEqual(call.prompt_tokens, 600)
+        self.assertGreater(call.completion_tokens, 0)
+        self.assertGreater(call.cost, 0)
+        self.assertEqual(accounting.cost_by_fingerprint().get()["calls"], 1)
+
+    def test_failed_call_is_recorded_without_cost(self):
+        with MockPerplexityServer(faults=[503, 503]) as server:
+            with self.assertRaises(requests.HTTPError):
+                self.fetch(server)
+
+        call = UpstreamCall.objects.get()
+        self.assertEqual((call.version, call.status_code, call.attempts, call.cost), (None, 503, 2, 0))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PERPLEXITY_RATE_LIMITS={}, PERPLEXITY_MAX_ATTEMPTS=1)
+class AsyncFetchTests(FakeEmbeddingsMixin, TransactionTestCase):
+    # The ORM work runs on sync_to_async's thread, which must see committed rows.
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.queries = [self.query] + [
+            TrendQuery.objects.create(industry=f"industry {i}", region="India", persona="creator",
+                                      date_range="last 7 days")
+            for i in range(5)]
+        self.ids = [str(q.id) for q in self.queries]
+
+    def fetch(self, server, concurrency):
+        async def run():
+            client = AsyncPerplexityClient(api_key="test-key", api_url=server.url, pool_maxsize=concurrency)
+            try:
+                return await services.fetch_trends_concurrently(self.ids, concurrency=concurrency, client=client)
+            finally:
+                await client.aclose()
+        return asyncio.run(run())
+
+    def test_requests_in_flight_are_bounded(self):
+        with MockPerplexityServer(latency=0.1, result_count=2) as server:
+            outcomes = self.fetch(server, concurrency=2)
+
+        self.assertEqual((len(server.requests), server.peak_in_flight), (6, 2))
+        self.assertTrue(all(len(outcomes[qid]) == 2 for qid in self.ids))
+        self.assertEqual(TrendResult.objects.filter(query__in=self.queries).count(), 12)
+        self.assertEqual(set(TrendQuery.objects.filter(id__in=self.ids).values_list("status", flat=True)),
+                         {"completed"})
+
+    def test_breaker_and_limiter_stay_off_the_event_loop(self):
+        threads = []
+
+        def record(*args, **kwargs):
+            threads.append(threading.get_ident())
+            return 0.0
+
+        with MockPerplexityServer(result_count=2) as server, \
+                mock.patch.object(RateLimiter, "reserve", side_effect=record), \
+                mock.patch.object(CircuitBreaker, "before_call", side_effect=record), \
+                mock.patch.object(CircuitBreaker, "record_success", side_effect=record):
+            self.fetch(server, concurrency=2)
+
+        self.assertEqual(len(threads), 18)
+        self.assertNotIn(threading.get_ident(), threads)  # asyncio.run's loop runs on this thread
+
+    def test_a_failed_query_does_not_sink_the_others(self):
+        with MockPerplexityServer(faults=[400], result_count=2) as server:
+            outcomes = self.fetch(server, concurrency=3)
+
+        failed = [qid for qid, outcome in outcomes.items() if isinstance(outcome, Exception)]
+        self.assertEqual(len(failed), 1)
+        statuses = dict(TrendQuery.objects.filter(id__in=self.ids).values_list("id", "status"))
+        self.assertEqual({str(qid): status for qid, status in statuses.items()},
+                         {qid: "failed" if qid in failed else "completed" for qid in self.ids})
+        self.assertEqual(IngestionRun.objects.get(status="failed").query_id, uuid.UUID(failed[0]))
+
+    def test_task_marks_queries_running_and_reports_failures(self):
+        seen = []
+        real_fetch = services.fetch_trends_concurrently
+
+        async def fetch(query_ids, concurrency=None):
+            seen.extend(await sync_to_async(list)(
+                TrendQuery.objects.filter(id__in=query_ids).values_list("status", flat=True)))
+            return await real_fetch(query_ids, concurrency=concurrency)
+
+        with MockPerplexityServer(faults=[400], result_count=2) as server, \
+                override_settings(PERPLEXITY_API_URL=server.url), \
+                mock.patch("trends.perplexity.PERPLEXITY_API_KEY", "test-key"), \
+                mock.patch.object(tasks, "fetch_trends_concurrently", side_effect=fetch):
+            summary = tasks.fetch_trend_queries_concurrently(self.ids, concurrency=3)
+
+        self.assertEqual(set(seen), {"running"})
+        self.assertEqual(summary["fetched"], 5)
+        [failed] = summary["failed"]
+        self.assertEqual(TrendQuery.objects.get(id=failed).status, "failed")
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TREND_REFRESH_MAX_RETRIES=2)
+class RefreshFanOutTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email="sub@example.com", password="x", first_name="Sub", last_name="Scriber")
+        self.query = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days", status="completed")
+        QuerySubscription.objects.create(user=self.user, query=self.query)
+
+    def test_dispatcher_enqueues_one_task_per_active_query(self):
+        inactive = TrendQuery.objects.create(
+            industry="food", region="US", persona="chef", date_range="last 7 days", status="completed")
+        QuerySubscription.objects.create(user=self.user, query=inactive, is_active=False)
+
+        with mock.patch.object(tasks, "chord") as chord:
+            self.assertEqual(tasks.refresh_trend_queries(), 1)
+
+        header = chord.call_args.args[0]
+        self.assertEqual([sig.args for sig in header], [(str(self.query.id), [])])
+        callback = chord.return_value.call_args.args[0]
+        [on_error] = callback.options["link_error"]
+        self.assertEqual((on_error["task"], on_error["immutable"]), (tasks.send_trend_digests.name, True))
+        self.assertEqual(on_error["args"], callback.args)
+
+    def test_copy_failure_is_reported_not_raised(self):
+        twin = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days", status="completed")
+
+        def fetch(query):
+            TrendResult.objects.create(query=query, version=1, topic="Fresh", summary="New")
+
+        with mock.patch.object(tasks, "fetch_trends_from_perplexity", side_effect=fetch), \
+                mock.patch.object(tasks, "copy_result_version", side_effect=RuntimeError("db gone")):
+            outcome = tasks.refresh_trend_query.apply(args=[str(self.query.id), [str(twin.id)]]).get()
+
+        self.assertEqual((outcome["status"], outcome["version"], outcome["error"]), ("failed", 1, "db gone"))
+        self.assertEqual(outcome["calls_saved"], 0)
+
+    def test_queries_with_identical_parameters_share_one_fetch(self):
+        twin = TrendQuery.objects.create(
+            industry=" Fashion", region="india", persona="Creator", date_range="last 7 days", status="completed")
+        QuerySubscription.objects.create(user=self.user, query=twin)
+        TrendResult.objects.create(query=twin, version=3, topic="Old", summary="Old")
+
+        with mock.patch.object(tasks, "chord") as chord:
+            self.assertEqual(tasks.refresh_trend_queries(), 1)
+        signature = chord.call_args.args[0][0]
+        self.assertEqual(signature.args, (str(twin.id), [str(self.query.id)]))
+
+        def fetch(query):
+            TrendResult.objects.create(query=query, version=4, topic="Fresh", summary="New", final_score=80)
+
+        with mock.patch.object(tasks, "fetch_trends_from_perplexity", side_effect=fetch) as fetched, \
+                mock.patch.object(tasks.send_trend_email_batch, "delay") as send:
+            outcome = tasks.refresh_trend_query.apply(args=signature.args).get()
+
+        fetched.assert_called_once()
+        self.assertEqual((outcome["status"], outcome["calls_saved"], outcome["emails"]), ("refreshed", 1, 2))
+        copied = self.query.results.get()
+        self.assertEqual((copied.version, copied.topic, copied.final_score), (1, "Fresh", 80))
+        self.assertEqual({item["version"] for item in send.call_args.args[0]}, {1, 4})
+
+    def test_failed_fetch_is_retried_then_reported(self):
+        with mock.patch.object(tasks, "fetch_trends_from_perplexity", side_effect=RuntimeError("down")) as fetch, \
+                mock.patch.object(tasks.random, "uniform", return_value=0):
+            outcome = tasks.refresh_trend_query.apply(args=[str(self.query.id)]).get()
+
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(outcome["status"], "failed")
+
+        started_at = timezone.now().isoformat()
+        with mock.patch.object(tasks.send_trend_digests, "delay") as digests:
+            summary = tasks.summarize_refresh([outcome], started_at)
+        self.assertEqual(summary["failed"], [str(self.query.id)])
+        digests.assert_called_once_with(started_at)
+
+    def test_fetch_that_marks_the_query_failed_is_still_retried(self):
+        attempts = []
+
+        def fetch(query):
+            attempts.append(query.id)
+            if len(attempts) == 1:
+                query.status = "failed"
+                query.save()
+                raise RuntimeError("stream cut")
+            TrendResult.objects.create(query=query, version=1, topic="Fresh", summary="New")
+
+        with mock.patch.object(tasks, "fetch_trends_from_perplexity", side_effect=fetch), \
+                mock.patch.object(tasks.send_trend_email_batch, "delay"), \
+                mock.patch.object(tasks.random, "uniform", return_value=0):
+            outcome = tasks.refresh_trend_query.apply(args=[str(self.query.id)]).get()
+
+        self.assertEqual((len(attempts), outcome["status"]), (2, "refreshed"))
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, "completed")
+
+    def test_query_stays_refreshable_after_retries_run_out(self):
+        def fetch(query):
+            query.status = "failed"
+            query.save()
+            raise RuntimeError("down")
+
+        with mock.patch.object(tasks, "fetch_trends_from_perplexity", side_effect=fetch) as fetched, \
+                mock.patch.object(tasks.random, "uniform", return_value=0):
+            outcome = tasks.refresh_trend_query.apply(args=[str(self.query.id)]).get()
+
+        self.assertEqual((fetched.call_count, outcome["status"], outcome["error"]), (3, "failed", "down"))
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, "completed")
+
+    def test_refresh_releases_its_slot(self):
+        slots = tasks.refresh_slots()
+        with mock.patch.object(tasks, "fetch_trends_from_perplexity"):
+            outcome = tasks.refresh_trend_query.apply(args=[str(self.query.id)]).get()
+
+        self.assertEqual(outcome["status"], "empty")
+        self.assertEqual([slots.acquire(f"holder-{i}") is not None for i in range(slots.limit + 1)],
+                         [True] * slots.limit + [False])
+
+    def test_waiting_for_a_slot_backs_off(self):
+        slots = tasks.refresh_slots()
+        for i in range(slots.limit):
+            slots.acquire(f"holder-{i}")
+
+        countdowns = []
+        for waits in (0, 3, 10):
+            with mock.patch.object(tasks.refresh_trend_query, "retry", side_effect=Retry()) as retry, \
+                    mock.patch.object(tasks.random, "uniform", return_value=1.0):
+                tasks.refresh_trend_query.apply(args=[str(self.query.id)], kwargs={"waits": waits})
+            countdowns.append(retry.call_args.kwargs["countdown"])
+            self.assertEqual(retry.call_args.kwargs["kwargs"], {"failures": 0, "waits": waits + 1})
+        self.assertEqual(countdowns, [10, 80, 300])
+
+    def test_slot_outlives_the_slowest_refresh(self):
+        with override_settings(PERPLEXITY_MAX_ATTEMPTS=3, PERPLEXITY_READ_TIMEOUT=120, PERPLEXITY_CONNECT_TIMEOUT=5,
+                               PERPLEXITY_RATE_LIMIT_MAX_WAIT=60, PERPLEXITY_RETRY_AFTER_MAX=120,
+                               TREND_REFRESH_SLOT_TIMEOUT=None):
+            self.assertEqual(tasks.refresh_slots().timeout, 3 * (120 + 5 + 60 + 120) + tasks.REFRESH_INGEST_ALLOWANCE)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_burst_then_waiters_queue_for_refills(self):
+        limiter = RateLimiter(limits={"interactive": {"per_minute": 60, "burst": 2}}, max_wait=5)
+        waits = [limiter.reserve() for _ in range(4)]
+
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 1.0, delta=0.1)
+        self.assertAlmostEqual(waits[3], 2.0, delta=0.1)
+
+    def test_bucket_outlives_reservations_past_capacity(self):
+        limiter = RateLimiter(limits={"batch": {"per_minute": 60, "burst": 1}}, max_wait=30)
+        with mock.patch("time.time", return_value=1000.0), traffic_class("batch"):
+            waits = [limiter.reserve() for _ in range(10)]
+        self.assertAlmostEqual(waits[-1], 9.0)
+
+        # Before the last reservation fires the bucket must still be in debt, not back to full.
+        with mock.patch("time.time", return_value=1008.5), traffic_class("batch"):
+            self.assertIsNotNone(cache.get(limiter.bucket("batch").key))
+            self.assertAlmostEqual(limiter.reserve(), 1.5)
+
+    def test_batch_traffic_cannot_spend_the_interactive_budget(self):
+        limiter = RateLimiter(limits={
+            "interactive": {"per_minute": 60, "burst": 1},
+            "batch": {"per_minute": 1, "burst": 1},
+        }, max_wait=0)
+
+        with traffic_class("batch"):
+            limiter.reserve()
+            with self.assertRaises(RateLimitExceeded):
+                limiter.reserve()
+        self.assertEqual(limiter.reserve(), 0.0)
+
+    def test_client_takes_a_token_per_attempt(self):
+        limiter = RateLimiter(limits={"interactive": {"per_minute": 1, "burst": 2}}, max_wait=0)
+        with MockPerplexityServer(faults=[503]) as server:
+            client = PerplexityClient(
+                api_key="test-key", api_url=server.url, limiter=limiter,
+                retry_policy=RetryPolicy(max_attempts=3, base_delay=0, max_delay=0),
+                breaker=CircuitBreaker(name="ratelimit", failure_threshold=10))
+            self.addCleanup(client.close)
+            self.assertEqual(client.create_completion(PAYLOAD).status_code, 200)
+            with self.assertRaises(RateLimitExceeded):
+                client.create_completion(PAYLOAD)
+
+        self.assertEqual(len(server.requests), 2)
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """locmem backend that rejects each address in `bounce_once` the first time, and counts sessions."""
+    opened = 0
+    bounce_once = set()
+
+    def open(self):
+        FlakyEmailBackend.opened += 1
+        return super().open()
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0] in self.bounce_once:
+                self.bounce_once.discard(message.to[0])
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (450, b"try again later")})
+        return super().send_messages(messages)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, EMAIL_BACKEND="trends.tests.FlakyEmailBackend")
+class EmailBatchTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+
+        FlakyEmailBackend.opened = 0
+        cache.clear()
+        self.query = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days", status="completed")
+        TrendResult.objects.create(query=self.query, version=2, topic="Thrift hauls", summary="Up")
+        self.items = []
+        for i in range(5):
+            user = get_user_model().objects.create_user(
+                email=f"reader{i}@example.com", password="x", first_name="R", last_name=str(i))
+            self.items.append({"user_id": str(user.id), "query_id": str(self.query.id), "version": 2})
+
+    def test_batch_shares_one_connection_and_retries_only_failures(self):
+        FlakyEmailBackend.bounce_once = {"reader3@example.com"}
+        self.assertEqual(tasks.send_trend_email_batch.apply(args=[self.items]).get(), {"queued": 5})
+        self.assertEqual(mail.outbox, [])  # rendered into the outbox, not sent
+
+        self.assertEqual(tasks.dispatch_email_outbox.apply().get(), {"sent": 4, "retrying": 1, "failed": 0})
+        bounced = EmailOutbox.objects.get(status="pending")
+        self.assertEqual((bounced.to_email, bounced.attempts), ("reader3@example.com", 1))
+        self.assertIn("try again later", bounced.last_error)
+        self.assertGreater(bounced.next_attempt_at, timezone.now())
+
+        self.assertEqual(tasks.dispatch_email_outbox.apply().get(), {"sent": 0, "retrying": 0, "failed": 0})
+        EmailOutbox.objects.filter(pk=bounced.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(tasks.dispatch_email_outbox.apply().get(), {"sent": 1, "retrying": 0, "failed": 0})
+
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), [f"reader{i}@example.com" for i in range(5)])
+        self.assertIn("Thrift hauls", mail.outbox[0].body)
+        self.assertIn("Thrift hauls", mail.outbox[0].alternatives[0][0])
+        # One session for the batch, one reopened after the bounce, one for the retry.
+        self.assertEqual(FlakyEmailBackend.opened, 3)
+
+    def test_smtp_outage_counts_as_an_attempt_for_every_claimed_row(self):
+        FlakyEmailBackend.bounce_once = set()
+        tasks.send_trend_email_batch.apply(args=[self.items])
+        with mock.patch.object(FlakyEmailBackend, "open", side_effect=ConnectionRefusedError("smtp down")):
+            self.assertEqual(tasks.dispatch_email_outbox.apply().get(), {"sent": 0, "retrying": 5, "failed": 0})
+
+        rows = EmailOutbox.objects.all()
+        self.assertEqual({(row.status, row.attempts, row.last_error) for row in rows}, {("pending", 1, "smtp down")})
+        self.assertTrue(all(row.next_attempt_at > timezone.now() for row in rows))
+        self.assertEqual(mail.outbox, [])
+
+    def test_outbox_gives_up_after_max_attempts(self):
+        FlakyEmailBackend.bounce_once = set()
+        email_utils.enqueue_emails([email_utils.build_signup_otp_email("x@example.com", "123456")], "signup_otp")
+        with override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=1), \
+                mock.patch.object(tasks, "send_email_batch", return_value=[(0, RuntimeError("550 no such user"))]):
+            self.assertEqual(tasks.dispatch_email_outbox.apply().get(), {"sent": 0, "retrying": 0, "failed": 1})
+        row = EmailOutbox.objects.get()
+        self.assertEqual((row.status, row.attempts, row.last_error), ("failed", 1, "550 no such user"))
+        self.assertEqual((row.body_text, row.body_html), ("", ""))
+
+    def test_signup_start_enqueues_the_otp_email(self):
+        with mock.patch.object(tasks, "send_email_batch") as send:
+            response = self.client.post(
+                reverse("api-signup-start"),
+                {"email": "New@Example.com", "first_name": "New", "last_name": "User"},
+                content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        send.assert_not_called()
+        self.assertEqual(mail.outbox, [])
+
+        row = EmailOutbox.objects.get()
+        self.assertEqual((row.kind, row.to_email, row.status), ("signup_otp", "new@example.com", "pending"))
+        self.assertTrue(SignUpOTP.objects.filter(email="new@example.com").exists())
+
+        tasks.dispatch_email_outbox.apply()
+        self.assertEqual(mail.outbox[0].subject, "Your TrendSage verification code")
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.body_text, row.body_html), ("sent", "", ""))
+
+    def test_purge_deletes_only_rows_sent_before_the_retention_window(self):
+        email_utils.enqueue_emails(
+            [email_utils.build_signup_otp_email(f"user{i}@example.com", "123456") for i in range(3)], "signup_otp")
+        old, recent, pending = EmailOutbox.objects.order_by("to_email")
+        EmailOutbox.objects.filter(pk=old.pk).update(status="sent", sent_at=timezone.now() - timedelta(days=8))
+        EmailOutbox.objects.filter(pk=recent.pk).update(status="sent", sent_at=timezone.now() - timedelta(days=6))
+
+        with override_settings(EMAIL_OUTBOX_RETENTION_DAYS=7):
+            self.assertEqual(tasks.purge_email_outbox(), 1)
+        self.assertEqual(set(EmailOutbox.objects.values_list("pk", flat=True)), {recent.pk, pending.pk})
+
+    def test_results_block_is_rendered_once_per_version(self):
+        FlakyEmailBackend.bounce_once = set()
+        with mock.patch.object(
+                email_utils, "render_results_block", wraps=email_utils.render_results_block) as render:
+            tasks.send_trend_email_batch.apply(args=[self.items[:3]])
+            tasks.send_trend_email_batch.apply(args=[self.items[3:]])
+        tasks.dispatch_email_outbox.apply()
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len({m.body for m in mail.outbox}), 5)  # unsubscribe links stay per user
+        self.assertTrue(all("1. Thrift hauls" in m.alternatives[0][0] for m in mail.outbox))
+
+    def test_render_cache_outage_still_queues_the_emails(self):
+        with mock.patch.object(email_utils.cache, "get", side_effect=ConnectionError("redis down")), \
+                mock.patch.object(email_utils.cache, "set", side_effect=ConnectionError("redis down")):
+            self.assertEqual(tasks.send_trend_email_batch.apply(args=[self.items]).get(), {"queued": 5})
+        self.assertTrue(all("Thrift hauls" in row.body_html for row in EmailOutbox.objects.all()))
+
+    def test_queue_splits_items_into_batches(self):
+        with override_settings(TREND_EMAIL_BATCH_SIZE=2), \
+                mock.patch.object(tasks.send_trend_email_batch, "delay") as delay:
+            self.assertEqual(tasks.queue_trend_emails(self.items), 5)
+        self.assertEqual([len(c.args[0]) for c in delay.call_args_list], [2, 2, 1])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DigestTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+
+        cache.clear()
+        self.started = timezone.now()
+        self.queries = []
+        for industry in ("fashion", "gaming"):
+            query = TrendQuery.objects.create(
+                industry=industry, region="India", persona="creator", date_range="last 7 days", status="completed")
+            TrendResult.objects.create(query=query, version=1, topic=f"Old {industry}", summary="Old")
+            TrendResult.objects.filter(query=query).update(created_at=self.started - timedelta(days=1))
+            TrendResult.objects.create(query=query, version=2, topic=f"New {industry}", summary="New")
+            self.queries.append(query)
+
+        users = get_user_model().objects
+        self.digest_user = users.create_user(email="digest@example.com", password="x", first_name="D", last_name="U")
+        self.instant_user = users.create_user(email="now@example.com", password="x", first_name="N", last_name="U")
+        for query in self.queries:
+            QuerySubscription.objects.create(user=self.digest_user, query=query, delivery="digest")
+            QuerySubscription.objects.create(user=self.instant_user, query=query)
+
+    def test_one_digest_per_user_covering_every_refreshed_query(self):
+        with CaptureQueriesContext(connection) as ctx, \
+                mock.patch.object(tasks.send_digest_batch, "delay") as delay:
+            outcome = tasks.send_trend_digests.apply(args=[self.started.isoformat()]).get()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(outcome, {"users": 1, "sections": 2})
+
+        digests = delay.call_args.args[0]
+        self.assertEqual(digests, [{"user_id": str(self.digest_user.id),
+                                    "sections": sorted([str(q.id), 2] for q in self.queries)}])
+
+        tasks.send_digest_batch.apply(args=[digests])
+        tasks.dispatch_email_outbox.apply()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["digest@example.com"])
+        self.assertIn("New fashion", mail.outbox[0].body)
+        self.assertIn("New gaming", mail.outbox[0].body)
+        self.assertNotIn("Old fashion", mail.outbox[0].body)
+
+    def test_digest_subscribers_get_no_immediate_email(self):
+        items = tasks.subscriber_emails(self.queries[0], 2)
+        self.assertEqual([item["user_id"] for item in items], [str(self.instant_user.id)])
+
+    def test_digest_preference_applies_to_later_subscriptions(self):
+        self.client.force_login(self.instant_user)
+        response = self.client.post(reverse("api-email-delivery"), {"delivery": "digest"},
+                                    content_type="application/json")
+        self.assertEqual(response.json(), {"delivery": "digest", "subscriptions": 2})
+
+        later = TrendQuery.objects.create(
+            industry="food", region="US", persona="chef", date_range="last 7 days", status="completed")
+        response = self.client.post(reverse("toggle-subscription-api", args=[later.id]), {"action": "subscribe"},
+                                    content_type="application/json")
+        self.assertEqual(response.json()["delivery"], "digest")
+        self.assertEqual(QuerySubscription.objects.get(user=self.instant_user, query=later).delivery, "digest")
+        self.assertEqual(QuerySubscription.objects.get(user=self.digest_user, query=self.queries[0]).delivery,
+                         "digest")  # an explicit choice is kept
+
+
+class RescoreResultsTests(TestCase):
+    def setUp(self):
+        self.query = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days", status="completed")
+        # Spread over the key space, two keys per quarter of it.
+        self.ids = [uuid.UUID(int=(i << 128) // 8 + 12345) for i in range(8)]
+        TrendResult.objects.bulk_create([
+            TrendResult(id=pk, query=self.query, topic=f"T{i}", summary="", engagement_score=10 * (i + 1),
+                        freshness_score=50, relevance_score=50, final_score=0)
+            for i, pk in enumerate(self.ids)
+        ])
+
+    def rescore(self, *args):
+        out = StringIO()
+        call_command("rescore_results", "--weights", "1,0,0", *args, stdout=out)
+        return out.getvalue()
+
+    def scores(self):
+        return dict(TrendResult.objects.values_list("id", "final_score"))
+
+    def test_dry_run_reports_without_writing(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "rescore.json")
+        out = self.rescore("--dry-run", "--checkpoint", path)
+
+        self.assertIn("Would rescore 8 results.", out)
+        self.assertIn("changed 8 rows", out)
+        self.assertEqual(set(self.scores().values()), {0})
+        self.assertFalse(os.path.exists(path))
+
+    def test_resume_skips_finished_ranges_and_checkpointed_rows(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "rescore.json")
+        ranges = rescore_results.split_uuid_space(2)
+        ranges[0]["done"] = True
+        ranges[1]["after"] = str(self.ids[5])
+        opts = {"chunk_size": 2, "weights": [1.0, 0.0, 0.0], "decay_days": 7.0, "components": False,
+                "dry_run": False, "now": timezone.now().isoformat()}
+        with open(path, "w") as f:
+            json.dump({"opts": opts, "ranges": ranges}, f)
+
+        out = self.rescore("--checkpoint", path)
+
+        self.assertIn("Resuming from", out)
+        scores = self.scores()
+        self.assertEqual([scores[pk] for pk in self.ids], [0] * 6 + [70, 80])
+        with open(path) as f:
+            self.assertTrue(all(r["done"] for r in json.load(f)["ranges"]))
+
+    def test_resumed_run_reports_on_every_row(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "rescore.json")
+        real_chunk = rescore_results.rescore_chunk
+        calls = []
+
+        def interrupted(rows, opts, now):
+            calls.append(len(rows))
+            if len(calls) == 3:
+                raise RuntimeError("worker killed")
+            return real_chunk(rows, opts, now)
+
+        with mock.patch.object(rescore_results, "rescore_chunk", side_effect=interrupted), \
+                self.assertRaises(RuntimeError):
+            self.rescore("--chunk-size", "2", "--checkpoint", path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)["stats"]["rows"], 4)
+
+        out = self.rescore("--chunk-size", "2", "--checkpoint", path)
+
+        self.assertIn("changed 8 rows", out)
+        self.assertIn("Rescored 8 results.", out)
+        self.assertIn("mean 0.00 -> 45.00", out)
+
+    def test_key_ranges_cover_every_row_exactly_once(self):
+        edges = [uuid.UUID(int=0), uuid.UUID(int=(1 << 128) - 1), uuid.UUID(int=1 << 126)]
+        TrendResult.objects.bulk_create([
+            TrendResult(id=pk, query=self.query, topic="edge", summary="") for pk in edges])
+        every_pk = sorted(self.ids + edges)
+        opts = {"chunk_size": 2, "weights": (1.0, 0.0, 0.0), "decay_days": 7.0, "components": False,
+                "dry_run": True, "now": timezone.now().isoformat()}
+        for parts in (1, 3, 4, 7):
+            ranges = rescore_results.split_uuid_space(parts)
+            seen = []
+
+            def record(rows, opts, now):
+                seen.extend(row.pk for row in rows)
+                return rescore_results.empty_stats()
+
+            with mock.patch.object(rescore_results, "rescore_chunk", side_effect=record):
+                for index, key_range in enumerate(ranges):
+                    rescore_results.rescore_range(index, key_range, opts, lambda *update: None)
+            self.assertEqual(sorted(seen), every_pk, parts)
+            self.assertEqual(ranges[0]["lower"], str(uuid.UUID(int=0)))
+            self.assertIsNone(ranges[-1]["upper"])
+            self.assertEqual([r["upper"] for r in ranges[:-1]], [r["lower"] for r in ranges[1:]])
+
+
+@override_settings(EMBEDDING_MODEL_NAME="model-a")
+class BackfillEmbeddingsTests(TestCase):
+    def test_fills_missing_and_stale_embeddings_only(self):
+        query = TrendQuery.objects.create(
+            industry="fashion", region="India", persona="creator", date_range="last 7 days", status="completed")
+        missing = TrendResult.objects.create(query=query, topic="Missing", summary="")
+        stale = TrendResult(query=query, topic="Stale", summary="")
+        stale.set_embedding(np.zeros(4), "model-old")
+        current = TrendResult(query=query, topic="Current", summary="")
+        current.set_embedding(np.full(4, 0.5), "model-a")
+        TrendResult.objects.bulk_create([stale, current])
+
+        def fake_embed(trends, model_name=None, batch_size=32):
+            return np.ones((len(trends), 4), dtype=np.float32)
+
+        out = StringIO()
+        with mock.patch.object(backfill_embeddings, "embed_trends", side_effect=fake_embed) as embed:
+            call_command("backfill_embeddings", "--chunk-size", "1", stdout=out)
+
+        self.assertEqual(sorted(t for call in embed.call_args_list for t, _ in call.args[0]), ["Missing", "Stale"])
+        self.assertIn("Backfilled embeddings for 2 results with model-a.", out.getvalue())
+        for row in (missing, stale):
+            row.refresh_from_db()
+            self.assertEqual(row.embedding_model, "model-a")
+            np.testing.assert_array_equal(row.get_embedding(), np.ones(4))
+        current.refresh_from_db()
+        np.testing.assert_array_equal(current.get_embedding(), np.full(4, 0.5))
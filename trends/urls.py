@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import TrendQueryDetailView, TrendQueryCreateView, TrendResultDetailView, SignupAPI, LoginAPI, DashboardAPI, LogoutAPI, QuerySubscriptionToggleAPI, MeAPIView, ToggleSubscriptionAPI, SignupStartAPI, SignupVerifyAPI
+from .views import TrendQueryDetailView, TrendQueryCreateView, TrendResultDetailView, SignupAPI, LoginAPI, DashboardAPI, LogoutAPI, QuerySubscriptionToggleAPI, MeAPIView, ToggleSubscriptionAPI, EmailDeliveryAPI, SignupStartAPI, SignupVerifyAPI
 from rest_framework.authtoken.views import obtain_auth_token
 
 
@@ -23,6 +23,7 @@ urlpatterns = [
     # Subscription
     path("trends/query/<uuid:query_id>/subscription/", QuerySubscriptionToggleAPI.as_view(), name="api-query-subscription"),
     path("trends/query/<uuid:query_id>/subscription/toggle/", ToggleSubscriptionAPI.as_view(), name="toggle-subscription-api"),
+    path("subscriptions/delivery/", EmailDeliveryAPI.as_view(), name="api-email-delivery"),
 
     # Profile
     path("auth/token/", obtain_auth_token, name="api_token_auth"),
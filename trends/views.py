@@ -5,7 +5,7 @@ from rest_framework import status
 from django.shortcuts import get_object_or_404
 from .models import TrendQuery, TrendResult, QuerySubscription, SignUpOTP
 from .serializers import TrendQuerySerializer, TrendResultSerializer, TrendQueryCreateSerializer, SignupSerializer, LoginSerializer, UserSerializer, TrendQueryBriefSerializer, QuerySubscriptionSerializer, SignupStartSerializer, SignupVerifySerializer
-from .tasks import process_trend_query
+from .tasks import dispatch_email_outbox, process_trend_query
 from rest_framework.pagination import PageNumberPagination
 from django.utils.timezone import now
 from datetime import timedelta
@@ -17,10 +17,11 @@ from drf_yasg.utils import swagger_auto_schema
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.authtoken.models import Token
 from rest_framework.authentication import SessionAuthentication, TokenAuthentication
+from django.db import transaction
 from django.db.models import Max
 import random
 from django.utils import timezone
-from .email_utils import send_signup_otp_email
+from .email_utils import build_signup_otp_email, enqueue_emails
 # Create your views here.
 
 
@@ -212,13 +213,13 @@ class TrendQueryCreateView(APIView):
 
             if existing_query:
                 new_query = TrendQuery.objects.create(
-                    user=request.user,
                     industry=industry,
                     region=region,
                     persona=persona,
                     date_range=date_range,
                     status="completed",
                 )
+                new_query.user.add(request.user)
 
                 for result in existing_query.results.all():
                     TrendResult.objects.create(
@@ -230,7 +231,10 @@ class TrendQueryCreateView(APIView):
                         freshness_score=result.freshness_score,
                         relevance_score=result.relevance_score,
                         final_score=result.final_score,
+                        newest_source_at=result.newest_source_at,
                         suggested_angles=result.suggested_angles,
+                        embedding=result.embedding,
+                        embedding_model=result.embedding_model,
                     )
 
                 return Response(
@@ -242,7 +246,7 @@ class TrendQueryCreateView(APIView):
                     status=status.HTTP_200_OK,
                 )
 
-            query = serializer.save(status="pending", user=request.user)
+            query = serializer.save(status="pending", user=[request.user])  # user is many-to-many
             QuerySubscription.objects.get_or_create(
                 user=request.user,
                 query=query,
@@ -342,6 +346,8 @@ class ToggleSubscriptionAPI(APIView):
             sub.is_active = True
         elif action == "deactivate":
             sub.is_active = False
+        elif action in ("digest", "immediate"):
+            sub.delivery = action
         else:
             return Response({"error": "Invalid action"}, status=400)
 
@@ -350,11 +356,31 @@ class ToggleSubscriptionAPI(APIView):
             {
                 "query_id": str(query_id),
                 "wants_emails": sub.wants_emails,
-                "is_active": sub.is_active
+                "is_active": sub.is_active,
+                "delivery": sub.delivery,
             }
         )
 
 
+class EmailDeliveryAPI(APIView):
+    """
+    Switch the user to "immediate" or "digest" emails: their existing
+    subscriptions now, and the ones they create later by default.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        delivery = request.data.get("delivery")
+        if delivery not in dict(QuerySubscription.DELIVERY_CHOICES):
+            return Response({"error": "Invalid delivery"}, status=400)
+
+        with transaction.atomic():
+            request.user.email_delivery = delivery
+            request.user.save(update_fields=["email_delivery"])
+            updated = QuerySubscription.objects.filter(user=request.user).update(delivery=delivery)
+        return Response({"delivery": delivery, "subscriptions": updated})
+
+
 class MeAPIView(APIView):
     authentication_classes = [SessionAuthentication, TokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -418,14 +444,17 @@ class SignupStartAPI(APIView):
             expires_at=timezone.now() + timedelta(minutes=10),
         )
         otp_obj.set_otp(otp)
-        otp_obj.save()
 
-        send_signup_otp_email(
-            email=email, 
-            otp=otp,
-            name=first_name, 
-            expiry_minutes=10
-        )
+        # The code and its email commit together; the outbox dispatcher sends it.
+        with transaction.atomic():
+            otp_obj.save()
+            enqueue_emails([build_signup_otp_email(
+                email=email, 
+                otp=otp,
+                name=first_name, 
+                expiry_minutes=10
+            )], "signup_otp")
+            transaction.on_commit(dispatch_email_outbox.delay, robust=True)
 
         return Response(
             {
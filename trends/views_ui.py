@@ -9,6 +9,7 @@ from django.utils.timezone import now
 from datetime import timedelta
 from django.urls import reverse
 from .tasks import process_trend_query
+from . import scoring
 from django.db.models import Max
 from django.views.decorators.http import require_http_methods
 from django.http import JsonResponse, HttpResponseForbidden
@@ -177,7 +178,9 @@ def query_detail(request, id):
         .order_by("-version")
     )
 
-    results = query.results.filter(version=version).order_by("-final_score")
+    results = scoring.rank_results(query.results.filter(version=version))
+    # Provisional rows only exist while a stream (first fetch or refresh) is being ingested.
+    generating = query.results.filter(version=version, is_provisional=True).exists()
     return render(
         request,
         "trends/query_detail.html",
@@ -187,6 +190,7 @@ def query_detail(request, id):
             "version": version,
             "versions": versions,
             "subscription": sub,
+            "generating": generating,
         },
     )
 
@@ -201,6 +205,8 @@ def result_detail(request, query_id, id):
         })
 
     result = get_object_or_404(TrendResult, id=id, query__id=query_id)
+    if scoring.live_ranking_enabled():
+        scoring.rank_live([result])
     return render(request, "trends/result_detail.html", {
         "result": result,
         "query_id": query_id
@@ -1,5 +1,7 @@
 import os
+import time
 from celery import Celery
+from celery.signals import task_postrun, task_prerun, worker_process_init, worker_process_shutdown
 from decouple import config
 
 
@@ -10,3 +12,39 @@ app = Celery('trendsage')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def warm_up_embedding_model(**kwargs):
+    # Only worker processes score results, so only they load the model.
+    from django.conf import settings
+    if not getattr(settings, "EMBEDDING_WARM_UP", True):
+        return
+
+    from trends.embeddings import warm_up
+    warm_up()
+
+
+_task_started = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def observe_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is None:
+        return
+    from trends.metrics import CELERY_TASK_DURATION
+    CELERY_TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    # Lets the multiprocess collector drop live gauges of exited children.
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid or os.getpid())
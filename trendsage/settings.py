@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from celery.schedules import crontab
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'trends.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,6 +60,9 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'trendsage.urls'
 
+# No explicit 'loaders': Django then wraps the filesystem and app loaders in
+# the cached loader (also with DEBUG since 4.1), so workers compile each
+# email template once per process.
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -141,12 +145,54 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
 
+# Nightly refresh fans out one task per query onto this queue, kept apart from
+# interactive queries on "celery". Some worker must consume it (-Q refresh).
+TREND_REFRESH_QUEUE = config("TREND_REFRESH_QUEUE", default="refresh")
+TREND_REFRESH_CONCURRENCY = config("TREND_REFRESH_CONCURRENCY", default=4, cast=int)  # refreshes in flight, all workers; 0 = no cap
+TREND_REFRESH_MAX_RETRIES = config("TREND_REFRESH_MAX_RETRIES", default=3, cast=int)  # per query
+# Seconds before the slot of a worker that died mid-refresh is freed. None derives
+# the worst-case refresh time from the Perplexity timeouts (tasks.refresh_slot_timeout).
+TREND_REFRESH_SLOT_TIMEOUT = None
+TREND_REFRESH_SLOT_WAIT_MAX = 300  # seconds; cap on the backoff of a refresh waiting for a slot
+# Trend emails go out in batches, one SMTP connection per batch. Every email
+# task (signup codes included) runs on this queue; some worker must consume it (-Q email).
+TREND_EMAIL_QUEUE = config("TREND_EMAIL_QUEUE", default="email")
+TREND_EMAIL_BATCH_SIZE = config("TREND_EMAIL_BATCH_SIZE", default=100, cast=int)
+TREND_EMAIL_RENDER_CACHE_TTL = 60 * 60  # seconds a rendered results block is reused per (query, version)
+# Email outbox: every email is stored first, then sent by dispatch_email_outbox
+EMAIL_OUTBOX_BATCH_SIZE = config("EMAIL_OUTBOX_BATCH_SIZE", default=100, cast=int)  # rows claimed per connection
+EMAIL_OUTBOX_MAX_ATTEMPTS = config("EMAIL_OUTBOX_MAX_ATTEMPTS", default=5, cast=int)
+EMAIL_OUTBOX_BACKOFF = 60  # seconds before the first retry, doubled per attempt
+EMAIL_OUTBOX_RETENTION_DAYS = config("EMAIL_OUTBOX_RETENTION_DAYS", default=7, cast=int)  # sent rows kept this long
+CELERY_TASK_ROUTES = {
+    "trends.tasks.refresh_trend_query": {"queue": TREND_REFRESH_QUEUE},
+    "trends.tasks.send_trend_email_batch": {"queue": TREND_EMAIL_QUEUE},
+    "trends.tasks.send_digest_batch": {"queue": TREND_EMAIL_QUEUE},
+    "trends.tasks.dispatch_email_outbox": {"queue": TREND_EMAIL_QUEUE},
+    "trends.tasks.purge_email_outbox": {"queue": TREND_EMAIL_QUEUE},
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": config("CACHE_URL", default=config("REDIS_URL", default="redis://127.0.0.1:6379/0")),
+    }
+}
+
 CELERY_BEAT_SCHEDULE = {
     "refresh-trend-queries-daily": {
         "task": "trends.tasks.refresh_trend_queries",
         # "schedule": 300.0,  # every 5 min (for testing)
         "schedule": crontab(minute=0, hour=0),
     },
+    "dispatch-email-outbox": {
+        "task": "trends.tasks.dispatch_email_outbox",
+        "schedule": 60.0,  # sweeps retries and anything a wake-up missed
+    },
+    "purge-email-outbox-daily": {
+        "task": "trends.tasks.purge_email_outbox",
+        "schedule": crontab(minute=30, hour=3),
+    },
 }
 
 REST_FRAMEWORK = {
@@ -191,6 +237,54 @@ EMAIL_HOST_PASSWORD = config("EMAIL_HOST_PASSWORD")
 # Default from address
 DEFAULT_FROM_EMAIL = config("DEFAULT_FROM_EMAIL", default=EMAIL_HOST_USER)
 
+# Perplexity client
+PERPLEXITY_API_URL = config(
+    "PERPLEXITY_API_URL", default="https://api.perplexity.ai/chat/completions")  # point at run_mock_perplexity for load tests
+PERPLEXITY_CONNECT_TIMEOUT = config("PERPLEXITY_CONNECT_TIMEOUT", default=5, cast=float)    # seconds
+PERPLEXITY_READ_TIMEOUT = config("PERPLEXITY_READ_TIMEOUT", default=120, cast=float)        # seconds
+PERPLEXITY_POOL_MAXSIZE = config("PERPLEXITY_POOL_MAXSIZE", default=10, cast=int)
+PERPLEXITY_MAX_CONCURRENCY = config("PERPLEXITY_MAX_CONCURRENCY", default=8, cast=int)  # async fetches in flight per process
+PERPLEXITY_MAX_ATTEMPTS = config("PERPLEXITY_MAX_ATTEMPTS", default=3, cast=int)
+PERPLEXITY_BACKOFF_BASE = 1.0         # seconds; delay ~ U(0, base * 2**attempt)
+PERPLEXITY_BACKOFF_MAX = 30.0         # seconds
+PERPLEXITY_RETRY_AFTER_MAX = 120.0    # cap on an honoured Retry-After
+PERPLEXITY_BREAKER_THRESHOLD = config("PERPLEXITY_BREAKER_THRESHOLD", default=5, cast=int)  # consecutive failures
+PERPLEXITY_BREAKER_RESET_TIMEOUT = config("PERPLEXITY_BREAKER_RESET_TIMEOUT", default=60, cast=int)  # seconds
+# Token buckets shared by all workers, one per traffic class (trends/ratelimit.py);
+# keep the per-minute sum under the account's limit. per_minute 0 = unlimited.
+PERPLEXITY_RATE_LIMITS = {
+    "interactive": {"per_minute": config("PERPLEXITY_INTERACTIVE_RPM", default=30, cast=int), "burst": 10},
+    "batch": {"per_minute": config("PERPLEXITY_BATCH_RPM", default=15, cast=int), "burst": 3},
+}
+PERPLEXITY_RATE_LIMIT_MAX_WAIT = config("PERPLEXITY_RATE_LIMIT_MAX_WAIT", default=60, cast=float)  # seconds
+PERPLEXITY_STREAMING = config("PERPLEXITY_STREAMING", default=False, cast=bool)  # SSE + provisional rows
+PERPLEXITY_RESPONSE_CACHE_ENABLED = config("PERPLEXITY_RESPONSE_CACHE_ENABLED", default=True, cast=bool)
+PERPLEXITY_RESPONSE_CACHE_TTL = config("PERPLEXITY_RESPONSE_CACHE_TTL", default=60 * 60 * 6, cast=int)  # seconds
+# USD per million tokens plus a flat per-request fee, used when a response carries
+# no usage.cost of its own. Keep in line with https://docs.perplexity.ai/getting-started/pricing
+PERPLEXITY_PRICING = {
+    "sonar": {"input": 1.0, "output": 1.0, "request": 0.005},
+    "sonar-pro": {"input": 3.0, "output": 15.0, "request": 0.006},
+}
+
+# Embeddings
+# Loaded lazily on first use; celery workers warm it up on process start.
+EMBEDDING_MODEL_NAME = config("EMBEDDING_MODEL_NAME", default="all-MiniLM-L6-v2")
+EMBEDDING_WARM_UP = config("EMBEDDING_WARM_UP", default=True, cast=bool)
+QUERY_EMBEDDING_CACHE_SIZE = config("QUERY_EMBEDDING_CACHE_SIZE", default=1024, cast=int)
+QUERY_EMBEDDING_CACHE_TIMEOUT = 60 * 60 * 24 * 30   # seconds, in the shared cache
+
+# Metrics
+# /metrics/ is served to staff users, or to scrapers sending "Authorization: Bearer <METRICS_TOKEN>".
+# For multi-process servers set PROMETHEUS_MULTIPROC_DIR in the environment (see README).
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+# Scoring
+# final_score = engagement * w[0] + freshness * w[1] + relevance * w[2]
+TREND_SCORE_WEIGHTS = config("TREND_SCORE_WEIGHTS", default="0.3,0.4,0.3", cast=Csv(float, post_process=tuple))
+TREND_FRESHNESS_DECAY_DAYS = config("TREND_FRESHNESS_DECAY_DAYS", default=7, cast=float)
+TREND_LIVE_RANKING = config("TREND_LIVE_RANKING", default=False, cast=bool)  # freshness/final_score at read time
+
 # Urls
 LOGIN_URL = "/trendsage/web/login/"
 LOGIN_REDIRECT_URL = "/trendsage/web/dashboard/"    # where to go after login
@@ -19,6 +19,7 @@ from django.urls import path, include, re_path
 from rest_framework import permissions
 from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
+from trends.metrics import metrics_view
 
 
 schema_view = get_schema_view(
@@ -36,6 +37,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('trendsage/api/', include('trends.urls')),
     path('trendsage/web/', include('trends.urls_ui')),
+    path('metrics/', metrics_view, name='metrics'),
 ]
 
 urlpatterns += [